@@ -0,0 +1,79 @@
+"""
+This module if ran takes input from a rabbitmq queue and index it with an asyncio pipeline, see
+index.ingest.IngestionPipeline.
+"""
+
+import argparse
+import asyncio
+import logging
+
+import aio_pika
+
+from index.indexer import Indexer
+from index.indexer import configure
+from index.ingest import IngestionPipeline
+from index.ingest import IndexMaintenance
+from index.migration import migrate
+
+CRAWLED_QUEUE = "crawledQueue"
+
+
+def acknowledger(message):
+	"""
+	creates the acknowledge coroutine function of a message for the IngestionPipeline. The pipeline only asks to requeue
+	the messages of pages that failed to persist on their own, and a message is requeued at most once, so that a single
+	bad page cannot block the queue.
+	:param message: the received message.
+	:return: the acknowledge coroutine function.
+	"""
+
+	async def acknowledge(success, requeue):
+		if success:
+			await message.ack()
+		else:
+			await message.nack(requeue = requeue and not message.redelivered)
+
+	return acknowledge
+
+
+async def consume(queue):
+	"""
+	yields the messages of a queue for the IngestionPipeline. No message is taken from the broker while the pipeline is
+	full, and the broker holds back messages beyond the prefetch limit, so a slow pipeline slows down consumption.
+	:param queue: the queue to consume.
+	:return: an async generator of (body, acknowledge) tuples.
+	"""
+	async with queue.iterator() as iterator:
+		async for message in iterator:
+			yield message.body, acknowledger(message)
+
+
+async def main(arguments):
+	migrate(configure(arguments.database), arguments.documents)
+	indexer = Indexer(document_directory = arguments.documents)
+	connection = await aio_pika.connect_robust(host = "localhost")
+	try:
+		channel = await connection.channel()
+		await channel.set_qos(prefetch_count = arguments.prefetch)
+		queue = await channel.declare_queue(CRAWLED_QUEUE, durable = True)
+		pipeline = IngestionPipeline(indexer, batch_size = arguments.batch_size, queue_size = arguments.queue_size,
+		                             after_batch = IndexMaintenance().maintain)
+		await pipeline.run(consume(queue), report_interval = arguments.report_interval)
+	finally:
+		await connection.close()
+		indexer.close()
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description = "Indexes crawled pages from a rabbitmq queue with asyncio.")
+	parser.add_argument("--database", default = "sqlite:///search_index.db", help = "the database connection string")
+	parser.add_argument("--documents", default = "documents", help = "the directory of the page content store")
+	parser.add_argument("--batch-size", type = int, default = 100, help = "the maximum pages per batch")
+	parser.add_argument("--queue-size", type = int, default = 1000, help = "the maximum items waiting per stage")
+	parser.add_argument("--prefetch", type = int, default = 1000, help = "the maximum unacknowledged messages")
+	parser.add_argument("--report-interval", type = float, default = 10, help = "the seconds between depth reports")
+	logging.basicConfig(level = logging.INFO, format = "%(asctime)s %(levelname)s %(name)s: %(message)s")
+	try:
+		asyncio.run(main(parser.parse_args()))
+	except KeyboardInterrupt:
+		print("closing resources")
@@ -0,0 +1,153 @@
+"""
+This module generates synthetic corpora of crawled pages for the benchmarks. The words of the pages follow a Zipf
+distribution over a generated vocabulary, and the links between pages follow a power law, so that a few pages are
+linked by many and most pages by few, as on the web. The same seed always yields the same corpus.
+"""
+
+import hashlib
+import itertools
+import random
+
+from index.entry import Anchor
+from index.entry import Header
+from index.entry import PageDocument
+from index.entry import TextSection
+
+# the corpus sizes the benchmarks are usually run at
+SIZES = {"small": 1000, "medium": 100000, "large": 1000000}
+CONSONANTS = "bcdfghjklmnprstvz"
+VOWELS = "aeiou"
+
+
+def vocabulary(size):
+	"""
+	generates distinct pronounceable words, shorter for lower ranks like the frequent words of natural language.
+	:param size: the amount of words.
+	:return: the list of words, ordered by rank.
+	"""
+	syllables = [consonant + vowel for consonant in CONSONANTS for vowel in VOWELS]
+	words = []
+	for rank in range(size):
+		word = []
+		while True:
+			word.append(syllables[rank % len(syllables)])
+			rank //= len(syllables)
+			if rank == 0:
+				break
+			rank -= 1
+		words.append("".join(word))
+	return words
+
+
+def zipf_weights(size, exponent):
+	"""
+	computes the cumulative weights of a Zipf distribution, for random.choices.
+	:param size: the amount of ranks.
+	:param exponent: the exponent of the distribution, about 1 for the words of natural language.
+	:return: the list of cumulative weights.
+	"""
+	return list(itertools.accumulate(1 / rank ** exponent for rank in range(1, size + 1)))
+
+
+class CorpusGenerator:
+	"""
+	Generates the pages of a synthetic corpus. Page i has the page id i + 1 and a url derived from it. The amount of
+	links of a page follows a Pareto distribution, and their targets are drawn from a Zipf distribution over a random
+	popularity order of the pages, which gives the in-degrees a power law as well.
+	"""
+
+	def __init__(self, page_count, vocabulary_size=50000, word_exponent=1.0, link_exponent=1.0, section_length=40,
+	             sections=(1, 6), headers=(0, 3), links=1.5, max_links=50, seed=0):
+		"""
+		creates a new CorpusGenerator.
+		:param page_count: the amount of pages in the corpus.
+		:param vocabulary_size: the amount of distinct words.
+		:param word_exponent: the exponent of the Zipf distribution of the words.
+		:param link_exponent: the exponent of the Zipf distribution of the link targets.
+		:param section_length: the mean amount of words of a text section.
+		:param sections: the minimum and maximum amount of text sections of a page.
+		:param headers: the minimum and maximum amount of headers of a page.
+		:param links: the shape of the Pareto distribution of the amount of links of a page, lower means more links.
+		:param max_links: the maximum amount of links of a page.
+		:param seed: the seed of the random generator.
+		"""
+		self.page_count = page_count
+		self.words = vocabulary(vocabulary_size)
+		self._word_weights = zipf_weights(vocabulary_size, word_exponent)
+		self._link_weights = zipf_weights(page_count, link_exponent)
+		self._section_length = section_length
+		self._sections = sections
+		self._headers = headers
+		self._links = links
+		self._max_links = max_links
+		self._seed = seed
+		self._popularity = list(range(page_count))
+		random.Random(seed).shuffle(self._popularity)
+
+	def __iter__(self):
+		return self.pages()
+
+	def __len__(self):
+		return self.page_count
+
+	def pages(self):
+		"""
+		generates the pages of the corpus one by one, so that even the largest corpora need not fit in memory.
+		:return: an iterator of PageDocument.
+		"""
+		generator = random.Random(self._seed)
+		for number in range(self.page_count):
+			yield self.page(number, generator)
+
+	def page(self, number, generator):
+		"""
+		generates a single page.
+		:param number: the number of the page, from 0.
+		:param generator: the random generator.
+		:return: the PageDocument.
+		"""
+		title = self.text(generator.randint(2, 8), generator)
+		headers = [Header(generator.randint(1, 4), self.text(generator.randint(2, 8), generator))
+		           for _ in range(generator.randint(*self._headers))]
+		texts = [TextSection(self.text(max(1, int(generator.expovariate(1 / self._section_length))), generator))
+		         for _ in range(generator.randint(*self._sections))]
+		link_count = min(self._max_links, int(generator.paretovariate(self._links)) - 1)
+		targets = generator.choices(self._popularity, cum_weights=self._link_weights, k=link_count)
+		anchors = [Anchor(self.text(generator.randint(1, 4), generator), page_url(target)) for target in targets
+		           if target != number]
+		content = " ".join([title] + [header.text for header in headers] + [text.text for text in texts]).encode("utf8")
+		return PageDocument(doc_id=number + 1, title=title, checksum=hashlib.md5(content).digest(),
+		                    url=page_url(number), content=content, anchors=anchors, texts=texts, headers=headers)
+
+	def text(self, length, generator):
+		"""
+		generates a text of words drawn from the Zipf distribution.
+		:param length: the amount of words.
+		:param generator: the random generator.
+		:return: the text.
+		"""
+		return " ".join(generator.choices(self.words, cum_weights=self._word_weights, k=length))
+
+	def query(self, length, generator):
+		"""
+		generates a query of distinct words drawn from the Zipf distribution, like the queries of users favour frequent
+		words.
+		:param length: the amount of words.
+		:param generator: the random generator.
+		:return: the query.
+		"""
+		words = []
+		while len(words) < length:
+			word = generator.choices(self.words, cum_weights=self._word_weights)[0]
+			if word not in words:
+				words.append(word)
+		return " ".join(words)
+
+
+def page_url(number):
+	"""
+	gets the url of a page of a synthetic corpus.
+	:param number: the number of the page, from 0.
+	:return: the url.
+	"""
+	return "https://www.site{0}.com/page/{1}".format(number // 100, number)
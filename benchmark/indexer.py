@@ -0,0 +1,220 @@
+"""
+This module if ran indexes a synthetic corpus into a fresh index and measures the index throughput, the latency of
+searches of 1, 2 and 5 words, the time of the page rank calculation and the size of the index on disk. The results are
+written as json, so that runs before and after a change can be compared. The corpus is generated from a seed, so runs
+with the same arguments index the same pages and search the same queries.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmark.corpus import SIZES
+from benchmark.corpus import CorpusGenerator
+from index.indexer import Indexer
+from index.indexer import cleanup
+from index.indexer import configure
+from index.migration import migrate
+
+# the amounts of words of the measured queries
+QUERY_LENGTHS = (1, 2, 5)
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values, percent):
+	"""
+	gets a percentile of some values by the nearest rank method.
+	:param values: the sorted values.
+	:param percent: the percentile, from 0 to 100.
+	:return: the value, or None if there are no values.
+	"""
+	if len(values) == 0:
+		return None
+	rank = max(1, -(-percent * len(values) // 100))
+	return values[rank - 1]
+
+
+def latency_summary(seconds):
+	"""
+	summarizes the latencies of some operations.
+	:param seconds: the latencies in seconds.
+	:return: a dictionary of the amount of operations, and the mean, percentiles and maximum in milliseconds.
+	"""
+	milliseconds = sorted(second * 1000 for second in seconds)
+	summary = {"count": len(milliseconds), "mean_ms": sum(milliseconds) / len(milliseconds) if milliseconds else None}
+	for percent in PERCENTILES:
+		summary["p{0}_ms".format(percent)] = percentile(milliseconds, percent)
+	summary["max_ms"] = milliseconds[-1] if milliseconds else None
+	return summary
+
+
+def directory_size(path):
+	"""
+	gets the size of a file, or of all files below a directory.
+	:param path: the path.
+	:return: the size in bytes, 0 if the path does not exist.
+	"""
+	if os.path.isfile(path):
+		return os.path.getsize(path)
+	size = 0
+	for directory, _, files in os.walk(path):
+		size += sum(os.path.getsize(os.path.join(directory, name)) for name in files)
+	return size
+
+
+def measure_indexing(indexer, corpus, batch_size):
+	"""
+	indexes a corpus in batches.
+	:param indexer: the Indexer.
+	:param corpus: the CorpusGenerator.
+	:param batch_size: the amount of pages indexed together.
+	:return: a dictionary of the amount of pages and tokens, the seconds taken and the throughput.
+	"""
+	pages, tokens, seconds = 0, 0, 0.0
+	batch = []
+	for page in corpus:
+		batch.append(page)
+		if len(batch) == batch_size:
+			tokens += sum(page_tokens(page) for page in batch)
+			seconds += timed(indexer.index_many, batch)
+			pages += len(batch)
+			batch = []
+	if len(batch) != 0:
+		tokens += sum(page_tokens(page) for page in batch)
+		seconds += timed(indexer.index_many, batch)
+		pages += len(batch)
+	seconds += timed(indexer.flush_segments)
+	return {"pages": pages, "tokens": tokens, "seconds": seconds, "pages_per_second": pages / seconds,
+	        "tokens_per_second": tokens / seconds}
+
+
+def measure_queries(indexer, corpus, count, k, seed):
+	"""
+	measures the latency of ranked and boolean searches of 1, 2 and 5 words. The query cache of the indexer should be
+	disabled, so that every search is measured in full.
+	:param indexer: the Indexer.
+	:param corpus: the CorpusGenerator the queries are drawn from.
+	:param count: the amount of queries of each length.
+	:param k: the amount of results of the ranked searches.
+	:param seed: the seed of the random generator of the queries.
+	:return: a dictionary mapping each kind of search and query length to its latency summary.
+	"""
+	generator = random.Random(seed)
+	results = {}
+	for length in QUERY_LENGTHS:
+		queries = [corpus.query(length, generator) for _ in range(count)]
+		results["ranked_{0}".format(length)] = latency_summary([timed(indexer.search, query, k) for query in queries])
+		results["boolean_{0}".format(length)] = latency_summary(
+			[timed(indexer.search_by_keywords, query) for query in queries])
+	return results
+
+
+def timed(function, *arguments):
+	"""
+	measures the wall clock time of a function call.
+	:param function: the function.
+	:param arguments: the arguments of the call.
+	:return: the seconds taken.
+	"""
+	start = time.perf_counter()
+	function(*arguments)
+	return time.perf_counter() - start
+
+
+def page_tokens(page):
+	"""
+	counts the words of a synthetic page, which are separated by single spaces, and its url, which is a single word.
+	:param page: the PageDocument.
+	:return: the amount of words.
+	"""
+	sections = [page.title] + [header.text for header in page.headers] + [text.text for text in page.texts] + [
+		anchor.text for anchor in page.anchors]
+	return sum(len(section.split(" ")) for section in sections) + 1
+
+
+def run(page_count, seed=0, query_count=200, k=10, batch_size=100, vocabulary_size=50000, segments=False,
+        directory=None, metrics=False):
+	"""
+	runs the benchmark on a fresh index in a temporary directory, which is removed afterwards.
+	:param page_count: the amount of pages of the corpus.
+	:param seed: the seed of the corpus and queries.
+	:param query_count: the amount of queries of each length.
+	:param k: the amount of results of the ranked searches.
+	:param batch_size: the amount of pages indexed together.
+	:param vocabulary_size: the amount of distinct words of the corpus.
+	:param segments: whether to serve the searches from segments rather than the database.
+	:param directory: the directory to create the temporary directory of the index in, or None for the default.
+	:param metrics: whether to record and report the durations of the stages of the indexer, at a small cost.
+	:return: the results as a dictionary.
+	"""
+	directory = tempfile.mkdtemp(dir=directory)
+	database = os.path.join(directory, "index.db")
+	documents = os.path.join(directory, "documents")
+	segment_directory = os.path.join(directory, "segments") if segments else None
+	try:
+		migrate(configure("sqlite:///" + database), documents)
+		indexer = Indexer(query_cache_size=0, document_directory=documents, segment_directory=segment_directory,
+		                  metrics=metrics)
+		corpus = CorpusGenerator(page_count, vocabulary_size=vocabulary_size, seed=seed)
+		indexing = measure_indexing(indexer, corpus, batch_size)
+		page_rank = {"seconds": timed(indexer.update_page_rank, True)}
+		queries = measure_queries(indexer, corpus, query_count, k, seed)
+		stages = indexer.metrics_statistics()
+		indexer.close()
+		cleanup()
+		disk = {"database_bytes": directory_size(database), "documents_bytes": directory_size(documents)}
+		if segment_directory is not None:
+			disk["segments_bytes"] = directory_size(segment_directory)
+		disk["total_bytes"] = sum(disk.values())
+	finally:
+		shutil.rmtree(directory)
+	result = {"parameters": {"pages": page_count, "seed": seed, "queries": query_count, "k": k,
+	                         "batch_size": batch_size, "vocabulary_size": vocabulary_size, "segments": segments},
+	          "environment": {"python": platform.python_version(), "platform": platform.platform(),
+	                          "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z")},
+	          "indexing": indexing, "page_rank": page_rank, "queries": queries, "disk": disk}
+	if metrics:
+		result["stages"] = stages
+	return result
+
+
+def page_count_argument(value):
+	"""
+	parses a corpus size given as an amount of pages or the name of one of the usual sizes.
+	:param value: the argument.
+	:return: the amount of pages.
+	"""
+	if value in SIZES:
+		return SIZES[value]
+	return int(value)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description = "Benchmarks indexing and searching a synthetic corpus.")
+	parser.add_argument("pages", type = page_count_argument, nargs = "?", default = SIZES["small"],
+	                    help = "the amount of pages, or one of " + ", ".join(SIZES))
+	parser.add_argument("--seed", type = int, default = 0, help = "the seed of the corpus and the queries")
+	parser.add_argument("--queries", type = int, default = 200, help = "the amount of queries of each length")
+	parser.add_argument("--k", type = int, default = 10, help = "the amount of results of the ranked searches")
+	parser.add_argument("--batch-size", type = int, default = 100, help = "the amount of pages indexed together")
+	parser.add_argument("--vocabulary", type = int, default = 50000, help = "the amount of distinct words")
+	parser.add_argument("--segments", action = "store_true", help = "search the segments rather than the database")
+	parser.add_argument("--metrics", action = "store_true", help = "report the durations of the stages of the indexer")
+	parser.add_argument("--directory", help = "the directory to create the temporary index in")
+	parser.add_argument("--output", help = "the json file to write the results to, standard output if not given")
+	arguments = parser.parse_args()
+	result = run(arguments.pages, seed = arguments.seed, query_count = arguments.queries, k = arguments.k,
+	             batch_size = arguments.batch_size, vocabulary_size = arguments.vocabulary,
+	             segments = arguments.segments, directory = arguments.directory, metrics = arguments.metrics)
+	if arguments.output is None:
+		json.dump(result, sys.stdout, indent = 2)
+		print()
+	else:
+		with open(arguments.output, "w") as output:
+			json.dump(result, output, indent = 2)
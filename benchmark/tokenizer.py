@@ -0,0 +1,87 @@
+"""
+This module if ran compares the throughput of index.tokenizer with the split(" ") and per character punctuation
+stripping it replaced.
+"""
+
+import random
+import string
+import sys
+import timeit
+
+from index.tokenizer import tokenize
+
+
+def legacy_stripe_enclosing_punctuation(target):
+	"""
+	the punctuation stripping the analysis used before index.tokenizer, kept for comparison.
+	"""
+	if len(target) == 0:
+		return target
+	lower_bound, upper_bound = 0, len(target)
+	acceptable_characters = string.ascii_letters + string.digits
+	index = 0
+	while index < len(target):
+		if target[index] not in acceptable_characters:
+			lower_bound += 1
+			index += 1
+		else:
+			break
+	index = len(target) - 1
+	while index >= 0:
+		if target[index] not in acceptable_characters:
+			upper_bound -= 1
+			index -= 1
+		else:
+			break
+	if upper_bound <= lower_bound:
+		return target
+	return target[lower_bound:upper_bound]
+
+
+def legacy_tokenize(text):
+	"""
+	the tokenization the analysis used before index.tokenizer, kept for comparison.
+	"""
+	for position, word in enumerate(text.split(" ")):
+		yield legacy_stripe_enclosing_punctuation(word.rstrip()).lower(), position
+
+
+def sample_text(size, seed=0):
+	"""
+	generates text resembling crawled pages, with punctuation, urls, repeated spaces, tabs and newlines.
+	:param size: the approximate amount of characters.
+	:param seed: the seed of the random generator.
+	:return: the text.
+	"""
+	generator = random.Random(seed)
+	words = ["search", "engine", "page", "rank", "the", "of", "and", "Hypertextual", "(large-scale)", "web,", "it's",
+	         "index.", "https://www.example.com/page", "\"quoted\"", "--", "café", "2019"]
+	separators = [" "] * 12 + ["  ", "\t", "\n", " - "]
+	parts = []
+	length = 0
+	while length < size:
+		part = generator.choice(words) + generator.choice(separators)
+		parts.append(part)
+		length += len(part)
+	return "".join(parts)
+
+
+def measure(function, text, repeat=5):
+	"""
+	measures the throughput of a tokenizer.
+	:param function: the tokenizer, a function returning an iterable of (word, position) tuples.
+	:param text: the text to tokenize.
+	:param repeat: the amount of runs, of which the fastest counts.
+	:return: a tuple of the megabytes of text per second and the amount of empty words produced.
+	"""
+	seconds = min(timeit.repeat(lambda: sum(1 for _ in function(text)), number=1, repeat=repeat))
+	empty = sum(1 for word, _ in function(text) if len(word.strip()) == 0)
+	return len(text.encode("utf8")) / seconds / 1e6, empty
+
+
+if __name__ == "__main__":
+	size = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+	text = sample_text(size)
+	for name, function in (("split + strip", legacy_tokenize), ("index.tokenizer", tokenize)):
+		throughput, empty = measure(function, text)
+		print("{0:>16}: {1:7.2f} MB/s, {2} empty words".format(name, throughput, empty))
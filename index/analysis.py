@@ -0,0 +1,145 @@
+import collections
+import multiprocessing
+import os
+import unittest
+
+from index.entry import Hit
+from index.tokenizer import strip_punctuation
+from index.tokenizer import tokenize
+
+
+def normalize_word(word):
+	"""
+	normalizes a word to the form it is stored in the WordDictionary.
+	:param word: the word to normalize.
+	:return: the lower case word without trailing whitespace and enclosing punctuations.
+	"""
+
+	return strip_punctuation(word.rstrip()).lower()
+
+
+def document_sections(data):
+	"""
+	extracts the text of a PageDocument that is analyzed into a plain tuple, which is cheap to send to another process.
+	:param data: the PageDocument.
+	:return: a tuple of the title, the header texts, the text sections, the anchor texts and the url.
+	"""
+	return (data.title, [header.text for header in data.headers], [text.text for text in data.texts],
+	        [anchor.text for anchor in data.anchors], data.url)
+
+
+def analyze_sections(sections):
+	"""
+	splits the sections of a page into normalized words and records where each word occurs. This is pure CPU work
+	without any database access, so it can run in a worker process. The hits are plain (kind, ordinal, position)
+	tuples, where ordinal is the index of the section among the sections of its kind, which is cheaper to send back
+	than Hit objects.
+	:param sections: the tuple returned by document_sections.
+	:return: a dictionary mapping each normalized word to its list of hit tuples.
+	"""
+	title, headers, texts, anchors, url = sections
+	result = {}
+	kinds = ((Hit.TITLE_HIT, [title]), (Hit.HEADER_HIT, headers), (Hit.TEXT_HIT, texts),
+	         (Hit.ANCHOR_HIT, anchors), (Hit.URL_HIT, [url]))
+	for kind, section_texts in kinds:
+		for ordinal, section in enumerate(section_texts):
+			for word, position in tokenize(section):
+				hits = result.get(word)
+				if hits is None:
+					hits = result[word] = []
+				hits.append((kind, ordinal, position))
+	return result
+
+
+def resolve_sections(word_hits):
+	"""
+	converts the hit tuples of analyze_sections to hit lists of Hit.
+	:param word_hits: the dictionary returned by analyze_sections.
+	:return: a dictionary mapping each normalized word to its hit list.
+	"""
+	return {word: [Hit(kind, ordinal, position) for kind, ordinal, position in hits] for word, hits in
+	        word_hits.items()}
+
+
+class ParallelIndexer:
+	"""
+	Indexes pages with the text analysis spread over a pool of worker processes and a single writer, the calling
+	process, that resolves word ids and writes to the database through an Indexer. Up to max_pending batches are
+	analyzed ahead of the batch being written, so analysis keeps all cores busy while the writer persists.
+	"""
+
+	def __init__(self, indexer, processes=None, batch_size=100, max_pending=None):
+		"""
+		creates a new ParallelIndexer.
+		:param indexer: the Indexer that writes the analyzed pages.
+		:param processes: the amount of worker processes, or None for one per core.
+		:param batch_size: the amount of pages written in one transaction.
+		:param max_pending: the maximum amount of batches analyzed ahead of the writer, or None for twice the amount of
+		worker processes.
+		"""
+		processes = processes or os.cpu_count() or 1
+		self._indexer = indexer
+		self._pool = multiprocessing.Pool(processes)
+		self._batch_size = batch_size
+		self._max_pending = max_pending if max_pending is not None else 2 * processes
+
+	def index(self, pages):
+		"""
+		analyzes and indexes pages. The pages are written in the order they are given.
+		:param pages: an iterable of PageDocument.
+		:return: the amount of pages indexed.
+		"""
+		pending = collections.deque()
+		indexed = 0
+		batch = []
+		for data in pages:
+			batch.append(data)
+			if len(batch) == self._batch_size:
+				pending.append(self._submit(batch))
+				batch = []
+				if len(pending) > self._max_pending:
+					indexed += self._write(*pending.popleft())
+		if len(batch) != 0:
+			pending.append(self._submit(batch))
+		while len(pending) != 0:
+			indexed += self._write(*pending.popleft())
+		return indexed
+
+	def close(self):
+		"""
+		stops the worker processes. The Indexer is not closed.
+		:return: None.
+		"""
+		self._pool.close()
+		self._pool.join()
+
+	def _submit(self, batch):
+		"""
+		hands a batch of pages to the worker processes.
+		:param batch: the list of PageDocument.
+		:return: a tuple of the batch and the pending analysis result.
+		"""
+		return batch, self._pool.map_async(analyze_sections, [document_sections(data) for data in batch])
+
+	def _write(self, batch, analysis):
+		"""
+		waits for the analysis of a batch and writes it.
+		:param batch: the list of PageDocument.
+		:param analysis: the pending analysis result of the batch.
+		:return: the amount of pages indexed.
+		"""
+		return self._indexer.index_many(batch, analysis.get())
+
+
+class TestAnalysis(unittest.TestCase):
+
+	def test_normalize_word(self):
+		self.assertEqual("word", normalize_word("(Word). "))
+		self.assertEqual("...", normalize_word("..."))
+
+	def test_analyze_sections(self):
+		word_hits = analyze_sections(("A title", ["Go to page"], ["Page one, page two"], ["page"], "url"))
+		self.assertEqual([(Hit.TITLE_HIT, 0, 0)], word_hits["a"])
+		self.assertEqual([(Hit.HEADER_HIT, 0, 2), (Hit.TEXT_HIT, 0, 0), (Hit.TEXT_HIT, 0, 2), (Hit.ANCHOR_HIT, 0, 0)],
+		                 word_hits["page"])
+		self.assertEqual([(Hit.URL_HIT, 0, 0)], word_hits["url"])
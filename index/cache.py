@@ -0,0 +1,96 @@
+import time
+import unittest
+from collections import OrderedDict
+
+
+class LRUCache:
+	"""
+	A bounded mapping that evicts the least recently used key once it holds more than maxsize entries. Entries may
+	also expire a fixed amount of time after they were cached. The hits and misses of get are counted.
+	"""
+
+	def __init__(self, maxsize=100000, ttl=None):
+		"""
+		creates a new LRUCache.
+		:param maxsize: the maximum number of entries to keep. A maxsize of 0 disables caching.
+		:param ttl: the amount of seconds an entry is kept after it was cached, or None to keep entries until evicted.
+		"""
+		self._maxsize = maxsize
+		self._ttl = ttl
+		self._entries = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key, default=None):
+		"""
+		gets the value cached under a key and marks it as recently used.
+		:param key: the key to look up.
+		:param default: the value to return if the key is not cached.
+		:return: the cached value or default.
+		"""
+		try:
+			value, expiry = self._entries[key]
+		except KeyError:
+			self.misses += 1
+			return default
+		if expiry is not None and expiry <= time.monotonic():
+			del self._entries[key]
+			self.misses += 1
+			return default
+		self._entries.move_to_end(key)
+		self.hits += 1
+		return value
+
+	def put(self, key, value):
+		"""
+		caches a value under a key, evicting the least recently used entries if the cache is full.
+		:param key: the key to cache under.
+		:param value: the value to cache.
+		:return: None.
+		"""
+		if self._maxsize <= 0:
+			return
+		expiry = time.monotonic() + self._ttl if self._ttl is not None else None
+		self._entries[key] = (value, expiry)
+		self._entries.move_to_end(key)
+		while len(self._entries) > self._maxsize:
+			self._entries.popitem(last=False)
+
+	def clear(self):
+		"""
+		removes all entries from the cache.
+		:return: None.
+		"""
+		self._entries.clear()
+
+	def __contains__(self, key):
+		return key in self._entries
+
+	def __len__(self):
+		return len(self._entries)
+
+
+class TestLRUCache(unittest.TestCase):
+
+	def test_eviction(self):
+		cache = LRUCache(maxsize=2)
+		cache.put("a", 1)
+		cache.put("b", 2)
+		self.assertEqual(1, cache.get("a"), "LRUCache failed basic retrieval")
+		cache.put("c", 3)
+		self.assertNotIn("b", cache, "LRUCache did not evict the least recently used entry")
+		self.assertIn("a", cache, "LRUCache evicted a recently used entry")
+		self.assertEqual(2, len(cache), "LRUCache exceeded its bound")
+
+	def test_ttl(self):
+		cache = LRUCache(maxsize=2, ttl=0.05)
+		cache.put("a", 1)
+		self.assertEqual(1, cache.get("a"), "LRUCache expired an entry too early")
+		time.sleep(0.06)
+		self.assertIsNone(cache.get("a"), "LRUCache did not expire an entry")
+		self.assertEqual((1, 1), (cache.hits, cache.misses), "LRUCache miscounted hits and misses")
+
+	def test_disabled(self):
+		cache = LRUCache(maxsize=0)
+		cache.put("a", 1)
+		self.assertIsNone(cache.get("a"), "LRUCache with maxsize 0 should not cache")
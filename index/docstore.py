@@ -0,0 +1,510 @@
+import json
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+from collections.abc import Sequence
+
+from index.cache import LRUCache
+from index.entry import Anchor
+from index.entry import Header
+from index.entry import Hit
+from index.entry import PageDocument
+from index.entry import TextSection
+from index.posting import decode_varint
+from index.posting import encode_varint
+
+CURRENT_NAME = "CURRENT"
+DATA_SUFFIX = ".dat"
+INDEX_SUFFIX = ".idx"
+# the names of the record streams of a store, the raw content of the pages and the texts of their sections
+DOCUMENT_STREAM = "documents"
+SECTION_STREAM = "sections"
+# the compressed length of a block
+BLOCK = struct.Struct("<I")
+# page id, block offset, record offset within the uncompressed block, record length
+LOCATION = struct.Struct("<qQII")
+# the end offset of the text of a section within the texts of a section record
+SECTION_END = struct.Struct("<I")
+# the block offset of an index entry marking a deleted page
+DELETED = 2 ** 64 - 1
+# the hit kinds of the sections of a page, in the order of a section record
+SECTION_KINDS = (Hit.HEADER_HIT, Hit.TEXT_HIT, Hit.ANCHOR_HIT)
+
+
+def encode_sections(data):
+	"""
+	encodes the sections of a PageDocument into a section record of the DocumentStore. The record holds the varint
+	encoded amount of headers, texts and anchors, the end offset of the text of each section as a 32 bit integer, the
+	utf8 encoded texts and a json array of the header sizes and anchor urls, so that the text of a single section can be
+	read without decoding the others.
+	:param data: the PageDocument.
+	:return: the encoded bytes.
+	"""
+	kinds = [[header.text for header in data.headers], [text.text for text in data.texts],
+	         [anchor.text for anchor in data.anchors]]
+	buffer = bytearray()
+	for texts in kinds:
+		encode_varint(len(texts), buffer)
+	encoded = [text.encode("utf8") for texts in kinds for text in texts]
+	end = 0
+	for text in encoded:
+		end += len(text)
+		buffer.extend(SECTION_END.pack(end))
+	for text in encoded:
+		buffer.extend(text)
+	attributes = [[header.size for header in data.headers], [anchor.url for anchor in data.anchors]]
+	buffer.extend(json.dumps(attributes, separators=(",", ":")).encode("utf8"))
+	return bytes(buffer)
+
+
+def decode_sections(record):
+	"""
+	decodes a section record encoded by encode_sections, without decoding any section text yet.
+	:param record: the encoded bytes.
+	:return: a SectionRecord, mapping the hit kinds of the sections to the list of texts of that kind on the page.
+	"""
+	return SectionRecord(record)
+
+
+def decode_document(content, sections, document):
+	"""
+	sets the raw content and the sections of a PageDocument from its records. A missing record leaves the content or
+	the sections empty.
+	:param content: the document record, the raw content, or None.
+	:param sections: the section record encoded by encode_sections, or None.
+	:param document: the PageDocument to set the content and sections of.
+	:return: the PageDocument.
+	"""
+	document.content = b"" if content is None else bytes(content)
+	if sections is None:
+		document.headers, document.texts, document.anchors = [], [], []
+		return document
+	record = SectionRecord(sections)
+	sizes, urls = record.attributes()
+	document.headers = [Header(size, text) for size, text in zip(sizes, record[Hit.HEADER_HIT])]
+	document.texts = [TextSection(text) for text in record[Hit.TEXT_HIT]]
+	document.anchors = [Anchor(text, url) for text, url in zip(record[Hit.ANCHOR_HIT], urls)]
+	return document
+
+
+class SectionRecord:
+	"""
+	A read only view of a section record, mapping each hit kind of SECTION_KINDS to the sequence of section texts of
+	that kind. A text is only decoded when it is read.
+	"""
+
+	def __init__(self, record):
+		"""
+		creates a new SectionRecord.
+		:param record: the bytes encoded by encode_sections.
+		"""
+		self._record = record
+		self._kinds = {}
+		offset, first = 0, 0
+		for kind in SECTION_KINDS:
+			count, offset = decode_varint(record, offset)
+			self._kinds[kind] = SectionTexts(self, first, count)
+			first += count
+		self._ends_offset = offset
+		self._texts_offset = offset + first * SECTION_END.size
+		self._count = first
+
+	def get(self, kind, default=None):
+		return self._kinds.get(kind, default)
+
+	def __getitem__(self, kind):
+		return self._kinds[kind]
+
+	def __contains__(self, kind):
+		return kind in self._kinds
+
+	def text(self, index):
+		"""
+		decodes the text of a section.
+		:param index: the index of the section among all sections of the record.
+		:return: the text.
+		"""
+		start = 0 if index == 0 else self._end(index - 1)
+		return bytes(self._record[self._texts_offset + start:self._texts_offset + self._end(index)]).decode("utf8")
+
+	def attributes(self):
+		"""
+		decodes the attributes of the sections besides their texts.
+		:return: a tuple of the list of header sizes and the list of anchor urls.
+		"""
+		start = self._texts_offset + (self._end(self._count - 1) if self._count != 0 else 0)
+		sizes, urls = json.loads(bytes(self._record[start:]).decode("utf8"))
+		return sizes, urls
+
+	def _end(self, index):
+		return SECTION_END.unpack_from(self._record, self._ends_offset + index * SECTION_END.size)[0]
+
+
+class SectionTexts(Sequence):
+	"""
+	The texts of the sections of one kind in a SectionRecord, decoded when read.
+	"""
+
+	def __init__(self, record, first, count):
+		self._record = record
+		self._first = first
+		self._count = count
+
+	def __len__(self):
+		return self._count
+
+	def __getitem__(self, ordinal):
+		if isinstance(ordinal, slice):
+			return [self[index] for index in range(*ordinal.indices(self._count))]
+		if ordinal < 0:
+			ordinal += self._count
+		if not 0 <= ordinal < self._count:
+			raise IndexError(ordinal)
+		return self._record.text(self._first + ordinal)
+
+
+class RecordStream:
+	"""
+	One kind of record of a DocumentStore generation, kept in a data file of compressed blocks and an index file of
+	fixed size entries mapping each page id to its block and its place within the uncompressed block. The index is
+	loaded into memory on open, and the most recently read blocks are cached.
+	"""
+
+	def __init__(self, path, block_size, compression_level, block_cache_size):
+		"""
+		opens or creates a RecordStream.
+		:param path: the path of the files of the stream, without suffix.
+		:param block_size: the amount of uncompressed bytes collected before a block is written.
+		:param compression_level: the zlib compression level of the blocks.
+		:param block_cache_size: the maximum number of decompressed blocks to cache.
+		"""
+		self.path = path
+		self._block_size = block_size
+		self._compression_level = compression_level
+		self._blocks = LRUCache(block_cache_size)
+		self.locations = {}
+		self.dead = 0
+		self._pending = bytearray()
+		self._pending_locations = {}
+		self._read_index()
+		self._data_file = open(path + DATA_SUFFIX, "a+b")
+		self._index_file = open(path + INDEX_SUFFIX, "ab")
+
+	def put(self, page_id, record):
+		if page_id in self:
+			self.dead += 1
+		self._pending_locations[page_id] = (len(self._pending), len(record))
+		self._pending.extend(record)
+		if len(self._pending) >= self._block_size:
+			self.flush()
+
+	def get(self, page_id):
+		location = self._pending_locations.get(page_id)
+		if location is not None:
+			return bytes(self._pending[location[0]:location[0] + location[1]])
+		location = self.locations.get(page_id)
+		if location is None:
+			return None
+		block_offset, record_offset, length = location
+		return self._read_block(block_offset)[record_offset:record_offset + length]
+
+	def delete(self, page_ids):
+		self.flush()
+		entries = bytearray()
+		for page_id in page_ids:
+			if self.locations.pop(page_id, None) is not None:
+				self.dead += 1
+				entries.extend(LOCATION.pack(page_id, DELETED, 0, 0))
+		self._append_index(entries)
+
+	def flush(self):
+		if len(self._pending_locations) == 0:
+			return
+		compressed = zlib.compress(bytes(self._pending), self._compression_level)
+		self._data_file.seek(0, os.SEEK_END)
+		block_offset = self._data_file.tell()
+		self._data_file.write(BLOCK.pack(len(compressed)))
+		self._data_file.write(compressed)
+		self._data_file.flush()
+		os.fsync(self._data_file.fileno())
+		entries = bytearray()
+		for page_id, (record_offset, length) in self._pending_locations.items():
+			entries.extend(LOCATION.pack(page_id, block_offset, record_offset, length))
+			self.locations[page_id] = (block_offset, record_offset, length)
+		self._append_index(entries)
+		self._pending = bytearray()
+		self._pending_locations = {}
+
+	def records(self):
+		"""
+		reads the flushed records in the order of the data file, decompressing each block once.
+		:return: a generator of (page_id, record) tuples.
+		"""
+		block_offset, block = None, None
+		for page_id, (offset, record_offset, length) in sorted(self.locations.items(), key=lambda item: item[1]):
+			if offset != block_offset:
+				block_offset, block = offset, self._decompress_block(self._data_file, offset)
+			yield page_id, block[record_offset:record_offset + length]
+
+	def close(self):
+		self.flush()
+		self._data_file.close()
+		self._index_file.close()
+
+	def remove(self):
+		"""
+		closes the stream and removes its files.
+		:return: None.
+		"""
+		self.close()
+		for suffix in (DATA_SUFFIX, INDEX_SUFFIX):
+			os.remove(self.path + suffix)
+
+	def __contains__(self, page_id):
+		return page_id in self._pending_locations or page_id in self.locations
+
+	def __len__(self):
+		return len(self.locations) + len([page_id for page_id in self._pending_locations if
+		                                  page_id not in self.locations])
+
+	def _read_block(self, block_offset):
+		block = self._blocks.get(block_offset)
+		if block is None:
+			block = self._decompress_block(self._data_file, block_offset)
+			self._blocks.put(block_offset, block)
+		return block
+
+	@staticmethod
+	def _decompress_block(data_file, block_offset):
+		data_file.seek(block_offset)
+		length = BLOCK.unpack(data_file.read(BLOCK.size))[0]
+		return zlib.decompress(data_file.read(length))
+
+	def _append_index(self, entries):
+		if len(entries) == 0:
+			return
+		self._index_file.write(entries)
+		self._index_file.flush()
+		os.fsync(self._index_file.fileno())
+
+	def _read_index(self):
+		path = self.path + INDEX_SUFFIX
+		if not os.path.isfile(path):
+			return
+		with open(path, "rb") as index_file:
+			data = index_file.read()
+		# an entry cut short by a crash while appending is ignored
+		for offset in range(0, len(data) - len(data) % LOCATION.size, LOCATION.size):
+			page_id, block_offset, record_offset, length = LOCATION.unpack_from(data, offset)
+			if page_id in self.locations:
+				self.dead += 1
+			if block_offset == DELETED:
+				self.locations.pop(page_id, None)
+			else:
+				self.locations[page_id] = (block_offset, record_offset, length)
+
+
+class DocumentStore:
+	"""
+	An append only store of the raw content and the section texts of pages, kept apart from the index database so that
+	the page bodies never take up room in its page cache. The content and the sections are separate records in
+	separate RecordStreams, so building snippets never decompresses or copies the content of a page. Records are
+	collected into blocks of about block_size bytes, and each block is compressed with zlib and appended to the data
+	file of its stream. Records replaced or deleted stay in the data files until compact rewrites the store, under a new
+	generation of files named in the CURRENT file. The store is not thread safe.
+	"""
+
+	def __init__(self, directory, block_size=64 * 1024, compression_level=6, block_cache_size=64):
+		"""
+		opens or creates a DocumentStore.
+		:param directory: the directory holding the files of the store.
+		:param block_size: the amount of uncompressed bytes collected before a block is written.
+		:param compression_level: the zlib compression level of the blocks.
+		:param block_cache_size: the maximum number of decompressed blocks to cache per stream.
+		"""
+		os.makedirs(directory, exist_ok=True)
+		self._directory = directory
+		self._block_size = block_size
+		self._compression_level = compression_level
+		self._block_cache_size = block_cache_size
+		self._generation = self._read_current()
+		self._documents = self._open_stream(DOCUMENT_STREAM)
+		self._sections = self._open_stream(SECTION_STREAM)
+
+	def put(self, page_id, content, sections):
+		"""
+		adds the records of a page, replacing any earlier records of the page. The records can be read right away, but
+		are only written once their block is full or the store is flushed.
+		:param page_id: the page id.
+		:param content: the raw content of the page.
+		:param sections: the section record of the page, see encode_sections.
+		:return: None.
+		"""
+		self._documents.put(page_id, content)
+		self._sections.put(page_id, sections)
+
+	def get(self, page_id):
+		"""
+		reads the raw content of a page.
+		:param page_id: the page id.
+		:return: the bytes of the content, or None if the store holds no record of the page.
+		"""
+		return self._documents.get(page_id)
+
+	def get_sections(self, page_id):
+		"""
+		reads the section record of a page, without touching its content.
+		:param page_id: the page id.
+		:return: the bytes of the section record, or None if the store holds no record of the page.
+		"""
+		return self._sections.get(page_id)
+
+	def delete(self, page_ids):
+		"""
+		deletes the records of pages.
+		:param page_ids: the page ids.
+		:return: None.
+		"""
+		page_ids = list(page_ids)
+		self._documents.delete(page_ids)
+		self._sections.delete(page_ids)
+
+	def flush(self):
+		"""
+		compresses the pending records into blocks and appends them to the data files, followed by their index entries.
+		:return: None.
+		"""
+		self._documents.flush()
+		self._sections.flush()
+
+	def garbage(self):
+		"""
+		gets the share of the records in the data files that were replaced or deleted.
+		:return: a number from 0 to 1.
+		"""
+		total = len(self) + self._documents.dead
+		return 0.0 if total == 0 else self._documents.dead / total
+
+	def compact(self):
+		"""
+		rewrites the records of all pages into a new generation of files without the replaced and deleted records, and
+		removes the files of the old generation. The new generation only becomes current once complete, so that a crash
+		leaves the old generation in place.
+		:return: None.
+		"""
+		self.flush()
+		documents, sections = self._documents, self._sections
+		self._generation += 1
+		self._documents = self._open_stream(DOCUMENT_STREAM, truncate=True)
+		self._sections = self._open_stream(SECTION_STREAM, truncate=True)
+		for page_id, content in documents.records():
+			self.put(page_id, content, sections.get(page_id))
+		self.flush()
+		self._write_current()
+		documents.remove()
+		sections.remove()
+
+	def close(self):
+		"""
+		flushes the pending records and closes the files of the store.
+		:return: None.
+		"""
+		self._documents.close()
+		self._sections.close()
+
+	def __contains__(self, page_id):
+		return page_id in self._documents
+
+	def __len__(self):
+		return len(self._documents)
+
+	def _open_stream(self, name, truncate=False):
+		path = os.path.join(self._directory, "{0}-{1:08d}".format(name, self._generation))
+		if truncate:
+			# files left by a rewrite that crashed before completing
+			for suffix in (DATA_SUFFIX, INDEX_SUFFIX):
+				if os.path.isfile(path + suffix):
+					os.remove(path + suffix)
+		return RecordStream(path, self._block_size, self._compression_level, self._block_cache_size)
+
+	def _read_current(self):
+		path = os.path.join(self._directory, CURRENT_NAME)
+		if os.path.isfile(path):
+			with open(path, "r") as current_file:
+				current = json.load(current_file)
+			return current["generation"]
+		self._generation = 0
+		self._write_current()
+		return self._generation
+
+	def _write_current(self):
+		path = os.path.join(self._directory, CURRENT_NAME)
+		with open(path + ".tmp", "w") as current_file:
+			json.dump({"generation": self._generation}, current_file)
+			current_file.flush()
+			os.fsync(current_file.fileno())
+		os.replace(path + ".tmp", path)
+
+
+class TestDocumentStore(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+
+	def test_encode_sections(self):
+		page = PageDocument(doc_id=1, title="Title", url="https://www.test.com", content=b"<html></html>",
+		                    headers=[Header(2, "Header")], texts=[TextSection("Some text"), TextSection("Grüße")],
+		                    anchors=[Anchor("Next", "https://www.next.com")])
+		decoded = decode_document(page.content, encode_sections(page), PageDocument())
+		self.assertEqual(b"<html></html>", decoded.content)
+		self.assertEqual([(2, "Header")], [(header.size, header.text) for header in decoded.headers])
+		self.assertEqual(["Some text", "Grüße"], [text.text for text in decoded.texts])
+		self.assertEqual([("Next", "https://www.next.com")], [(anchor.text, anchor.url) for anchor in decoded.anchors])
+		sections = decode_sections(encode_sections(page))
+		self.assertEqual("Grüße", sections[Hit.TEXT_HIT][1], "Failed to decode a single section")
+		self.assertEqual(["Header"], list(sections[Hit.HEADER_HIT]))
+		self.assertEqual(0, len(decode_sections(encode_sections(PageDocument())).get(Hit.TEXT_HIT)))
+		self.assertEqual([], decode_document(None, None, PageDocument()).texts, "Missing records were not tolerated")
+
+	def test_put_and_reopen(self):
+		store = DocumentStore(self.directory, block_size=16)
+		store.put(1, b"first record", b"first sections")
+		store.put(2, b"second record, flushing the block", b"second sections")
+		store.put(3, b"pending", b"pending sections")
+		self.assertEqual(b"first record", store.get(1), "Flushed record was not read back")
+		self.assertEqual(b"first sections", store.get_sections(1), "Flushed sections were not read back")
+		self.assertEqual(b"pending", store.get(3), "Pending record was not read back")
+		store.put(1, b"replaced", b"replaced sections")
+		store.delete([2])
+		store.close()
+		store = DocumentStore(self.directory)
+		self.assertEqual(b"replaced", store.get(1), "Replaced record survived reopening")
+		self.assertEqual(b"replaced sections", store.get_sections(1))
+		self.assertIsNone(store.get(2), "Deleted record survived reopening")
+		self.assertIsNone(store.get_sections(2), "Deleted sections survived reopening")
+		self.assertEqual(b"pending", store.get(3), "Pending record was not flushed on close")
+		self.assertEqual(2, len(store))
+		self.assertAlmostEqual(0.5, store.garbage())
+		store.close()
+
+	def test_compact(self):
+		store = DocumentStore(self.directory, block_size=8)
+		for page_id in range(10):
+			store.put(page_id, str(page_id).encode("utf8") * 4, str(page_id).encode("utf8"))
+		store.delete(range(5))
+		store.compact()
+		self.assertEqual(0.0, store.garbage(), "Compaction kept garbage")
+		self.assertEqual([b"5555", b"9999"], [store.get(5), store.get(9)], "Compaction lost records")
+		self.assertEqual(b"7", store.get_sections(7), "Compaction lost sections")
+		store.close()
+		store = DocumentStore(self.directory)
+		self.assertEqual(5, len(store), "Compacted store did not reopen")
+		self.assertIsNone(store.get(0))
+		store.close()
+		self.assertEqual(5, len(os.listdir(self.directory)), "Old generation was not removed")
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
@@ -1,9 +1,10 @@
+import hashlib
 import json
 import os.path
 
 import sqlalchemy as sa
+from sqlalchemy import orm
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
 
 
 def dump_dictionary(dictionary, text_file):
@@ -38,17 +39,15 @@ Base = declarative_base()
 
 class PageDocument(Base):
 	"""
-	A data class representing the information crawled from a web page.
+	A data class representing the information crawled from a web page. Only the title, url and checksum are stored in
+	the index database. The raw content and the sections are kept in the index.docstore.DocumentStore, and are empty on
+	documents loaded from the database until they are read from the store.
 	"""
 	__tablename__ = "Document"
 	doc_id = sa.Column("id", sa.BigInteger().with_variant(sa.Integer, "sqlite"), primary_key=True)
 	title = sa.Column("title", sa.String(500), nullable=False)
 	url = sa.Column("url", sa.String(500), nullable=False)
-	content = sa.Column("content", sa.Binary(2000000), nullable=False)
 	checksum = sa.Column("checksum", sa.Binary(128), nullable=False)
-	anchors = relationship("Anchor")
-	headers = relationship("Header")
-	texts = relationship("TextSection")
 
 	def __init__(self, doc_id=0, title="", checksum=b"", url="", content=b"", anchors=(), texts=(),
 	             headers=()):
@@ -69,25 +68,26 @@ class PageDocument(Base):
 		self.checksum = checksum
 		self.url = url
 		self.content = content
-		self.anchors.extend(anchors)
-		self.texts.extend(texts)
-		self.headers.extend(headers)
+		self.anchors = list(anchors)
+		self.texts = list(texts)
+		self.headers = list(headers)
+
+	@orm.reconstructor
+	def _init_body(self):
+		self.content = b""
+		self.anchors = []
+		self.texts = []
+		self.headers = []
 
 	def __repr__(self) -> str:
 		return str(self.__dict__)
 
 
-class Anchor(Base):
+class Anchor:
 	"""
 	A data class representing the anchor on a webpage.
 	"""
 
-	__tablename__ = "Anchor"
-	doc_id = sa.Column("doc_id", sa.BigInteger().with_variant(sa.Integer, "sqlite"), sa.ForeignKey("Document.id"))
-	text = sa.Column("text", sa.String(500), nullable=False)
-	url = sa.Column("url", sa.String(500), nullable=False)
-	id = sa.Column("id", sa.BigInteger().with_variant(sa.Integer, "sqlite"), primary_key=True)
-
 	def __init__(self, text, url):
 		self.text = text
 		self.url = url
@@ -96,12 +96,7 @@ class Anchor(Base):
 		return str(self.__dict__)
 
 
-class Header(Base):
-	__tablename__ = "Header"
-	doc_id = sa.Column("doc_id", sa.BigInteger().with_variant(sa.Integer, "sqlite"), sa.ForeignKey("Document.id"))
-	text = sa.Column("text", sa.String(500), nullable=False)
-	size = sa.Column("size", sa.Integer, nullable=False)
-	id = sa.Column("id", sa.BigInteger().with_variant(sa.Integer, "sqlite"), primary_key=True)
+class Header:
 
 	def __init__(self, size=1, text=""):
 		self.text = text
@@ -111,21 +106,21 @@ class Header(Base):
 		return str(self.__dict__)
 
 
-class TextSection(Base):
-	__tablename__ = "TextSection"
-	doc_id = sa.Column("doc_id", sa.BigInteger().with_variant(sa.Integer, "sqlite"), sa.ForeignKey("Document.id"))
-	text = sa.Column("text", sa.String(5000), nullable=False)
-	id = sa.Column("id", sa.BigInteger().with_variant(sa.Integer, "sqlite"), primary_key=True)
+class TextSection:
 
 	def __init__(self, text):
 		self.text = text
 
+	def __repr__(self):
+		return str(self.__dict__)
+
 
-class Hit(Base):
+class Hit:
 	"""
 	A class representing a hit in the index. As of now, the types of hit includes: text(1), anchor(2), title(3), header(4),
-	url(5), reference(6). The hit contains the section of the page that the hit occurred on, as well as the position
-	within the section.
+	url(5), reference(6). The hit contains the section of the page that the hit occurred on, the index of the section
+	among the sections of its kind on the page, as well as the position within the section. The title and the url are
+	section 0. Hits are not stored individually, but as the encoded hit list of a Posting.
 	"""
 
 	TEXT_HIT = 1
@@ -135,11 +130,7 @@ class Hit(Base):
 	URL_HIT = 5
 	REFERENCE_HIT = 6
 
-	__tablename__ = "Hit"
-	id = sa.Column("id", sa.BigInteger().with_variant(sa.Integer, "sqlite"), primary_key=True)
-	kind = sa.Column("kind", sa.SmallInteger)
-	section = sa.Column("section", sa.Integer)
-	position = sa.Column("position", sa.Integer)
+	__slots__ = ("kind", "section", "position")
 
 	def __init__(self, kind, section, position):
 		self.kind = kind
@@ -165,48 +156,37 @@ class Hit(Base):
 		return str({"kind": self.kind, "section": self.section, "position": self.position})
 
 
-class WordHitMapper(Base):
-	__tablename__ = "WordHitMapper"
-	entry_id = sa.Column("id", sa.BigInteger().with_variant(sa.Integer, "sqlite"), primary_key=True)
-	word_id = sa.Column("word_id", sa.BigInteger)
-	hit_id = sa.Column("hit_id", sa.BigInteger)
-
-	def __init__(self, word_id, hit_id):
-		self.word_id = word_id
-		self.hit_id = hit_id
-
-	def __eq__(self, other: "WordHitMapper"):
-		try:
-			if not self.word_id == other.word_id:
-				return False
-			if not self.hit_id == other.hit_id:
-				return False
-		except AttributeError:
-			return False
-		return True
-
-	def __ne__(self, other):
-		return not self.__eq__(other)
-
-	def __repr__(self):
-		return str(self.__dict__)
-
+class Posting(Base):
+	"""
+	The hits of a word on a page. The whole hit list is stored in a single row, encoded by index.posting.encode_hits,
+	along with the text score of the word on the page calculated by index.ranking.hit_weight.
+	Postings are shared by the forward index, which looks them up by page, and the reverse index, which looks them up by
+	word.
+	"""
 
-class ForwardMapper(Base):
-	__tablename__ = "ForwardMapper"
-	entry_id = sa.Column("id", sa.BigInteger().with_variant(sa.Integer, "sqlite"), primary_key=True)
-	page_id = sa.Column("page_id", sa.BigInteger)
-	word_id = sa.Column("word_id", sa.BigInteger)
+	__tablename__ = "Posting"
+	__table_args__ = (sa.Index("ix_Posting_page_id", "page_id"),
+	                  sa.Index("ix_Posting_word_id_weight", "word_id", "weight"))
+	word_id = sa.Column("word_id", sa.BigInteger, primary_key=True, autoincrement=False)
+	page_id = sa.Column("page_id", sa.BigInteger, primary_key=True, autoincrement=False)
+	hit_count = sa.Column("hit_count", sa.Integer, nullable=False)
+	weight = sa.Column("weight", sa.Float, nullable=False)
+	hits = sa.Column("hits", sa.LargeBinary, nullable=False)
 
-	def __init__(self, page_id, word_id):
-		self.page_id = page_id
+	def __init__(self, word_id, page_id, hit_count=0, weight=0.0, hits=b""):
 		self.word_id = word_id
+		self.page_id = page_id
+		self.hit_count = hit_count
+		self.weight = weight
+		self.hits = hits
 
 	def __eq__(self, other):
 		try:
-			if not self.page_id == other.page_id:
+			if self.word_id != other.word_id:
+				return False
+			if self.page_id != other.page_id:
 				return False
-			if not self.word_id == other.word_id:
+			if self.hits != other.hits:
 				return False
 		except AttributeError:
 			return False
@@ -250,62 +230,6 @@ class ForwardIndexEntry:
 		return not self.__eq__(other)
 
 
-class PageHitMapper(Base):
-	__tablename__ = "PageHitMapper"
-	id = sa.Column("id", sa.BigInteger().with_variant(sa.Integer, "sqlite"), primary_key=True)
-	page_id = sa.Column("page_id", sa.BigInteger)
-	hit_id = sa.Column("hit_id", sa.BigInteger)
-
-	def __init__(self, page_id, hit_id):
-		self.page_id = page_id
-		self.hit_id = hit_id
-
-	def __eq__(self, o) -> bool:
-		try:
-			if self.id != o.id:
-				return False
-			if not self.page_id == o.page_id:
-				return False
-			if not self.hit_id == o.hit_id:
-				return False
-		except AttributeError:
-			return False
-		return True
-
-	def __ne__(self, o) -> bool:
-		return not self.__eq__(o)
-
-	def __repr__(self):
-		return str(self.__dict__)
-
-
-class LexiconMapper(Base):
-	__tablename__ = "LexiconMapper"
-	entry_id = sa.Column("id", sa.BigInteger().with_variant(sa.Integer, "sqlite"), primary_key=True)
-	word_id = sa.Column("word_id", sa.BigInteger)
-	page_hit_mapper_id = sa.Column("entry_id", sa.BigInteger)
-
-	def __init__(self, word_id, page_hit_mapper_id):
-		self.word_id = word_id
-		self.page_hit_mapper_id = page_hit_mapper_id
-
-	def __eq__(self, o) -> bool:
-		try:
-			if self.word_id != o.word_id:
-				return False
-			if not self.page_hit_mapper_id == o.page_hit_mapper_id:
-				return False
-		except AttributeError:
-			return False
-		return True
-
-	def __ne__(self, o) -> bool:
-		return not self.__eq__(o)
-
-	def __repr__(self):
-		return str(self.__dict__)
-
-
 class ReverseIndexEntry:
 
 	def __init__(self, word_id):
@@ -378,20 +302,50 @@ class PageLinks(Base):
 		return str(self.__dict__)
 
 
+class UrlDictionaryEntry(Base):
+	"""
+	A url interned to a compact integer id. Urls are looked up by a 64 bit hash, so that the index on it stays small no
+	matter how long the urls are.
+	"""
+
+	__tablename__ = "UrlDictionary"
+	__table_args__ = (sa.Index("ix_UrlDictionary_url_hash", "url_hash"),)
+	url_id = sa.Column("url_id", sa.BigInteger().with_variant(sa.Integer, "sqlite"), primary_key=True,
+	                   autoincrement=True)
+	url_hash = sa.Column("url_hash", sa.BigInteger, nullable=False)
+	url = sa.Column("url", sa.String(500), nullable=False)
+
+	def __init__(self, url):
+		self.url = url
+		self.url_hash = url_hash(url)
+
+	def __repr__(self):
+		return str(self.__dict__)
+
+
+def url_hash(url):
+	"""
+	hashes a url to a signed 64 bit integer, stable across processes.
+	:param url: the url to hash.
+	:return: the hash.
+	"""
+	return int.from_bytes(hashlib.blake2b(url.encode("utf8"), digest_size=8).digest(), "little", signed=True)
+
+
 class PageUrlMapper(Base):
 	__tablename__ = "PageUrlMapper"
 	id = sa.Column("page_id", sa.BigInteger, primary_key=True, autoincrement=False)
-	url = sa.Column("url", sa.String(500), unique=True)
+	url_id = sa.Column("url_id", sa.BigInteger, unique=True, nullable=False)
 
-	def __init__(self, id=-1, url=""):
+	def __init__(self, id=-1, url_id=-1):
 		self.id = id
-		self.url = url
+		self.url_id = url_id
 
 	def __eq__(self, other):
 		try:
 			if self.id != other.id:
 				return False
-			if self.url != other.url:
+			if self.url_id != other.url_id:
 				return False
 		except AttributeError:
 			return False
@@ -406,19 +360,22 @@ class PageUrlMapper(Base):
 
 class ReferenceTracker(Base):
 	__tablename__ = "ReferenceTracker"
+	# the url index covers the page id, so the pages linking to a url are found without reading the table
+	__table_args__ = (sa.Index("ix_ReferenceTracker_url_id_page_id", "url_id", "page_id"),
+	                  sa.Index("ix_ReferenceTracker_page_id", "page_id"))
 	id = sa.Column("id", sa.BigInteger().with_variant(sa.Integer, "sqlite"), primary_key=True)
 	page_id = sa.Column("page_id", sa.BigInteger)
-	url = sa.Column("url", sa.String(500))
+	url_id = sa.Column("url_id", sa.BigInteger)
 
-	def __init__(self, page_id=-1, url=""):
+	def __init__(self, page_id=-1, url_id=-1):
 		self.page_id = page_id
-		self.url = url
+		self.url_id = url_id
 
 	def __eq__(self, other):
 		try:
 			if self.page_id != other.page_id:
 				return False
-			if self.url != other.url:
+			if self.url_id != other.url_id:
 				return False
 		except AttributeError:
 			return False
@@ -433,16 +390,16 @@ class ReferenceTracker(Base):
 
 class PageRankTracker(Base):
 	__tablename__ = "PageRank"
-	url = sa.Column("url", sa.String(500), primary_key=True)
+	page_id = sa.Column("page_id", sa.BigInteger, primary_key=True, autoincrement=False)
 	page_rank = sa.Column("page_rank", sa.Float)
 
-	def __init__(self, url="", page_rank=0):
-		self.url = url
+	def __init__(self, page_id=-1, page_rank=0):
+		self.page_id = page_id
 		self.page_rank = page_rank
 
 	def __eq__(self, other):
 		try:
-			if self.url != other.url:
+			if self.page_id != other.page_id:
 				return False
 			if self.page_rank != other.page_rank:
 				return False
@@ -455,3 +412,80 @@ class PageRankTracker(Base):
 
 	def __repr__(self):
 		return str(self.__dict__)
+
+
+class PageRankStatus(Base):
+	"""
+	A single row tracking the generation of the link graph, which is increased whenever pages are added, the
+	generation of the graph the persisted page ranks were calculated from, and the generation of the whole index, which
+	is increased whenever pages are added or the page ranks change so that cached search results can be invalidated.
+	"""
+
+	SINGLETON_ID = 1
+
+	__tablename__ = "PageRankStatus"
+	id = sa.Column("id", sa.Integer, primary_key=True, autoincrement=False)
+	graph_generation = sa.Column("graph_generation", sa.BigInteger, nullable=False)
+	rank_generation = sa.Column("rank_generation", sa.BigInteger, nullable=False)
+	updated = sa.Column("updated", sa.Float)
+	index_generation = sa.Column("index_generation", sa.BigInteger, nullable=False, default=0)
+
+	def __init__(self, graph_generation=0, rank_generation=0, updated=None, index_generation=0):
+		"""
+		creates a new PageRankStatus.
+		:param graph_generation: the current generation of the link graph.
+		:param rank_generation: the generation of the link graph the page ranks were calculated from.
+		:param updated: the unix time the page ranks were last calculated, or None if they never were.
+		:param index_generation: the current generation of the index.
+		"""
+		self.id = PageRankStatus.SINGLETON_ID
+		self.graph_generation = graph_generation
+		self.rank_generation = rank_generation
+		self.updated = updated
+		self.index_generation = index_generation
+
+	def __repr__(self):
+		return str(self.__dict__)
+
+
+class Tombstone(Base):
+	"""
+	Marks a deleted page. Searches and page rank leave out tombstoned pages right away, while the rows of the page are
+	only removed by a later compaction.
+	"""
+
+	__tablename__ = "Tombstone"
+	page_id = sa.Column("page_id", sa.BigInteger, primary_key=True, autoincrement=False)
+	deleted = sa.Column("deleted", sa.Float, nullable=False)
+
+	def __init__(self, page_id=-1, deleted=0.0):
+		"""
+		creates a new Tombstone.
+		:param page_id: the page id of the deleted page.
+		:param deleted: the unix time the page was deleted.
+		"""
+		self.page_id = page_id
+		self.deleted = deleted
+
+	def __repr__(self):
+		return str(self.__dict__)
+
+
+class SchemaVersion(Base):
+	"""
+	A single row holding the version of the database schema, the number of the last migration in index.migration
+	applied to it.
+	"""
+
+	SINGLETON_ID = 1
+
+	__tablename__ = "SchemaVersion"
+	id = sa.Column("id", sa.Integer, primary_key=True, autoincrement=False)
+	version = sa.Column("version", sa.Integer, nullable=False)
+
+	def __init__(self, version=0):
+		self.id = SchemaVersion.SINGLETON_ID
+		self.version = version
+
+	def __repr__(self):
+		return str(self.__dict__)
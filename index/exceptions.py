@@ -11,47 +11,69 @@ class IndexException(IndexerException):
 		self.url = url
 
 
-class PageRankPersistException(IndexerException):
+class BatchIndexException(IndexException):
 
-	def __init__(self):
-		IndexerException.__init__(self, "Failed to update page rank")
+	def __init__(self, urls):
+		IndexerException.__init__(self, "Failed to index " + ", ".join(urls))
+		self.url = urls[0] if len(urls) != 0 else ""
+		self.urls = urls
 
 
-class ForwardIndexException(IndexerException):
+class WordDictionaryPersistException(IndexerException):
 
-	def __init__(self, *args, **kwargs):
-		IndexerException.__init__(self, args, kwargs)
+	def __init__(self, words):
+		IndexerException.__init__(self, "Failed to add " + str(len(words)) + " words to the dictionary")
+		self.words = words
 
 
-class ReverseIndexException(IndexerException):
+class DeletePersistException(IndexerException):
 
-	def __init__(self, *args, **kwargs):
-		IndexerException.__init__(self, args, kwargs)
+	def __init__(self, page):
+		IndexerException.__init__(self, "Failed to delete " + str(page))
+		self.page = page
+
+
+class CompactionException(IndexerException):
 
+	def __init__(self, page_count):
+		IndexerException.__init__(self, "Failed to compact " + str(page_count) + " deleted pages")
+		self.page_count = page_count
 
-class HitListPersistException(ForwardIndexException):
 
-	def __init__(self, page_id):
-		ForwardIndexException.__init__(self, "Failed to persist hits for " + str(page_id))
-		self.page_id = page_id
+class MigrationException(IndexerException):
 
+	def __init__(self, reason):
+		IndexerException.__init__(self, "Failed to migrate the database: " + reason)
+		self.reason = reason
 
-class ForwardMappingPersistException(ForwardIndexException):
 
-	def __init__(self, page_id):
-		ForwardIndexException.__init__(self, "Failed to create forward mappings for " + str(page_id))
-		self.page_id = page_id
+class DocumentStoreException(IndexerException):
 
+	def __init__(self, reason):
+		IndexerException.__init__(self, "Document store unavailable: " + reason)
+		self.reason = reason
 
-class PageHitMappingPersistException(ReverseIndexException):
 
-	def __init__(self, word_id):
-		ReverseIndexException.__init__(self, "Failed to create page hit mappings for " + str(word_id))
-		self.word_id = word_id
+class PageRankPersistException(IndexerException):
+
+	def __init__(self):
+		IndexerException.__init__(self, "Failed to update page rank")
+
+
+class ForwardIndexException(IndexerException):
+
+	def __init__(self, *args, **kwargs):
+		IndexerException.__init__(self, args, kwargs)
+
+
+class ReverseIndexException(IndexerException):
+
+	def __init__(self, *args, **kwargs):
+		IndexerException.__init__(self, args, kwargs)
 
 
-class LexiconMappingPersistException(ReverseIndexException):
+class SegmentException(IndexerException):
 
-	def __init__(self, word_id):
-		ReverseIndexException.__init__(self, "Failed to create lexicon mappings for " + str(word_id))
-		self.word_id = word_id
+	def __init__(self, path):
+		IndexerException.__init__(self, "Invalid index segment " + str(path))
+		self.path = path
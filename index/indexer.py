@@ -1,44 +1,82 @@
-import string
+import os
+import shutil
+import tempfile
+import time
 import unittest
+from unittest import mock
 
+import sqlalchemy as sa
 from sqlalchemy import create_engine
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import StaticPool
 
+from index.analysis import ParallelIndexer
+from index.analysis import analyze_sections
+from index.analysis import document_sections
+from index.analysis import normalize_word
+from index.analysis import resolve_sections
+from index.cache import LRUCache
+from index.docstore import DocumentStore
+from index.docstore import decode_document
+from index.docstore import decode_sections
+from index.docstore import encode_sections
 from index.entry import Anchor
 from index.entry import Base
 from index.entry import ForwardIndexEntry
-from index.entry import ForwardMapper
 from index.entry import Header
 from index.entry import Hit
-from index.entry import LexiconMapper
 from index.entry import PageDocument
-from index.entry import PageHitMapper
 from index.entry import PageLinks
+from index.entry import PageRankStatus
 from index.entry import PageRankTracker
 from index.entry import PageUrlMapper
+from index.entry import Posting
 from index.entry import ReferenceTracker
 from index.entry import ReverseIndexEntry
 from index.entry import TextSection
+from index.entry import Tombstone
+from index.entry import UrlDictionaryEntry
 from index.entry import WordDictionaryEntry
-from index.entry import WordHitMapper
-from index.exceptions import ForwardMappingPersistException
-from index.exceptions import HitListPersistException
+from index.entry import url_hash
+from index.exceptions import BatchIndexException
+from index.exceptions import CompactionException
+from index.exceptions import DeletePersistException
+from index.exceptions import DocumentStoreException
 from index.exceptions import IndexException
-from index.exceptions import LexiconMappingPersistException
-from index.exceptions import PageHitMappingPersistException
 from index.exceptions import PageRankPersistException
+from index.exceptions import WordDictionaryPersistException
+from index.metrics import DISABLED
+from index.metrics import Metrics
+from index.pagerank import PageRankEngine
+from index.pagerank import PageRanks
+from index.posting import decode_hits
+from index.posting import posting_rows
+from index.query import AndQuery
+from index.query import QueryEngine
+from index.query import gallop
+from index.query import normalize_query
+from index.query import parse_query
+from index.query import query_terms
+from index.query import required_phrases
+from index.query import union
+from index.ranking import top_k
+from index.segment import SegmentIndex
+from index.snippet import snippet
 
 Session = sessionmaker()
 engine = None
 
+# the maximum number of values bound in a single IN clause, kept below the SQLite limit of 999 variables.
+QUERY_CHUNK_SIZE = 500
+
 
 def configure(connection_string, **kwargs):
 	global engine
 	global Session
 	engine = create_engine(connection_string, **kwargs)
 	Session.configure(bind=engine)
+	return engine
 
 
 def cleanup():
@@ -50,69 +88,34 @@ def cleanup():
 	Session = sessionmaker()
 
 
-def merge_list_dictionaries(dictionaries):
-	"""
-	merges dictionaries containing lists such that the result dictionary would have the keys and list entries of
-	all the input dictionaries.
-	:param dictionaries: a iterable series of dictionaries.
-	:return: the result dictionary.
-	"""
-
-	result_dict = dict()
-	for dictionary in dictionaries:
-		for key, value in dictionary.items():
-			if key not in result_dict:
-				result_dict[key] = list()
-			result_dict[key].extend(dictionary[key])
-	return result_dict
-
-
-def stripe_enclosing_punctuation(target: str):
-	"""
-	removes punctuations around a string. If the string is all punctuation, then do nothing.
-	:param target: the string to filter.
-	:return: a new string without the surrounding punctuations. Or, if the string is all punctuation, the original string.
-	"""
-
-	if len(target) == 0:
-		return target
-	lower_bound, upper_bound = 0, len(target)
-	acceptable_characters = string.ascii_letters + string.digits
-	# check from beginning
-	index = 0
-	while index < len(target):
-		if target[index] not in acceptable_characters:
-			lower_bound += 1
-			index += 1
-		else:
-			break
-	# check from end
-	index = len(target) - 1
-	while index >= 0:
-		if target[index] not in acceptable_characters:
-			upper_bound -= 1
-			index -= 1
-		else:
-			break
-	if upper_bound <= lower_bound:
-		return target
-	return target[lower_bound:upper_bound]
-
-
 class WordDictionary:
 	"""
-	A dictionary of words that maps a single word to a word_id. The mapping of words are persisted in a text file.
+	A dictionary of words that maps a single word to a word_id. The mapping of words are persisted in the database,
+	with a bounded write-through cache of recently used words kept in memory.
 	"""
 
-	def __init__(self, session):
+	def __init__(self, session, cache_size=100000):
+		"""
+		creates a new WordDictionary.
+		:param session: the session to persist the words with.
+		:param cache_size: the maximum number of word ids to cache in memory.
+		"""
 		self._session = session
+		self._cache = LRUCache(cache_size)
 
 	def close(self):
 		"""
 		cleans up all resources.
 		:return: None.
 		"""
-		pass
+		self._cache.clear()
+
+	def clear_cache(self):
+		"""
+		drops all cached word ids. This must be called when a transaction that added words is rolled back.
+		:return: None.
+		"""
+		self._cache.clear()
 
 	def get_word_id(self, word):
 		"""
@@ -122,22 +125,179 @@ class WordDictionary:
 		:return: the word if of the word.
 		"""
 
-		word = stripe_enclosing_punctuation(word.rstrip())
-		word = word.lower()
-		query = self._session.query(WordDictionaryEntry).filter(WordDictionaryEntry.word == word)
+		word = normalize_word(word)
+		word_id = self._cache.get(word)
+		if word_id is not None:
+			return word_id
+		query = self._session.query(WordDictionaryEntry.word_id).filter(WordDictionaryEntry.word == word)
 		word_entry = query.one_or_none()
 		if word_entry is not None:
-			return word_entry.word_id
+			word_id = word_entry[0]
+			self._cache.put(word, word_id)
+			return word_id
 		else:
 			return self.add_word(word)
 
+	def get_word_ids(self, words):
+		"""
+		gets the word ids of many words at once. Words missing from the cache are looked up with a single IN query
+		per chunk, and the ones missing from the dictionary are created with a single bulk insert.
+		:param words: an iterable of words.
+		:return: a dictionary mapping each of the given words to its word id.
+		"""
+
+		normalized = {word: normalize_word(word) for word in words}
+		resolved = self.lookup_word_ids(set(normalized.values()))
+		unseen = set(normalized.values()).difference(resolved.keys())
+		if len(unseen) != 0:
+			self._session.begin(subtransactions=True)
+			self._session.execute(WordDictionaryEntry.__table__.insert(), [{"word": word} for word in unseen])
+			self._session.commit()
+			found = self._lookup_words(unseen)
+			for word, word_id in found.items():
+				self._cache.put(word, word_id)
+			resolved.update(found)
+		return {word: resolved[normalized_word] for word, normalized_word in normalized.items()}
+
+	def lookup_word_ids(self, words):
+		"""
+		gets the word ids of words without adding the missing ones to the dictionary.
+		:param words: an iterable of words.
+		:return: a dictionary mapping each of the given words that is in the dictionary to its word id.
+		"""
+
+		normalized = {word: normalize_word(word) for word in words}
+		resolved = {}
+		missing = set()
+		for word in set(normalized.values()):
+			word_id = self._cache.get(word)
+			if word_id is None:
+				missing.add(word)
+			else:
+				resolved[word] = word_id
+		if len(missing) != 0:
+			found = self._lookup_words(missing)
+			for word, word_id in found.items():
+				self._cache.put(word, word_id)
+			resolved.update(found)
+		return {word: resolved[normalized_word] for word, normalized_word in normalized.items() if
+		        normalized_word in resolved}
+
 	def add_word(self, word):
 		word_entry = WordDictionaryEntry(word)
 		self._session.begin(subtransactions=True)
 		self._session.add(word_entry)
 		self._session.commit()
+		self._cache.put(word, word_entry.word_id)
 		return word_entry.word_id
 
+	def _lookup_words(self, words):
+		"""
+		looks up the ids of normalized words in the database.
+		:param words: the normalized words to look up.
+		:return: a dictionary mapping the words found in the database to their ids.
+		"""
+		found = {}
+		words = list(words)
+		for start in range(0, len(words), QUERY_CHUNK_SIZE):
+			chunk = words[start:start + QUERY_CHUNK_SIZE]
+			query = self._session.query(WordDictionaryEntry.word, WordDictionaryEntry.word_id).filter(
+				WordDictionaryEntry.word.in_(chunk))
+			found.update(query.all())
+		return found
+
+
+class UrlDictionary:
+	"""
+	A dictionary of urls that interns each url to a compact integer url_id, so that links, url mappings and page ranks
+	are stored and joined by integers rather than by long strings. Urls are looked up by their hash and compared in
+	full, with a bounded cache of recently used urls kept in memory.
+	"""
+
+	def __init__(self, session, cache_size=100000):
+		"""
+		creates a new UrlDictionary.
+		:param session: the session to persist the urls with.
+		:param cache_size: the maximum number of url ids to cache in memory.
+		"""
+		self._session = session
+		self._cache = LRUCache(cache_size)
+
+	def close(self):
+		"""
+		cleans up all resources.
+		:return: None.
+		"""
+		self._cache.clear()
+
+	def clear_cache(self):
+		"""
+		drops all cached url ids. This must be called when a transaction that added urls is rolled back.
+		:return: None.
+		"""
+		self._cache.clear()
+
+	def get_url_ids(self, urls):
+		"""
+		gets the url ids of many urls at once, adding the ones missing from the dictionary with a single bulk insert.
+		:param urls: an iterable of urls.
+		:return: a dictionary mapping each of the given urls to its url id.
+		"""
+		urls = set(urls)
+		resolved = self.lookup_url_ids(urls)
+		unseen = urls.difference(resolved.keys())
+		if len(unseen) != 0:
+			self._session.begin(subtransactions=True)
+			self._session.execute(UrlDictionaryEntry.__table__.insert(),
+			                      [{"url_hash": url_hash(url), "url": url} for url in unseen])
+			self._session.commit()
+			found = self._lookup_urls(unseen)
+			for url, url_id in found.items():
+				self._cache.put(url, url_id)
+			resolved.update(found)
+		return resolved
+
+	def lookup_url_ids(self, urls):
+		"""
+		gets the url ids of urls without adding the missing ones to the dictionary.
+		:param urls: an iterable of urls.
+		:return: a dictionary mapping each of the given urls that is in the dictionary to its url id.
+		"""
+		resolved = {}
+		missing = set()
+		for url in set(urls):
+			url_id = self._cache.get(url)
+			if url_id is None:
+				missing.add(url)
+			else:
+				resolved[url] = url_id
+		if len(missing) != 0:
+			found = self._lookup_urls(missing)
+			for url, url_id in found.items():
+				self._cache.put(url, url_id)
+			resolved.update(found)
+		return resolved
+
+	def _lookup_urls(self, urls):
+		"""
+		looks up the ids of urls in the database. Urls sharing a hash with a url looked up are told apart by their text.
+		:param urls: the urls to look up.
+		:return: a dictionary mapping the urls found in the database to their ids.
+		"""
+		found = {}
+		hashes = {}
+		for url in urls:
+			hashes.setdefault(url_hash(url), set()).add(url)
+		keys = list(hashes.keys())
+		for start in range(0, len(keys), QUERY_CHUNK_SIZE):
+			query = self._session.query(UrlDictionaryEntry.url_hash, UrlDictionaryEntry.url,
+			                            UrlDictionaryEntry.url_id).filter(
+				UrlDictionaryEntry.url_hash.in_(keys[start:start + QUERY_CHUNK_SIZE]))
+			for hash_value, url, url_id in query:
+				if url in hashes[hash_value]:
+					found[url] = url_id
+		return found
+
 
 class ForwardIndex:
 	"""
@@ -145,13 +305,15 @@ class ForwardIndex:
 	Hit that describes the kind of hit and the location of the hit.
 	"""
 
-	def __init__(self, session, word_dic):
+	def __init__(self, session, word_dic, metrics=DISABLED):
 		"""
 		creates a new forward entry with word dictionary.
 		:param word_dic: the word dictionary to map words
+		:param metrics: the Metrics to record the stages of indexing in.
 		"""
 		self._word_dic = word_dic
 		self._session = session
+		self._metrics = metrics
 
 	def index(self, data):
 		"""
@@ -159,18 +321,52 @@ class ForwardIndex:
 		:param data: the PageDocument to index.
 		:return: the forward index entry representing the PageDocument.
 		"""
+		return self.index_many([data])[0]
+
+	def index_many(self, documents, analyses=None):
+		"""
+		index many PageDocument to the forward index. The word ids of all the documents are resolved at once, and all
+		their postings are written with a single bulk insert.
+		:param documents: the PageDocuments to index.
+		:param analyses: the result of index.analysis.analyze_sections for each document if it was already analyzed,
+		or None to analyze the documents here.
+		:return: the forward index entries representing the PageDocuments, in the same order.
+		"""
 		self._session.begin(subtransactions=True)
-		forward_entry = ForwardIndexEntry(data.doc_id)
-		title_hits = self._title_to_hits(data.title)
-		header_hits = self._headers_to_hits(data.headers)
-		text_hits = self._texts_to_hits(data.texts)
-		anchor_hits = self._anchor_to_hits(data.anchors)
-		url_hits = self._url_to_hits(data.url)
-		master_dic = merge_list_dictionaries((title_hits, header_hits, text_hits, anchor_hits, url_hits))
-		forward_entry.hits = master_dic
-		self._write_forward_entry(forward_entry)
-		self._session.commit()
-		return forward_entry
+		metrics = self._metrics
+		with metrics.timer("analyze"):
+			if analyses is None:
+				analyses = [analyze_sections(document_sections(data)) for data in documents]
+			word_hits = [resolve_sections(analysis) for analysis in analyses]
+		with metrics.timer("resolve_words"):
+			word_ids = self._word_dic.get_word_ids(set().union(*word_hits))
+		entries = []
+		rows = []
+		with metrics.timer("encode_hits"):
+			for data, master_dic in zip(documents, word_hits):
+				forward_entry = ForwardIndexEntry(data.doc_id)
+				forward_entry.hits = {word_ids[word]: hit_list for word, hit_list in master_dic.items()}
+				rows.extend(posting_rows(forward_entry))
+				entries.append(forward_entry)
+		with metrics.timer("write_postings"):
+			if len(rows) != 0:
+				self._session.execute(Posting.__table__.insert(), rows)
+			self._session.commit()
+		metrics.increment("words_resolved", len(word_ids))
+		metrics.increment("postings_written", len(rows))
+		return entries
+
+	def remove_many(self, page_ids):
+		"""
+		deletes the postings of many pages with one bulk delete per QUERY_CHUNK_SIZE pages. The session is not
+		committed.
+		:param page_ids: the page ids of the pages.
+		:return: None.
+		"""
+		page_ids = list(page_ids)
+		for start in range(0, len(page_ids), QUERY_CHUNK_SIZE):
+			self._session.query(Posting).filter(Posting.page_id.in_(page_ids[start:start + QUERY_CHUNK_SIZE])).delete(
+				synchronize_session=False)
 
 	def get_entry(self, page_id):
 		"""
@@ -190,24 +386,23 @@ class ForwardIndex:
 		"""
 		pass
 
-	def _write_forward_entry(self, entry):
+	def get_entries(self, page_ids):
 		"""
-		writes a ForwardIndexEntry to the database.
-		:param entry: the entry to write.
-		:return: None.
+		gets the ForwardIndexEntry of many pages with one query per QUERY_CHUNK_SIZE pages.
+		:param page_ids: the page ids of the entries.
+		:return: a dictionary mapping each page id that has an entry to its ForwardIndexEntry.
 		"""
-		for word_id, hit_list in entry.hits.items():
-			self._write_hits(hit_list)
-			forward_mapper = ForwardMapper(entry.page_id, word_id)
-			for hit in hit_list:
-				word_hit_mapper = WordHitMapper(word_id, hit.id)
-				self._session.add(word_hit_mapper)
-			self._session.add(forward_mapper)
-			self._session.commit()
-
-	def _write_hits(self, hits):
-		self._session.add_all(hits)
-		self._session.flush()
+		page_ids = list(set(page_ids))
+		result = {}
+		for start in range(0, len(page_ids), QUERY_CHUNK_SIZE):
+			postings = self._session.query(Posting.page_id, Posting.word_id, Posting.hits).filter(
+				Posting.page_id.in_(page_ids[start:start + QUERY_CHUNK_SIZE]))
+			for page_id, word_id, hits in postings:
+				entry = result.get(page_id)
+				if entry is None:
+					entry = result[page_id] = ForwardIndexEntry(page_id)
+				entry.hits[word_id] = decode_hits(hits)
+		return result
 
 	def _read_forward_entry(self, page_id):
 		"""
@@ -215,158 +410,128 @@ class ForwardIndex:
 		:param page_id: the page id of the entry
 		:return: the read ForwardIndexEntry.
 		"""
-		word_ids = self._session.query(ForwardMapper.word_id).filter(ForwardMapper.page_id == page_id).all()
-		hit_dict = {}
-		for word_id in word_ids:
-			hit_ids = self._session.query(WordHitMapper.hit_id).filter(WordHitMapper.word_id == word_id[0]).all()
-			hit_ids = [hit_id_tuple[0] for hit_id_tuple in hit_ids]
-			hits = self._session.query(Hit).filter(Hit.id.in_(hit_ids)).all()
-			hit_dict[word_id[0]] = hits
-		result = ForwardIndexEntry(page_id)
-		result.hits = hit_dict
-		return result
+		return self.get_entries([page_id]).get(page_id, ForwardIndexEntry(page_id))
 
-	def _title_to_hits(self, title):
-		"""
-		converts the title of the PageDocument to Title Hits.
-		:param title: the title of the PageDocument.
-		:return: A dictionary mapping the word ids in the title to the hit list of each word.
-		"""
 
-		return self._scan_hits([(0, title)], Hit.TITLE_HIT)
+class ReverseIndex:
+	"""
+	A reverse index that maps a word to documents. Each document contains a hit list that are hits of the mapping word.
+	"""
 
-	def _headers_to_hits(self, headers):
+	def __init__(self, session, metrics=DISABLED):
 		"""
-		converts the headers of the PageDocument to Header Hits.
-		:param headers: the headers of the PageDocument.
-		:return: a dictionary mapping the word ids in the headers to their hit list.
+		creates a new ReverseIndex.
+		:param metrics: the Metrics to record the stages of indexing in.
 		"""
+		self._session = session
+		self._metrics = metrics
 
-		header_list = []
-		for header in headers:
-			header_list.append((header.id, header.text))
-		return self._scan_hits(header_list, Hit.HEADER_HIT)
-
-	def _texts_to_hits(self, texts):
+	def index(self, forward_entry):
 		"""
-		converts the text sections of the PageDocument to Text Hits.
-		:param texts: the text sections of the PageDocument.
-		:return: a dictionary mapping the word ids in the text sections to their hit list.
+		converts a ForwardIndexEntry to several ReverseIndexEntry and then index them. The reverse index shares its
+		postings with the forward index, so only the words of the entry that don't have a posting for its page yet are
+		written.
+		:param forward_entry: the forward entry to index.
+		:return: None.
 		"""
+		with self._metrics.timer("reverse_index"):
+			self._session.begin(subtransactions=True)
+			existing = {result[0] for result in
+			            self._session.query(Posting.word_id).filter(Posting.page_id == forward_entry.page_id)}
+			missing = [word_id for word_id in forward_entry.hits.keys() if word_id not in existing]
+			if len(missing) != 0:
+				self._session.execute(Posting.__table__.insert(), posting_rows(forward_entry, missing))
+			self._session.commit()
+		self._metrics.increment("postings_written", len(missing))
 
-		text_list = []
-		for text in texts:
-			text_list.append((text.id, text.text))
-		return self._scan_hits(text_list, Hit.TEXT_HIT)
-
-	def _anchor_to_hits(self, anchors):
+	def get_entry(self, word_id):
 		"""
-		converts the anchors of the PageDocument to Anchor Hits.
-		:param anchors: the anchors of the PageDocument.
-		:return: a dictionary mapping the word ids in the anchors to their hit list.
+		gets all reverse entries that are mapped by the specified word.
+		:param word_id: the word id to search for.
+		:return: ReverseIndexEntry mapped by this word id.
 		"""
+		result = ReverseIndexEntry(word_id)
+		result.pages = dict(self.iter_entry(word_id))
+		return result
 
-		anchor_texts = []
-		for anchor in anchors:
-			anchor_texts.append((anchor.id, anchor.text))
-		return self._scan_hits(anchor_texts, Hit.ANCHOR_HIT)
-
-	def _url_to_hits(self, url):
+	def iter_entry(self, word_id):
 		"""
-		converts the url of the page to URL Hit.
-		:param url: the url of the page.
-		:return: a dictionary with the word id of the url mapped to its Hit.
+		streams the pages and hit lists of a word with a single query, fetching QUERY_CHUNK_SIZE postings at a time,
+		so that the postings of a common word never have to be held in memory at once.
+		:param word_id: the word id to search for.
+		:return: a generator of (page_id, hit list) tuples in ascending page order.
 		"""
+		query = self._session.query(Posting.page_id, Posting.hits).filter(Posting.word_id == word_id).order_by(
+			Posting.page_id)
+		for page_id, hits in query.yield_per(QUERY_CHUNK_SIZE):
+			yield page_id, decode_hits(hits)
 
-		return self._scan_hits([(0, url)], Hit.URL_HIT)
-
-	def _scan_hits(self, sections, kind):
+	def get_page_ids(self, word_id):
 		"""
-		converts sections of content to dictionary mapping word ids in the sections to hit list of the specified kind.
-		:param sections: the iterable sections of strings to convert to hit lists.
-		:param kind: the kind of Hit
-		:return: a dictionary mapping word ids in the sections to hit lists.
+		gets the page id of all pages containing the word referenced by this word id.
+		:param word_id: the word id to search for.
+		:return: all page ids referenced by this word id in ascending order.
 		"""
+		query = self._session.query(Posting.page_id).filter(Posting.word_id == word_id).order_by(Posting.page_id)
+		return [result[0] for result in query]
 
-		master_result = dict()
-		for id_num, section in sections:
-			result_dict = self._scan_section(id_num, section, kind)
-			master_result = merge_list_dictionaries((master_result, result_dict))
-		return master_result
-
-	def _scan_section(self, section_num, section: str, kind: int):
+	def filter_page_ids(self, word_id, page_ids):
 		"""
-		converts an individual section to a dictionary mapping the word ids in the section to their hit list.
-		:param section_num: the section number of the section.
-		:param section: the string section itself.
-		:param kind: the kind of Hit of this section.
-		:return: a dictionary mapping the word ids in the section to their hit list.
+		finds which of some pages contain the word referenced by this word id. The lookups only read the primary key
+		index of the postings, a chunk of pages at a time, so the posting list of a common word is never read in full.
+		:param word_id: the word id to search for.
+		:param page_ids: the sorted page ids to check.
+		:return: the sorted page ids containing the word.
 		"""
-
-		words = section.split(" ")
-		result = dict()
-		for count, word in enumerate(words):
-			word_id = self._word_dic.get_word_id(word)
-			if word_id not in result:
-				result[word_id] = []
-			result[word_id].append(Hit(kind, section_num, count))
+		page_ids = list(page_ids)
+		result = []
+		for start in range(0, len(page_ids), QUERY_CHUNK_SIZE):
+			query = self._session.query(Posting.page_id).filter(
+				Posting.word_id == word_id, Posting.page_id.in_(page_ids[start:start + QUERY_CHUNK_SIZE])).order_by(
+				Posting.page_id)
+			result.extend(row[0] for row in query)
 		return result
 
-
-class ReverseIndex:
-	"""
-	A reverse index that maps a word to documents. Each document contains a hit list that are hits of the mapping word.
-	"""
-
-	def __init__(self, session):
+	def get_hits(self, word_id, page_ids):
 		"""
-		creates a new ReverseIndex.
+		gets the hit lists of a word on some pages, without reading its postings for any other page.
+		:param word_id: the word id to search for.
+		:param page_ids: the page ids to get the hits on.
+		:return: a dictionary mapping the page ids containing the word to its hit list on the page.
 		"""
-		self._session = session
+		page_ids = list(page_ids)
+		result = {}
+		for start in range(0, len(page_ids), QUERY_CHUNK_SIZE):
+			query = self._session.query(Posting.page_id, Posting.hits).filter(
+				Posting.word_id == word_id, Posting.page_id.in_(page_ids[start:start + QUERY_CHUNK_SIZE]))
+			result.update((page_id, decode_hits(hits)) for page_id, hits in query)
+		return result
 
-	def index(self, forward_entry):
+	def document_frequency(self, word_id):
 		"""
-		converts a ForwardIndexEntry to several ReverseIndexEntry and then index them.
-		:param forward_entry: the forward entry to index.
-		:return: all the reverse entries that came from the forward entry in the form of a dictionary with
-		word id -> ReverseIndexEntry.
+		gets the amount of pages containing the word referenced by this word id.
+		:param word_id: the word id to search for.
+		:return: the amount of pages.
 		"""
-		self._session.begin(subtransactions=True)
-		for word_id, hit_list in forward_entry.hits.items():
-			page_hit_mappers = self._write_hit_list_mapping(forward_entry.page_id, hit_list)
-			for page_hit in page_hit_mappers:
-				lexicon_mapper = LexiconMapper(word_id, page_hit.id)
-				self._session.add(lexicon_mapper)
-		self._session.commit()
+		return self._session.query(sa.func.count(Posting.page_id)).filter(Posting.word_id == word_id).scalar()
 
-	def get_entry(self, word_id):
+	def cursor(self, word_id):
 		"""
-		gets all reverse entries that are mapped by the specified word.
+		gets a cursor over the page ids and text scores of the word referenced by this word id, which fetches the
+		postings a chunk at a time and only where it moves to.
 		:param word_id: the word id to search for.
-		:return: ReverseIndexEntry mapped by this word id.
+		:return: a PostingRangeCursor.
 		"""
-		entry_ids = [result[0] for result in
-		             self._session.query(LexiconMapper.page_hit_mapper_id).filter(LexiconMapper.word_id == word_id)]
-		page_hit_mappers = self._session.query(PageHitMapper).filter(PageHitMapper.id.in_(entry_ids)).all()
-		page_dict = {}
-		for page_hit_mapper in page_hit_mappers:
-			if page_hit_mapper.page_id not in page_dict:
-				page_dict[page_hit_mapper.page_id] = []
-			hit = self._session.query(Hit).filter(Hit.id == page_hit_mapper.hit_id).one_or_none()
-			if hit is not None:
-				page_dict[page_hit_mapper.page_id].append(hit)
-		result = ReverseIndexEntry(word_id)
-		result.pages = page_dict
-		return result
+		return PostingRangeCursor(self._session, word_id, self.max_weight(word_id))
 
-	def get_page_ids(self, word_id):
+	def max_weight(self, word_id):
 		"""
-		gets the page id of all pages containing the word referenced by this word id.
+		gets the highest text score of the word referenced by this word id on any page, which reads a single entry of
+		the index on the words and text scores of the postings.
 		:param word_id: the word id to search for.
-		:return: all page ids referenced by this word id.
+		:return: the highest text score.
 		"""
-		reverse_entry = self.get_entry(word_id)
-		return reverse_entry.pages.keys()
+		return self._session.query(sa.func.max(Posting.weight)).filter(Posting.word_id == word_id).scalar() or 0.0
 
 	def close(self):
 		"""
@@ -375,20 +540,77 @@ class ReverseIndex:
 		"""
 		pass
 
-	def _write_hit_list_mapping(self, page_id, hit_list):
-		to_save = []
-		for hit in hit_list:
-			to_save.append(PageHitMapper(page_id, hit.id))
-		self._session.add_all(to_save)
-		self._session.flush()
-		return to_save
+
+class PostingRangeCursor:
+	"""
+	A cursor over the page ids and text scores of the posting list of a word in the database. It fetches chunk_size
+	postings at a time with a range query on the primary key of the postings, and seeking beyond the fetched postings
+	starts the next range at the target page, so the pages skipped over are never read.
+	"""
+
+	def __init__(self, session, word_id, upper_bound, chunk_size=QUERY_CHUNK_SIZE):
+		"""
+		creates a new PostingRangeCursor.
+		:param session: the session to read the postings with.
+		:param word_id: the word id of the posting list.
+		:param upper_bound: the highest text score in the posting list.
+		:param chunk_size: the amount of postings fetched at a time.
+		"""
+		self._session = session
+		self._word_id = word_id
+		self._chunk_size = chunk_size
+		self.upper_bound = upper_bound
+		self._page_ids, self._weights, self._position, self._complete = [], [], 0, False
+		self._fetch(None)
+
+	def page_id(self):
+		return self._page_ids[self._position]
+
+	def weight(self):
+		return self._weights[self._position]
+
+	def next(self):
+		self._position += 1
+		if self._position == len(self._page_ids) and not self._complete:
+			self._fetch(self._page_ids[-1] + 1)
+
+	def advance_to(self, page_id):
+		"""
+		moves the cursor to the first page with an id not less than page_id.
+		:param page_id: the page id to move to.
+		:return: None.
+		"""
+		if self.exhausted() or self._page_ids[self._position] >= page_id:
+			return
+		if page_id <= self._page_ids[-1]:
+			self._position = gallop(self._page_ids, page_id, self._position)
+		elif self._complete:
+			self._position = len(self._page_ids)
+		else:
+			self._fetch(page_id)
+
+	def exhausted(self):
+		return self._position >= len(self._page_ids)
+
+	def _fetch(self, page_id):
+		query = self._session.query(Posting.page_id, Posting.weight).filter(Posting.word_id == self._word_id)
+		if page_id is not None:
+			query = query.filter(Posting.page_id >= page_id)
+		self._page_ids, self._weights = [], []
+		for found, weight in query.order_by(Posting.page_id).limit(self._chunk_size):
+			self._page_ids.append(found)
+			self._weights.append(weight)
+		self._position = 0
+		self._complete = len(self._page_ids) < self._chunk_size
 
 
 class SearchResult:
 
-	def __init__(self, page_id, page_rank):
+	def __init__(self, page_id, page_rank, score=None, snippet=None):
 		self.page_id = page_id
 		self.page_rank = page_rank
+		self.score = score
+		self.snippet = snippet
 
 	def __eq__(self, o: "SearchResult") -> bool:
 		try:
@@ -413,18 +635,65 @@ class Indexer:
 	The Anatomy of a Large-Scale Hypertextual Web Search Engine. Currently, it is not thread safe.
 	"""
 
-	def __init__(self, dampener=0.8, page_rank_iteration=100):
+	def __init__(self, dampener=0.8, page_rank_iteration=100, word_cache_size=100000, page_rank_tolerance=1e-8,
+	             page_rank_residual=1e-6, segment_directory=None, segment_flush_size=1000, page_rank_weight=1.0,
+	             query_cache_size=10000, query_cache_ttl=300, url_cache_size=100000, document_directory=None,
+	             document_garbage=0.5, section_cache_size=1000, metrics=False, generation_check_interval=0.1):
 		"""
 		creates a new Indexer specifying index directory and weight dampener.
 		:param dampener: the dampening factor.
-		:param page_rank_iteration the amount of iteration to calculate page_rank
+		:param page_rank_iteration the maximum amount of iteration to calculate page_rank
+		:param word_cache_size: the maximum number of word ids the word dictionary keeps in memory.
+		:param page_rank_tolerance: page rank iteration stops once no rank changes by more than this amount.
+		:param page_rank_residual: incremental page rank updates stop once no residual exceeds this amount.
+		:param segment_directory: the directory of the memory mapped segments to serve searches from, or None to search
+		the database. The segments of a directory are only seen by the process that opened it.
+		:param segment_flush_size: the amount of newly indexed pages collected in memory before they are written to a
+		new segment.
+		:param page_rank_weight: the weight of the page rank against the text score in ranked searches.
+		:param query_cache_size: the maximum number of search results to cache. A size of 0 disables the cache.
+		:param query_cache_ttl: the amount of seconds a search result is cached, or None to cache it until the index
+		changes.
+		:param url_cache_size: the maximum number of url ids the url dictionary keeps in memory.
+		:param document_directory: the directory of the DocumentStore keeping the raw content and the sections of the
+		pages. It may only be None for an indexer that searches, as indexing and reading pages need the store.
+		:param document_garbage: the share of replaced and deleted records in the DocumentStore above which compact
+		rewrites the store.
+		:param section_cache_size: the maximum number of pages whose section texts are kept in memory for snippets.
+		:param metrics: whether to record the durations of the stages of indexing, searching and page rank calculation,
+		see metrics_statistics and prometheus_metrics.
+		:param generation_check_interval: the minimum amount of seconds between two reads of the index generation,
+		which is how the caches notice changes made by other processes. Changes made through this indexer invalidate
+		the caches right away.
 		"""
 		self._dampener = dampener
 		self._page_rank_iteration = page_rank_iteration
+		self._page_rank_tolerance = page_rank_tolerance
+		self._page_rank_residual = page_rank_residual
+		self._page_rank_weight = page_rank_weight
+		self._rank_cache = None
+		self._query_cache = LRUCache(query_cache_size, query_cache_ttl)
+		self._query_cache_generation = None
+		self._generation_check_interval = generation_check_interval
+		self._generation_checked = None
+		self._deleted_cache = None
+		self._section_cache = LRUCache(section_cache_size)
+		self._metrics = Metrics(enabled=metrics)
 		self._session = Session()
-		self._word_dictionary = WordDictionary(self._session)
-		self._forward_index = ForwardIndex(self._session, self._word_dictionary)
-		self._reverse_index = ReverseIndex(self._session)
+		self._word_dictionary = WordDictionary(self._session, word_cache_size)
+		self._url_dictionary = UrlDictionary(self._session, url_cache_size)
+		self._forward_index = ForwardIndex(self._session, self._word_dictionary, self._metrics)
+		self._reverse_index = ReverseIndex(self._session, self._metrics)
+		self._segment_index = None
+		self._segment_flush_size = segment_flush_size
+		if segment_directory is not None:
+			self._segment_index = SegmentIndex(segment_directory)
+			self._recover_segments()
+			self._segment_index.start_merging()
+		self._document_store = None
+		self._document_garbage = document_garbage
+		if document_directory is not None:
+			self._document_store = DocumentStore(document_directory)
 
 	def index(self, data):
 		"""
@@ -433,48 +702,278 @@ class Indexer:
 		:return: None.
 		"""
 		try:
-			existing = self._session.query(PageUrlMapper).filter(PageUrlMapper.url == data.url).one_or_none()
-			if existing is not None:
-				return
-			self._session.add(data)
-			self._session.flush()
-			forward_entry = self._forward_index.index(data)
-			self._reverse_index.index(forward_entry)
-			url_page_id_mapper = PageUrlMapper(forward_entry.page_id, data.url)
-			page_link_count = PageLinks(forward_entry.page_id, len(data.anchors))
-			default_page_rank = PageRankTracker(data.url, 1 - self._dampener)
-			reference_trackers = []
-			unique_anchors = set(data.anchors)
-			for anchor in unique_anchors:
-				reference_trackers.append(ReferenceTracker(forward_entry.page_id, anchor.url))
-			self._session.add(url_page_id_mapper)
-			self._session.add(page_link_count)
-			self._session.add_all(reference_trackers)
-			self._session.add(default_page_rank)
+			self.index_many([data])
+		except BatchIndexException as e:
+			raise IndexException(data.url) from e.__cause__
+
+	def index_many(self, pages, analyses=None):
+		"""
+		indexes a batch of PageDocument in a single transaction. The words of all pages are resolved to word ids at
+		once, and the postings, url mappings, link counts, references and default page ranks are written with one bulk
+		insert per table. A page whose url is already indexed is skipped if its checksum is unchanged and it was not
+		deleted. Otherwise it keeps its page id and page rank, and only its document, postings, link count and
+		references are replaced. Pages that repeat a url earlier in the batch are skipped.
+		:param pages: an iterable of PageDocument to index.
+		:param analyses: the result of index.analysis.analyze_sections for each page if the pages were analyzed
+		elsewhere, such as by a ParallelIndexer, or None to analyze them here.
+		:return: the amount of pages indexed or re-indexed.
+		"""
+		self._require_document_store()
+		with self._metrics.timer("index_many"):
+			return self._index_many(list(pages), analyses)
+
+	def delete(self, page):
+		"""
+		deletes a page by writing a tombstone for it. Searches and page rank calculations leave the page out right away,
+		while its rows are removed by the next compact.
+		:param page: the page id or the url of the page.
+		:return: True if the page was deleted, False if it is not indexed or already deleted.
+		"""
+		try:
+			if isinstance(page, str):
+				url_id = self._url_dictionary.lookup_url_ids([page]).get(page)
+				page_id = None if url_id is None else self._session.query(PageUrlMapper.id).filter(
+					PageUrlMapper.url_id == url_id).scalar()
+			else:
+				page_id = self._session.query(PageUrlMapper.id).filter(PageUrlMapper.id == page).scalar()
+			if page_id is None or self._session.query(Tombstone).get(page_id) is not None:
+				return False
+			self._session.add(Tombstone(page_id, time.time()))
+			status = self._page_rank_status()
+			status.graph_generation += 1
+			status.index_generation += 1
+			self._session.commit()
+		except SQLAlchemyError as e:
+			self._session.rollback()
+			raise DeletePersistException(page) from e
+		self._check_generation(force=True)
+		return True
+
+	def get_document(self, page_id):
+		"""
+		gets an indexed page. Its raw content and sections are read from the DocumentStore, the only time they are
+		loaded.
+		:param page_id: the page id.
+		:return: the PageDocument, or None if the page is not indexed or deleted.
+		"""
+		self._require_document_store()
+		self._check_generation()
+		if page_id in self._deleted_pages():
+			return None
+		document = self._session.query(PageDocument).get(page_id)
+		if document is None:
+			return document
+		store = self._document_store
+		return decode_document(store.get(page_id), store.get_sections(page_id), document)
+
+	def tombstone_count(self):
+		"""
+		gets the amount of deleted pages waiting for compaction.
+		:return: the amount of tombstones.
+		"""
+		return self._session.query(Tombstone).count()
+
+	def compact(self):
+		"""
+		removes the rows of all deleted pages in bulk: their documents, postings, link counts, references, url mappings
+		and page ranks, as well as their tombstones. Segment files holding deleted pages are rewritten and their records
+		are deleted from the DocumentStore first, so the pages stay hidden from searches if the database part fails.
+		:return: the amount of pages removed.
+		"""
+		page_ids = [page_id for page_id, in self._session.query(Tombstone.page_id)]
+		if len(page_ids) == 0:
+			return 0
+		if self._segment_index is not None:
+			self._segment_index.purge(page_ids)
+		if self._document_store is not None:
+			self._document_store.delete(page_ids)
+			if self._document_store.garbage() > self._document_garbage:
+				self._document_store.compact()
+		try:
+			self._remove_pages(page_ids)
+			for start in range(0, len(page_ids), QUERY_CHUNK_SIZE):
+				chunk = page_ids[start:start + QUERY_CHUNK_SIZE]
+				self._session.query(PageUrlMapper).filter(PageUrlMapper.id.in_(chunk)).delete(
+					synchronize_session="fetch")
+				self._session.query(PageRankTracker).filter(PageRankTracker.page_id.in_(chunk)).delete(
+					synchronize_session="fetch")
 			self._session.commit()
 		except SQLAlchemyError as e:
 			self._session.rollback()
-			raise IndexException(data.url) from e
+			raise CompactionException(len(page_ids)) from e
+		return len(page_ids)
+
+	def resolve_words(self, words):
+		"""
+		resolves words to word ids, adding the missing ones to the dictionary, so that indexing pages containing them
+		later finds them in the word cache.
+		:param words: an iterable of words.
+		:return: a dictionary mapping each of the given words to its word id.
+		"""
+		words = list(words)
+		try:
+			return self._word_dictionary.get_word_ids(words)
+		except SQLAlchemyError as e:
+			self._session.rollback()
+			self._word_dictionary.clear_cache()
+			raise WordDictionaryPersistException(words) from e
 
-	def search_by_keywords(self, keywords):
+	def search_by_keywords(self, keywords, snippets=False, snippet_count=10):
 		"""
-		search the index by keywords.
+		search the index by keywords. The keywords form a boolean query: all words must match unless joined by OR, and
+		words prefixed by NOT or - must not match. See index.query.parse_query.
 		:param keywords: the keywords to search for.
-		:return: the result sorted by pagerank and keywords.
-		"""
-
-		self._calculate_page_rank()
-		keyword_id = self._word_dictionary.get_word_id(keywords)
-		pages = self._reverse_index.get_page_ids(keyword_id)
-		ranked_pages = {}
-		for page_id in pages:
-			url = self._session.query(PageUrlMapper.url).filter(PageUrlMapper.id == page_id).one()[0]
-			page_rank = self._session.query(PageRankTracker.page_rank).filter(PageRankTracker.url == url).one()[0]
-			ranked_pages[page_id] = page_rank
-		sorted_pages = []
-		for key, item in sorted(ranked_pages.items(), key=lambda entry: entry[1], reverse=True):
-			sorted_pages.append(SearchResult(key, item))
-		return sorted_pages
+		:param snippets: whether to add a highlighted snippet to the first results, see _add_snippets.
+		:param snippet_count: the amount of first results to add a snippet to, the others keep a snippet of None.
+		:return: the result sorted by the page rank last calculated by update_page_rank.
+		"""
+
+		with self._metrics.timer("search_by_keywords"):
+			query = parse_query(keywords)
+			key = ("boolean", repr(normalize_query(query, normalize_word)))
+			cached = self._cached_result(key)
+			if cached is not None:
+				return self._search_results(cached, query, snippet_count if snippets else 0)
+			pages = QueryEngine(self._postings(), self._word_dictionary).search(query)
+			ranks = self._page_ranks()
+			deleted = self._deleted_pages()
+			ranked_pages = {page_id: ranks.get(page_id) for page_id in pages if page_id not in deleted}
+			sorted_pages = tuple((page_id, rank, None) for page_id, rank in
+			                     sorted(ranked_pages.items(), key=lambda entry: entry[1], reverse=True))
+			self._query_cache.put(key, sorted_pages)
+			return self._search_results(sorted_pages, query, snippet_count if snippets else 0)
+
+	def search(self, keywords, k=10, snippets=False):
+		"""
+		finds the k best pages for some keywords. The score of a page is the sum of the text scores of the keywords it
+		contains, where title, url, anchor and header hits weigh more than text hits, plus the weighted page rank last
+		calculated by update_page_rank. Words are not required: a page only needs to contain one of the keywords, even
+		where the query joins them by AND, and containing more of them scores higher. Phrases are required, so a page
+		must match every phrase that is not under an OR, and pages matching a word or group prefixed by NOT or - are
+		left out. The posting lists are read lazily, and pages that cannot reach the top k are skipped without being
+		read or scored.
+		:param keywords: the keywords to search for.
+		:param k: the amount of results.
+		:param snippets: whether to add a highlighted snippet to each result, see _add_snippets.
+		:return: up to k SearchResult sorted by descending score.
+		"""
+
+		with self._metrics.timer("search"):
+			query = parse_query(keywords)
+			key = ("ranked", repr(normalize_query(query, normalize_word)), k)
+			cached = self._cached_result(key)
+			if cached is not None:
+				return self._search_results(cached, query, k if snippets else 0)
+			words, excluding = query_terms(query)
+			postings = self._postings()
+			word_ids = set(self._word_dictionary.lookup_word_ids(words).values())
+			cursors = [postings.cursor(word_id) for word_id in word_ids]
+			engine = QueryEngine(postings, self._word_dictionary)
+			excluded = set(union([engine.search(query) for query in excluding]))
+			excluded.update(self._deleted_pages())
+			phrases = required_phrases(query)
+			required = engine.search(AndQuery(phrases)) if len(phrases) != 0 else None
+			ranks = self._page_ranks()
+			results = top_k(cursors, k, ranks, ranks.default_rank, ranks.max_rank, self._page_rank_weight, excluded,
+			                required)
+			results = tuple((page_id, ranks.get(page_id), score) for page_id, score in results)
+			self._query_cache.put(key, results)
+			return self._search_results(results, query, k if snippets else 0)
+
+	def query_cache_statistics(self):
+		"""
+		gets the statistics of the search result cache.
+		:return: a dictionary with the amount of cache hits, cache misses and cached results.
+		"""
+		return {"hits": self._query_cache.hits, "misses": self._query_cache.misses, "size": len(self._query_cache)}
+
+	def metrics_statistics(self):
+		"""
+		gets the durations of the stages of indexing, searching and page rank calculation and the counters recorded
+		since the indexer was created, if it was created with metrics enabled. See index.metrics.Metrics.statistics.
+		:return: a dictionary with the statistics of each stage in seconds and the value of each counter.
+		"""
+		return self._metrics.statistics()
+
+	def prometheus_metrics(self, prefix="halindexer"):
+		"""
+		dumps the recorded stage durations and counters in the Prometheus text exposition format, along with the
+		statistics of the search result cache.
+		:param prefix: the prefix of the metric names.
+		:return: the text.
+		"""
+		lines = [self._metrics.prometheus(prefix)]
+		for name, value in self.query_cache_statistics().items():
+			metric = "{0}_query_cache_{1}".format(prefix, name)
+			lines.append("# TYPE {0} {1}\n{0} {2}\n".format(metric, "gauge" if name == "size" else "counter", value))
+		return "".join(lines)
+
+	def update_page_rank(self, force=False, incremental=False):
+		"""
+		recalculates the page rank of all pages if pages were added since the last calculation. Searches use the
+		persisted ranks, so this is meant to be called explicitly or on a schedule rather than per query.
+		:param force: recalculate even if the link graph did not change.
+		:param incremental: only propagate the changes since the last calculation, starting from the persisted ranks.
+		A full calculation is done instead if the page ranks were never calculated.
+		:return: True if the page ranks were recalculated, False otherwise.
+		"""
+		status = self._page_rank_status()
+		if not force and status.updated is not None and status.graph_generation == status.rank_generation:
+			return False
+		try:
+			with self._metrics.timer("page_rank"):
+				if incremental and status.updated is not None:
+					self._update_page_rank()
+				else:
+					self._calculate_page_rank()
+				status.rank_generation = status.graph_generation
+				status.index_generation += 1
+				status.updated = time.time()
+				self._session.commit()
+		except SQLAlchemyError as e:
+			self._session.rollback()
+			raise PageRankPersistException() from e
+		self._check_generation(force=True)
+		return True
+
+	def is_page_rank_stale(self):
+		"""
+		checks whether pages were added since the page ranks were last calculated.
+		:return: True if the page ranks are out of date.
+		"""
+		status = self._page_rank_status()
+		return status.updated is None or status.graph_generation != status.rank_generation
+
+	def page_rank_age(self):
+		"""
+		gets the age of the persisted page ranks.
+		:return: the seconds since the page ranks were last calculated, or None if they never were.
+		"""
+		updated = self._page_rank_status().updated
+		if updated is None:
+			return None
+		return time.time() - updated
+
+	def flush_segments(self):
+		"""
+		writes the pages indexed since the last flush to a new segment. Does nothing if no segment directory is used.
+		:return: None.
+		"""
+		if self._segment_index is not None:
+			self._segment_index.flush()
+
+	def rebuild_segments(self):
+		"""
+		replaces all segments with a single segment holding every posting in the database. This builds the segments of
+		an index that was created without them.
+		:return: None.
+		"""
+		if self._segment_index is None:
+			return
+		query = self._session.query(Posting.word_id, Posting.page_id, Posting.hit_count, Posting.weight,
+		                            Posting.hits).order_by(Posting.word_id, Posting.page_id)
+		self._segment_index.clear()
+		self._segment_index.write(tuple(row) for row in query.yield_per(QUERY_CHUNK_SIZE))
 
 	def close(self):
 		"""
@@ -483,36 +982,333 @@ class Indexer:
 		"""
 
 		self._word_dictionary.close()
+		self._url_dictionary.close()
 		self._forward_index.close()
 		self._reverse_index.close()
+		if self._segment_index is not None:
+			self._segment_index.close()
+		if self._document_store is not None:
+			self._document_store.close()
 		self._session.close()
 
+	def _index_many(self, pages, analyses):
+		"""
+		indexes a batch of PageDocument, see index_many, recording the duration of each stage.
+		:param pages: the list of PageDocument to index.
+		:param analyses: the analyses of the pages, or None.
+		:return: the amount of pages indexed or re-indexed.
+		"""
+		metrics = self._metrics
+		if analyses is None:
+			analyses = [None] * len(pages)
+		try:
+			with metrics.timer("check_changes"):
+				kept, changed = self._changed_pages(pages)
+			metrics.increment("pages_skipped", len(pages) - len(kept))
+			analyses = [analyses[position] for position in kept]
+			pages = [pages[position] for position in kept]
+			if len(pages) == 0:
+				return 0
+			if any(analysis is None for analysis in analyses):
+				analyses = None
+			with metrics.timer("remove_pages"):
+				self._remove_pages(changed.values())
+			for data in pages:
+				if data.url in changed:
+					data.doc_id = changed[data.url]
+			with metrics.timer("write_documents"):
+				self._session.add_all(pages)
+				self._session.flush()
+			# the reverse index shares the postings written by the forward index
+			forward_entries = self._forward_index.index_many(pages, analyses)
+			with metrics.timer("resolve_urls"):
+				urls = set(data.url for data in pages)
+				for data in pages:
+					urls.update(anchor.url for anchor in data.anchors)
+				url_ids = self._url_dictionary.get_url_ids(urls)
+			with metrics.timer("write_links"):
+				url_rows, link_rows, reference_rows, rank_rows = [], [], [], []
+				for data, forward_entry in zip(pages, forward_entries):
+					if data.url not in changed:
+						url_rows.append({"page_id": forward_entry.page_id, "url_id": url_ids[data.url]})
+						rank_rows.append({"page_id": forward_entry.page_id, "page_rank": 1 - self._dampener})
+					link_rows.append({"page_id": forward_entry.page_id, "link_out": len(data.anchors)})
+					for url in set(anchor.url for anchor in data.anchors):
+						reference_rows.append({"page_id": forward_entry.page_id, "url_id": url_ids[url]})
+				if len(url_rows) != 0:
+					self._session.execute(PageUrlMapper.__table__.insert(), url_rows)
+					self._session.execute(PageRankTracker.__table__.insert(), rank_rows)
+				self._session.execute(PageLinks.__table__.insert(), link_rows)
+				if len(reference_rows) != 0:
+					self._session.execute(ReferenceTracker.__table__.insert(), reference_rows)
+				status = self._page_rank_status()
+				status.graph_generation += 1
+				status.index_generation += 1
+			if self._segment_index is not None:
+				self._segment_index.log_pending([forward_entry.page_id for forward_entry in forward_entries])
+			with metrics.timer("commit"):
+				self._session.commit()
+		except BaseException as e:
+			# whatever failed, such as the analysis of a malformed page, nothing of the batch may stay in the session,
+			# including the subtransactions the failure left open in the dictionaries or the forward index
+			while self._session.transaction.parent is not None:
+				self._session.rollback()
+			self._session.rollback()
+			self._word_dictionary.clear_cache()
+			self._url_dictionary.clear_cache()
+			metrics.increment("failed_batches")
+			if isinstance(e, SQLAlchemyError):
+				raise BatchIndexException([data.url for data in pages]) from e
+			raise
+		with metrics.timer("store_documents"):
+			self._store_documents(pages)
+		if self._segment_index is not None:
+			with metrics.timer("segments"):
+				for forward_entry in forward_entries:
+					self._segment_index.add(forward_entry)
+				if self._segment_index.buffered_documents() >= self._segment_flush_size:
+					self._segment_index.flush()
+		self._check_generation(force=True)
+		metrics.increment("pages_indexed", len(pages))
+		metrics.increment("pages_reindexed", len(changed))
+		return len(pages)
+
+	def _recover_segments(self):
+		"""
+		adds the pages that were committed to the database but lost with the in memory segment when the process exited
+		before flushing it, and flushes them. Pending pages whose batch was not committed have no entry and are skipped.
+		:return: None.
+		"""
+		pending = self._segment_index.pending_pages()
+		if len(pending) == 0:
+			return
+		entries = self._forward_index.get_entries(pending)
+		for page_id in sorted(entries):
+			self._segment_index.add(entries[page_id])
+		self._segment_index.flush()
+
+	def _changed_pages(self, pages):
+		"""
+		finds the pages that are not indexed yet, deleted or whose checksum differs from the indexed version, skipping
+		pages that repeat a url earlier in the list. The indexed checksums are read with one query per QUERY_CHUNK_SIZE
+		urls.
+		:param pages: a list of PageDocument.
+		:return: a tuple of the positions of the pages to index in the list, and a dictionary mapping the url of each
+		changed page to the page id of its indexed version.
+		"""
+		url_ids = self._url_dictionary.lookup_url_ids(data.url for data in pages)
+		known = list(set(url_ids.values()))
+		indexed = {}
+		for start in range(0, len(known), QUERY_CHUNK_SIZE):
+			query = self._session.query(PageUrlMapper.url_id, PageUrlMapper.id, PageDocument.checksum,
+			                            Tombstone.page_id).join(
+				PageDocument, PageDocument.doc_id == PageUrlMapper.id).outerjoin(
+				Tombstone, Tombstone.page_id == PageUrlMapper.id).filter(
+				PageUrlMapper.url_id.in_(known[start:start + QUERY_CHUNK_SIZE]))
+			# a deleted page that is crawled again is indexed again, whatever its checksum
+			indexed.update((url_id, (page_id, None if deleted is not None else checksum)) for
+			               url_id, page_id, checksum, deleted in query)
+		seen = set()
+		result = []
+		changed = {}
+		for position, data in enumerate(pages):
+			if data.url in seen:
+				continue
+			seen.add(data.url)
+			page_id, checksum = indexed.get(url_ids.get(data.url), (None, None))
+			if page_id is None:
+				result.append(position)
+			elif checksum != data.checksum:
+				changed[data.url] = page_id
+				result.append(position)
+		return result, changed
+
+	def _remove_pages(self, page_ids):
+		"""
+		deletes the documents, postings, link counts, references and tombstones of pages, keeping their url mappings and
+		page ranks so that the pages can be indexed again under the same page id. The session is not committed.
+		:param page_ids: the page ids of the pages.
+		:return: None.
+		"""
+		page_ids = list(page_ids)
+		self._forward_index.remove_many(page_ids)
+		for start in range(0, len(page_ids), QUERY_CHUNK_SIZE):
+			chunk = page_ids[start:start + QUERY_CHUNK_SIZE]
+			self._session.query(Tombstone).filter(Tombstone.page_id.in_(chunk)).delete(synchronize_session=False)
+			self._session.query(ReferenceTracker).filter(ReferenceTracker.page_id.in_(chunk)).delete(
+				synchronize_session=False)
+			self._session.query(PageLinks).filter(PageLinks.id.in_(chunk)).delete(synchronize_session="fetch")
+			self._session.query(PageDocument).filter(PageDocument.doc_id.in_(chunk)).delete(
+				synchronize_session="fetch")
+
+	def _store_documents(self, pages):
+		"""
+		writes the raw content and sections of pages to the DocumentStore, if one is used. They are written after the
+		transaction indexing the pages commits, so that a rolled back batch leaves the records of its pages untouched. A
+		page whose record is missing because the process exited in between is read from the database alone.
+		:param pages: the indexed PageDocuments.
+		:return: None.
+		"""
+		if self._document_store is None:
+			return
+		for data in pages:
+			self._document_store.put(data.doc_id, data.content, encode_sections(data))
+		self._document_store.flush()
+
+	def _require_document_store(self):
+		"""
+		makes sure a DocumentStore is used, as the content and sections of pages are kept nowhere else.
+		:return: None.
+		"""
+		if self._document_store is None:
+			raise DocumentStoreException("the indexer was created without a document directory")
+
+	def _postings(self):
+		"""
+		gets the source of postings for searches.
+		:return: the SegmentIndex if one is used, the ReverseIndex otherwise.
+		"""
+		if self._segment_index is not None:
+			# no cursor of an earlier search is alive at this point, so the segments retired by merges can go
+			self._segment_index.release_retired()
+			return self._segment_index
+		return self._reverse_index
+
+	def _cached_result(self, key):
+		"""
+		gets a cached search result. The whole cache is dropped first if the index changed since it was filled, which
+		is detected through the index generation so that changes made by other processes are seen as well.
+		:param key: the key of the search.
+		:return: the cached tuple of (page id, page rank, score) tuples, or None if it is not cached.
+		"""
+		self._check_generation()
+		return self._query_cache.get(key)
+
+	def _search_results(self, entries, query, snippet_count):
+		"""
+		creates the SearchResult of a search from its cached entries, so that callers never share them with the cache.
+		:param entries: the (page id, page rank, score) tuples of the results.
+		:param query: the parsed query.
+		:param snippet_count: the amount of first results to add a highlighted snippet to.
+		:return: a new list of SearchResult.
+		"""
+		results = [SearchResult(page_id, page_rank, score) for page_id, page_rank, score in entries]
+		if snippet_count > 0:
+			self._add_snippets(results[:snippet_count], query)
+		return results
+
+	def _check_generation(self, force=False):
+		"""
+		drops the cached search results and deleted pages if the index generation changed since they were cached. The
+		index generation is read at most once per generation_check_interval, unless forced after a change made through
+		this indexer.
+		:param force: whether to read the index generation even if it was read recently.
+		:return: None.
+		"""
+		now = time.monotonic()
+		interval = self._generation_check_interval
+		recent = self._generation_checked is not None and now - self._generation_checked < interval
+		if recent and not force:
+			return
+		self._generation_checked = now
+		generation = self._session.query(PageRankStatus.index_generation).filter(
+			PageRankStatus.id == PageRankStatus.SINGLETON_ID).scalar()
+		if generation != self._query_cache_generation:
+			self._query_cache.clear()
+			self._deleted_cache = None
+			self._section_cache.clear()
+			self._query_cache_generation = generation
+
+	def _add_snippets(self, results, query):
+		"""
+		builds the snippets of search results from the hits of the query words on the result pages. Only the hit lists
+		of those pages and the section texts of their records are read, never the raw content, and the section texts
+		are cached per page. Pages without a record keep a snippet of None.
+		:param results: the list of SearchResult to set the snippet of.
+		:param query: the parsed query.
+		:return: None.
+		"""
+		if self._document_store is None or len(results) == 0:
+			return
+		with self._metrics.timer("snippets"):
+			page_ids = [result.page_id for result in results]
+			word_ids = set(self._word_dictionary.lookup_word_ids(query_terms(query)[0]).values())
+			postings = self._postings()
+			hit_lists = {page_id: [] for page_id in page_ids}
+			for word_id in word_ids:
+				for page_id, hits in postings.get_hits(word_id, page_ids).items():
+					hit_lists[page_id].append(hits)
+			for result in results:
+				sections = self._sections(result.page_id)
+				if sections is not None:
+					result.snippet = snippet(sections, hit_lists[result.page_id])
+
+	def _sections(self, page_id):
+		"""
+		gets the section texts of a page from the section cache or its section record in the DocumentStore, which is
+		read without its raw content.
+		:param page_id: the page id.
+		:return: a SectionRecord mapping a hit kind to the section texts of that kind, decoded when read, or None if the
+		page has no record.
+		"""
+		sections = self._section_cache.get(page_id)
+		if sections is None:
+			record = self._document_store.get_sections(page_id)
+			if record is None:
+				return None
+			sections = decode_sections(record)
+			self._section_cache.put(page_id, sections)
+		return sections
+
+	def _deleted_pages(self):
+		"""
+		gets the page ids of the deleted pages, cached until the index generation changes.
+		:return: the set of page ids with a tombstone.
+		"""
+		if self._deleted_cache is None:
+			self._deleted_cache = set(page_id for page_id, in self._session.query(Tombstone.page_id))
+		return self._deleted_cache
+
+	def _page_ranks(self):
+		"""
+		gets the persisted page rank of every page, cached until the page ranks are recalculated. Pages indexed since
+		then have the default rank of 1 - dampener.
+		:return: the PageRanks.
+		"""
+		updated = self._session.query(PageRankStatus.updated).filter(
+			PageRankStatus.id == PageRankStatus.SINGLETON_ID).scalar()
+		if self._rank_cache is None or self._rank_cache[0] != updated:
+			self._rank_cache = (updated, PageRanks.load(self._session, 1 - self._dampener, QUERY_CHUNK_SIZE))
+		return self._rank_cache[1]
+
+	def _page_rank_status(self):
+		"""
+		gets the PageRankStatus row, creating it in the session if the index has none yet.
+		:return: the PageRankStatus.
+		"""
+		status = self._session.query(PageRankStatus).get(PageRankStatus.SINGLETON_ID)
+		if status is None:
+			status = PageRankStatus()
+			self._session.add(status)
+		return status
+
 	def _calculate_page_rank(self):
 		"""
-		calculates page rank iteratively.
+		calculates page rank with power iteration over the whole link graph. The session is not committed.
 		:return: None
 		"""
-		try:
-			for i in range(self._page_rank_iteration):
-				for page_rank in self._session.query(PageRankTracker).all():
-					link_weight = 0
-					random_weight = 1 - self._dampener
-					for referenced_page in self._session.query(ReferenceTracker).filter(
-							ReferenceTracker.url == page_rank.url):
-						other_url = self._session.query(PageUrlMapper.url).filter(
-							PageUrlMapper.id == referenced_page.page_id).one()[0]
-						other_page_rank = self._session.query(PageRankTracker).filter(
-							PageRankTracker.url == other_url).one()
-						link_out_count = \
-							self._session.query(PageLinks.count).filter(PageLinks.id == referenced_page.page_id).one()[
-								0]
-						link_weight += other_page_rank.page_rank / link_out_count
-					link_weight = self._dampener * link_weight
-					page_rank.page_rank = random_weight + link_weight
-					self._session.merge(page_rank)
-			self._session.commit()
-		except SQLAlchemyError as e:
-			raise PageRankPersistException() from e
+		engine = PageRankEngine(self._session, self._dampener, self._page_rank_iteration, self._page_rank_tolerance,
+		                        metrics=self._metrics)
+		engine.run()
+
+	def _update_page_rank(self):
+		"""
+		updates page rank incrementally from the persisted ranks. The session is not committed.
+		:return: None
+		"""
+		engine = PageRankEngine(self._session, self._dampener, self._page_rank_iteration, self._page_rank_tolerance,
+		                        self._page_rank_residual, self._metrics)
+		engine.update()
 
 
 class TestForwardIndex(unittest.TestCase):
@@ -532,24 +1328,22 @@ class TestForwardIndex(unittest.TestCase):
 		                    anchors=anchors, texts=texts, headers=headers)
 		forward_index = ForwardIndex(session, word_dictionary)
 		try:
-			session.add_all(anchors)
-			session.add_all(headers)
-			session.add_all(texts)
-			session.flush()
 			forward_index.index(page)
 			forward_entry = forward_index.get_entry(1)
 			expected_entry = ForwardIndexEntry(1)
 			expected_entry.hits[word_dictionary.get_word_id("test")] = [Hit(Hit.TITLE_HIT, 0, 0)]
 			expected_entry.hits[word_dictionary.get_word_id("page")] = [Hit(Hit.TITLE_HIT, 0, 1)]
-			expected_entry.hits[word_dictionary.get_word_id("Go")] = [Hit(Hit.HEADER_HIT, 1, 0),
-			                                                          Hit(Hit.TEXT_HIT, 1, 0)]
-			expected_entry.hits[word_dictionary.get_word_id("to")] = [Hit(Hit.HEADER_HIT, 1, 1)]
-			expected_entry.hits[word_dictionary.get_word_id("example")] = [Hit(Hit.HEADER_HIT, 1, 2),
-			                                                               Hit(Hit.TEXT_HIT, 1, 2),
-			                                                               Hit(Hit.ANCHOR_HIT, 1, 0)]
-			expected_entry.hits[word_dictionary.get_word_id("with")] = [Hit(Hit.TEXT_HIT, 1, 1)]
+			expected_entry.hits[word_dictionary.get_word_id("Go")] = [Hit(Hit.HEADER_HIT, 0, 0),
+			                                                          Hit(Hit.TEXT_HIT, 0, 0)]
+			expected_entry.hits[word_dictionary.get_word_id("to")] = [Hit(Hit.HEADER_HIT, 0, 1)]
+			expected_entry.hits[word_dictionary.get_word_id("example")] = [Hit(Hit.HEADER_HIT, 0, 2),
+			                                                               Hit(Hit.TEXT_HIT, 0, 2),
+			                                                               Hit(Hit.ANCHOR_HIT, 0, 0)]
+			expected_entry.hits[word_dictionary.get_word_id("with")] = [Hit(Hit.TEXT_HIT, 0, 1)]
 			expected_entry.hits[word_dictionary.get_word_id("https://www.test.com")] = [Hit(Hit.URL_HIT, 0, 0)]
 			self.assertEqual(expected_entry, forward_entry, "Failed to index/retrieve correctly")
+			self.assertEqual({1: expected_entry}, forward_index.get_entries([1, 1, 5]),
+			                 "Failed to retrieve entries in batch")
 		finally:
 			session.close()
 
@@ -576,9 +1370,6 @@ class TestReverseIndex(unittest.TestCase):
 		forward_entry.hits[word_dictionary.get_word_id("example")] = [Hit(Hit.HEADER_HIT, 0, 2),
 		                                                              Hit(Hit.TEXT_HIT, 0, 2),
 		                                                              Hit(Hit.ANCHOR_HIT, 0, 0)]
-		session.add_all(forward_entry.hits[word_dictionary.get_word_id("Go")])
-		session.add_all(forward_entry.hits[word_dictionary.get_word_id("example")])
-		session.commit()
 		reverse_index = ReverseIndex(session)
 		try:
 			reverse_index.index(forward_entry)
@@ -592,6 +1383,8 @@ class TestReverseIndex(unittest.TestCase):
 			                                   Hit(Hit.ANCHOR_HIT, 0, 0)]
 			self.assertEqual(expected_entry_go, reverse_entry_go)
 			self.assertEqual(expected_entry_example, reverse_entries_example)
+			streamed = reverse_index.iter_entry(word_dictionary.get_word_id("go"))
+			self.assertEqual(list(expected_entry_go.pages.items()), list(streamed), "Streamed entry differs")
 		finally:
 			session.close()
 
@@ -605,10 +1398,10 @@ class TestIndexer(unittest.TestCase):
 	def setUp(self):
 		configure("sqlite:///:memory:", connect_args={'check_same_thread': False}, poolclass=StaticPool)
 		Base.metadata.create_all(engine)
+		self.document_directory = tempfile.mkdtemp()
 
-	@staticmethod
-	def load_indexer():
-		indexer = Indexer()
+	def load_indexer(self):
+		indexer = Indexer(document_directory=self.document_directory)
 		return indexer
 
 	@staticmethod
@@ -655,6 +1448,7 @@ class TestIndexer(unittest.TestCase):
 		pages = self.create_simple_multipage_data()
 		for page in pages:
 			indexer.index(page)
+		indexer.update_page_rank()
 		query_result = indexer.search_by_keywords("Page")
 		self.assertEqual(3, len(query_result), "search_by_keywords did not return the pages that it should match")
 		self.assertEqual(3, query_result[0].page_id, "The page Page 1 should be ranked first")
@@ -662,6 +1456,333 @@ class TestIndexer(unittest.TestCase):
 		self.assertEqual(2, query_result[2].page_id, "The page Page 3 should be ranked third")
 		indexer.close()
 
+	def test_boolean_query(self):
+		indexer = self.load_indexer()
+		for page in self.create_simple_multipage_data():
+			indexer.index(page)
+		indexer.update_page_rank()
+		self.assertEqual([3, 1, 2], [result.page_id for result in indexer.search_by_keywords("welcome to page")],
+		                 "AND query should match all pages containing every word")
+		self.assertEqual([1], [result.page_id for result in indexer.search_by_keywords("second ranked")],
+		                 "AND query matched pages missing a word")
+		self.assertEqual([1, 2], [result.page_id for result in indexer.search_by_keywords("second OR third")],
+		                 "OR query should match pages containing any word")
+		self.assertEqual([3], [result.page_id for result in indexer.search_by_keywords("page -references")],
+		                 "NOT query matched excluded pages")
+		self.assertEqual([], indexer.search_by_keywords("page unknownword"), "Unknown word should match nothing")
+		self.assertEqual([3], [result.page_id for result in indexer.search_by_keywords("page (-references -third)")],
+		                 "Excluding group was not applied")
+		self.assertEqual({}, WordDictionary(indexer._session).lookup_word_ids(["unknownword"]),
+		                 "Searching should not add words to the dictionary")
+		indexer.close()
+
+	def test_phrase_query(self):
+		indexer = self.load_indexer()
+		for page in self.create_simple_multipage_data():
+			indexer.index(page)
+		indexer.update_page_rank()
+		self.assertEqual([3, 1, 2], [result.page_id for result in indexer.search_by_keywords('"welcome to page"')],
+		                 "Phrase query failed to match the exact phrase")
+		self.assertEqual([], indexer.search_by_keywords('"page welcome"'), "Phrase query matched the wrong order")
+		self.assertEqual([1, 2], [result.page_id for result in indexer.search_by_keywords('"page one is great"')],
+		                 "Phrase query failed to match the exact phrase")
+		self.assertEqual([1, 2], [result.page_id for result in indexer.search_by_keywords('"great page"~3')],
+		                 "Proximity query failed to match words within the window")
+		self.assertEqual([], indexer.search_by_keywords('"welcome rank"~3'), "Proximity query matched across sections")
+		indexer.close()
+
+	def test_ranked_search(self):
+		indexer = self.load_indexer()
+		for page in self.create_simple_multipage_data():
+			indexer.index(page)
+		indexer.update_page_rank()
+		query_result = indexer.search("page", k=2)
+		self.assertEqual(2, len(query_result), "Ranked search did not limit the results to k")
+		self.assertGreaterEqual(query_result[0].score, query_result[1].score, "Ranked search is not sorted by score")
+		query_result = indexer.search("second third", k=10)
+		self.assertEqual({1, 2}, {result.page_id for result in query_result},
+		                 "Ranked search should match pages containing any keyword")
+		query_result = indexer.search("highest OR second -third", k=10)
+		self.assertEqual([3, 1], [result.page_id for result in query_result], "Ranked search returned the wrong pages")
+		query_result = indexer.search('highest "page 2"', k=10)
+		self.assertEqual({1, 2}, {result.page_id for result in query_result}, "Ranked search ignored the phrase")
+		self.assertEqual([], indexer.search("unknownword"), "Unknown word should match nothing")
+		cursor = PostingRangeCursor(indexer._session, indexer._word_dictionary.get_word_id("page"), 1.0, chunk_size=2)
+		self.assertEqual(1, cursor.page_id())
+		cursor.advance_to(3)
+		self.assertEqual((3, False), (cursor.page_id(), cursor.exhausted()), "Cursor failed to fetch the next range")
+		cursor.next()
+		self.assertTrue(cursor.exhausted())
+		indexer.close()
+
+	def test_index_many(self):
+		indexer = self.load_indexer()
+		page1, page2, page3 = self.create_simple_multipage_data()
+		self.assertEqual(2, indexer.index_many([page1, page2, page1]), "Duplicate pages in a batch were indexed")
+		self.assertEqual(1, indexer.index_many([page2, page3]), "Already indexed pages were indexed again")
+		self.assertEqual(0, indexer.index_many([]), "Empty batch should index nothing")
+		indexer.update_page_rank()
+		self.assertEqual([3, 1, 2], [result.page_id for result in indexer.search_by_keywords("Page")],
+		                 "Bulk indexed pages are ranked differently")
+		self.assertEqual(2, indexer._session.query(ReferenceTracker).filter(ReferenceTracker.page_id == 2).count(),
+		                 "References of bulk indexed pages were not recorded")
+		indexer.close()
+
+	def test_failed_batch(self):
+		indexer = self.load_indexer()
+		page1, page2, page3 = self.create_simple_multipage_data()
+		malformed = PageDocument(doc_id=9, title="Malformed", checksum=b"1", url="https://www.malformed.com",
+		                         texts=[TextSection(None)])
+		with self.assertRaises(AttributeError):
+			indexer.index_many([page1, malformed, page2])
+		self.assertEqual(0, indexer._session.query(PageDocument).count(), "Failed batch left pages in the session")
+		self.assertEqual(1, indexer.index_many([page1]), "Page of a failed batch could not be indexed alone")
+		self.assertEqual([3], [result.page_id for result in indexer.search_by_keywords("page")])
+		indexer.close()
+
+	def test_reindex(self):
+		directory = tempfile.mkdtemp()
+		try:
+			indexer = Indexer(segment_directory=directory, document_directory=self.document_directory)
+			page1, page2, page3 = self.create_simple_multipage_data()
+			indexer.index_many([page1, page2, page3])
+			unchanged = PageDocument(doc_id=7, title="Page 3", checksum=b"09876", url="https://www.page3.com")
+			self.assertEqual(0, indexer.index_many([unchanged]), "Unchanged page was indexed again")
+			changed = PageDocument(doc_id=7, title="Page 3 moved", checksum=b"11111", url="https://www.page3.com",
+			                       texts=[TextSection(text="Relocated content")],
+			                       anchors=[Anchor("Page 1", "https://www.page1.com")])
+			self.assertEqual(1, indexer.index_many([changed]), "Changed page was not indexed again")
+			self.assertEqual(2, changed.doc_id, "Changed page did not keep its page id")
+			self.assertEqual([2], [result.page_id for result in indexer.search_by_keywords("relocated")],
+			                 "Postings of the changed page were not added")
+			self.assertEqual([], indexer.search_by_keywords("third"), "Postings of the changed page were not removed")
+			self.assertEqual([1, 3], sorted(result.page_id for result in indexer.search("welcome")),
+			                 "Postings of the other pages were changed")
+			references = indexer._session.query(ReferenceTracker).filter(ReferenceTracker.page_id == 2).count()
+			self.assertEqual(1, references, "References of the changed page were not replaced")
+			self.assertEqual(3, indexer._session.query(PageRankTracker).count(), "Page ranks were duplicated")
+			indexer.close()
+		finally:
+			shutil.rmtree(directory)
+
+	def test_delete(self):
+		directory = tempfile.mkdtemp()
+		try:
+			indexer = Indexer(segment_directory=directory, segment_flush_size=1,
+			                  document_directory=self.document_directory)
+			page1, page2, page3 = self.create_simple_multipage_data()
+			indexer.index_many([page1, page2, page3])
+			self.assertEqual(3, len(indexer.search_by_keywords("welcome")))
+			self.assertTrue(indexer.delete("https://www.page3.com"), "Page was not deleted by url")
+			self.assertTrue(indexer.delete(1), "Page was not deleted by page id")
+			self.assertFalse(indexer.delete(1), "Page was deleted twice")
+			self.assertFalse(indexer.delete("https://www.unknown.com"), "Unknown page was deleted")
+			self.assertEqual([3], [result.page_id for result in indexer.search_by_keywords("welcome")],
+			                 "Deleted pages were found by a boolean search")
+			self.assertEqual([3], [result.page_id for result in indexer.search("welcome")],
+			                 "Deleted pages were found by a ranked search")
+			self.assertEqual(2, indexer.compact(), "Deleted pages were not compacted")
+			self.assertEqual(0, indexer.tombstone_count(), "Tombstones were not removed")
+			self.assertEqual(0, indexer._session.query(Posting).filter(Posting.page_id.in_([1, 2])).count(),
+			                 "Postings of deleted pages were not removed")
+			self.assertEqual(1, indexer._session.query(PageRankTracker).count(), "Page ranks were not removed")
+			self.assertEqual([3], [result.page_id for result in indexer.search("welcome")],
+			                 "Compaction changed the search results")
+			page3 = PageDocument(doc_id=2, title="Page 3", checksum=b"09876", url="https://www.page3.com")
+			self.assertEqual(1, indexer.index_many([page3]), "Compacted page could not be indexed again")
+			indexer.close()
+		finally:
+			shutil.rmtree(directory)
+
+	def test_document_store(self):
+		directory = tempfile.mkdtemp()
+		try:
+			indexer = Indexer(document_directory=directory, document_garbage=0.2)
+			page1, page2, page3 = self.create_simple_multipage_data()
+			page1.content = b"<html>1</html>"
+			indexer.index_many([page1, page2, page3])
+			indexer.close()
+			indexer = Indexer(document_directory=directory, document_garbage=0.2)
+			document = indexer.get_document(3)
+			self.assertEqual(b"<html>1</html>", document.content, "Content was not read from the document store")
+			self.assertEqual(["Page 1 test"], [header.text for header in document.headers])
+			self.assertEqual("https://www.page1.com", document.url)
+			self.assertEqual(["Page 1"], [anchor.text for anchor in indexer.get_document(1).anchors])
+			self.assertIsNone(indexer.get_document(7), "Unknown page was found")
+			snippets = {result.page_id: result.snippet for result in indexer.search("page 1", snippets=True)}
+			self.assertEqual("Welcome to <b>page</b> <b>1</b> … <b>Page</b> <b>1</b> test", snippets[3],
+			                 "Snippet was not highlighted")
+			self.assertIsNone(indexer.search("page")[0].snippet, "Snippet was added without being asked for")
+			results = indexer.search_by_keywords("page", snippets=True, snippet_count=1)
+			self.assertEqual([True, False, False], [result.snippet is not None for result in results],
+			                 "Snippets were built beyond the first results")
+			indexer.delete(3)
+			self.assertIsNone(indexer.get_document(3), "Deleted page was found")
+			indexer.compact()
+			files = ["CURRENT", "documents-00000001.dat", "documents-00000001.idx", "sections-00000001.dat",
+			         "sections-00000001.idx"]
+			self.assertEqual(files, sorted(os.listdir(directory)), "Document store was not compacted")
+			indexer.close()
+		finally:
+			shutil.rmtree(directory)
+
+	def test_document_store_rollback(self):
+		directory = tempfile.mkdtemp()
+		try:
+			indexer = Indexer(document_directory=directory)
+			page1, page2, page3 = self.create_simple_multipage_data()
+			page1.content = b"<html>1</html>"
+			indexer.index(page1)
+			page1.content, page1.checksum = b"<html>changed</html>", b"54321"
+			session, commit = indexer._session, indexer._session.commit
+
+			def failing_commit():
+				# only the commit of the batch fails, not those of the dictionaries within it
+				if session.transaction.parent is None:
+					raise SQLAlchemyError("commit failed")
+				commit()
+
+			with mock.patch.object(session, "commit", side_effect=failing_commit):
+				with self.assertRaises(BatchIndexException):
+					indexer.index_many([page1, page2])
+			self.assertEqual(b"<html>1</html>", indexer.get_document(3).content,
+			                 "Record of a rolled back batch was kept")
+			self.assertIsNone(indexer._document_store.get(page2.doc_id), "Record of a rolled back page was written")
+			indexer.close()
+		finally:
+			shutil.rmtree(directory)
+
+	def test_parallel_indexer(self):
+		indexer = self.load_indexer()
+		parallel_indexer = ParallelIndexer(indexer, processes=2, batch_size=2, max_pending=1)
+		try:
+			pages = self.create_simple_multipage_data()
+			self.assertEqual(3, parallel_indexer.index(pages + pages), "Parallel indexer indexed duplicate pages")
+		finally:
+			parallel_indexer.close()
+		indexer.update_page_rank()
+		self.assertEqual([3, 1, 2], [result.page_id for result in indexer.search_by_keywords("welcome to page")],
+		                 "Parallel indexed pages are searched differently")
+		self.assertEqual([1, 2], [result.page_id for result in indexer.search_by_keywords('"page one is great"')],
+		                 "Parallel indexer lost the positions of the hits")
+		indexer.close()
+
+	def test_query_cache(self):
+		indexer = self.load_indexer()
+		page1, page2, page3 = self.create_simple_multipage_data()
+		indexer.index_many([page1, page2])
+		indexer.update_page_rank()
+		first = indexer.search_by_keywords("welcome page")
+		self.assertEqual(first, indexer.search_by_keywords("Welcome, PAGE"), "Equivalent queries returned differently")
+		self.assertEqual({"hits": 1, "misses": 1, "size": 1}, indexer.query_cache_statistics(),
+		                 "Equivalent queries were not served from the cache")
+		indexer.search("welcome page", k=1)
+		indexer.search("welcome page", k=2)
+		self.assertEqual(3, indexer.query_cache_statistics()["misses"], "Ranked searches of different k were shared")
+		indexer.index(page3)
+		self.assertEqual(3, len(indexer.search_by_keywords("welcome page")), "Indexing did not invalidate the cache")
+		indexer.update_page_rank()
+		self.assertEqual([3, 1, 2], [result.page_id for result in indexer.search_by_keywords("welcome page")],
+		                 "Page rank update did not invalidate the cache")
+		indexer.search_by_keywords("welcome page")[0].page_id = 7
+		self.assertEqual(3, indexer.search_by_keywords("welcome page")[0].page_id, "Cached result was changed")
+		indexer.close()
+
+	def test_generation_check(self):
+		indexer = Indexer(generation_check_interval=60, document_directory=self.document_directory)
+		other = Indexer(document_directory=os.path.join(self.document_directory, "other"))
+		page1, page2, page3 = self.create_simple_multipage_data()
+		indexer.index_many([page1, page2])
+		self.assertEqual(2, len(indexer.search_by_keywords("welcome")))
+		other.index(page3)
+		self.assertEqual(2, len(indexer.search_by_keywords("welcome")), "Index generation was read again too soon")
+		indexer.delete(1)
+		self.assertEqual({2, 3}, {result.page_id for result in indexer.search_by_keywords("welcome")},
+		                 "Own change did not invalidate the cache")
+		other.close()
+		indexer.close()
+
+	def test_metrics(self):
+		indexer = Indexer(metrics=True, document_directory=self.document_directory)
+		indexer.index_many(self.create_simple_multipage_data())
+		indexer.update_page_rank()
+		indexer.search("page")
+		statistics = indexer.metrics_statistics()
+		for stage in ("index_many", "analyze", "resolve_words", "write_postings", "commit", "page_rank_compute",
+		              "search"):
+			self.assertEqual(1, statistics["stages"][stage]["count"], "Stage {0} was not timed".format(stage))
+		self.assertEqual(3, statistics["counters"]["pages_indexed"])
+		text = indexer.prometheus_metrics()
+		self.assertIn('halindexer_stage_duration_seconds_count{stage="search"} 1\n', text)
+		self.assertIn("halindexer_pages_indexed_total 3\n", text)
+		self.assertIn("halindexer_query_cache_misses 1\n", text)
+		indexer.close()
+		indexer = self.load_indexer()
+		indexer.search("page")
+		self.assertEqual({"stages": {}, "counters": {}}, indexer.metrics_statistics(), "Disabled metrics were recorded")
+		indexer.close()
+
+	def test_page_rank_snapshot(self):
+		indexer = self.load_indexer()
+		self.assertIsNone(indexer.page_rank_age(), "Page rank should not have an age before it is calculated")
+		for page in self.create_simple_multipage_data():
+			indexer.index(page)
+		self.assertTrue(indexer.is_page_rank_stale(), "Indexing pages should mark the page rank as stale")
+		self.assertTrue(indexer.update_page_rank(), "Stale page rank was not recalculated")
+		self.assertFalse(indexer.is_page_rank_stale(), "Recalculated page rank should not be stale")
+		self.assertGreaterEqual(indexer.page_rank_age(), 0, "Recalculated page rank should have an age")
+		self.assertFalse(indexer.update_page_rank(), "Unchanged link graph should not be recalculated")
+		self.assertTrue(indexer.update_page_rank(force=True), "Forced page rank update was skipped")
+		indexer.close()
+
+	def test_incremental_page_rank(self):
+		indexer = self.load_indexer()
+		page1, page2, page3 = self.create_simple_multipage_data()
+		indexer.index(page1)
+		indexer.index(page2)
+		indexer.update_page_rank()
+		indexer.index(page3)
+		self.assertTrue(indexer.update_page_rank(incremental=True), "Incremental page rank update was skipped")
+		self.assertFalse(indexer.is_page_rank_stale(), "Incremental page rank update should refresh the snapshot")
+		query_result = indexer.search_by_keywords("Page")
+		self.assertEqual([3, 1, 2], [result.page_id for result in query_result],
+		                 "Incremental page rank update produced the wrong order")
+		indexer.close()
+
+	def test_segments(self):
+		directory = tempfile.mkdtemp()
+		try:
+			indexer = Indexer(segment_directory=directory, segment_flush_size=2,
+			                  document_directory=self.document_directory)
+			for page in self.create_simple_multipage_data():
+				indexer.index(page)
+			indexer.update_page_rank()
+			query_result = indexer.search_by_keywords("Page")
+			self.assertEqual([3, 1, 2], [result.page_id for result in query_result],
+			                 "Search over segments returned the wrong pages")
+			indexer.rebuild_segments()
+			query_result = indexer.search_by_keywords("welcome")
+			self.assertEqual(3, len(query_result), "Rebuilt segments lost postings")
+			indexer.close()
+		finally:
+			shutil.rmtree(directory)
+
+	def test_segment_recovery(self):
+		directory = tempfile.mkdtemp()
+		try:
+			indexer = Indexer(segment_directory=directory, segment_flush_size=10,
+			                  document_directory=self.document_directory)
+			for page in self.create_simple_multipage_data():
+				indexer.index(page)
+			# the process exits before the in memory segment is flushed
+			indexer._segment_index.stop_merging()
+			indexer = Indexer(segment_directory=directory, document_directory=self.document_directory)
+			query_result = indexer.search_by_keywords("welcome")
+			self.assertEqual(3, len(query_result), "Unflushed postings were not recovered")
+			indexer.close()
+		finally:
+			shutil.rmtree(directory)
+
 	def test_persistence(self):
 		indexer = self.load_indexer()
 		page = PageDocument(doc_id=1, title="Test persistence", checksum=b"3782",
@@ -674,8 +1795,18 @@ class TestIndexer(unittest.TestCase):
 		self.assertEqual(1, query_result[0].page_id, "Failed to maintain integrity")
 		indexer.close()
 
+	def test_missing_document_store(self):
+		indexer = Indexer()
+		with self.assertRaises(DocumentStoreException, msg="Content was discarded without a document store"):
+			indexer.index_many(self.create_simple_multipage_data())
+		with self.assertRaises(DocumentStoreException):
+			indexer.get_document(3)
+		self.assertEqual([], indexer.search_by_keywords("page"), "Searching should not need a document store")
+		indexer.close()
+
 	def tearDown(self):
 		cleanup()
+		shutil.rmtree(self.document_directory)
 
 
 class TestWordDictionary(unittest.TestCase):
@@ -709,6 +1840,47 @@ class TestWordDictionary(unittest.TestCase):
 		self.assertEqual(1, dictionary.get_word_id(".lexicon"), "Dictionary failed punctuation identification")
 		session.close()
 
+	def test_bulk_word_to_id(self):
+		session = Session()
+		dictionary = WordDictionary(session, cache_size=2)
+		existing_id = dictionary.get_word_id("bulk")
+		word_ids = dictionary.get_word_ids(["Bulk", "bulk,", "resolve", "many", "Many"])
+		self.assertEqual(existing_id, word_ids["Bulk"], "Dictionary failed bulk retrieval of an existing word")
+		self.assertEqual(existing_id, word_ids["bulk,"], "Dictionary failed bulk punctuation identification")
+		self.assertEqual(word_ids["many"], word_ids["Many"], "Dictionary failed bulk capitalization identification")
+		self.assertNotEqual(word_ids["resolve"], word_ids["many"], "Dictionary assigned the same id twice")
+		self.assertEqual(word_ids["resolve"], dictionary.get_word_id("resolve"),
+		                 "Dictionary failed to persist bulk words")
+		self.assertEqual(word_ids["many"], dictionary.get_word_id("many"), "Dictionary failed to persist bulk words")
+		session.close()
+
+	@classmethod
+	def tearDownClass(cls):
+		cleanup()
+
+
+class TestUrlDictionary(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		configure("sqlite:///:memory:")
+		Base.metadata.create_all(engine)
+
+	def test_url_to_id(self):
+		session = Session()
+		dictionary = UrlDictionary(session, cache_size=1)
+		url_ids = dictionary.get_url_ids(["https://www.a.com", "https://www.b.com", "https://www.a.com"])
+		self.assertEqual(2, len(set(url_ids.values())), "Dictionary failed to intern urls")
+		self.assertEqual(url_ids, dictionary.get_url_ids(["https://www.a.com", "https://www.b.com"]),
+		                 "Dictionary assigned a new id to a known url")
+		self.assertEqual({"https://www.b.com": url_ids["https://www.b.com"]},
+		                 dictionary.lookup_url_ids(["https://www.b.com", "https://www.c.com"]),
+		                 "Lookup added a missing url")
+		self.assertEqual(1, session.query(UrlDictionaryEntry).filter(
+			UrlDictionaryEntry.url_hash == url_hash("https://www.a.com")).count(), "Url was stored twice")
+		dictionary.close()
+		session.close()
+
 	@classmethod
 	def tearDownClass(cls):
 		cleanup()
@@ -0,0 +1,452 @@
+import asyncio
+import concurrent.futures
+import json
+import logging
+import time
+import unittest
+
+from index.analysis import analyze_sections
+from index.analysis import document_sections
+from index.entry import Anchor
+from index.entry import Header
+from index.entry import PageDocument
+from index.entry import TextSection
+from index.exceptions import IndexerException
+
+# the minimum amount of seconds between two page rank updates while crawled pages keep arriving
+PAGE_RANK_INTERVAL = 300
+# the amount of seconds after which a full page rank calculation replaces the incremental updates
+PAGE_RANK_FULL_INTERVAL = 6 * 60 * 60
+# the minimum amount of seconds between two compactions while deleted pages are waiting
+COMPACTION_INTERVAL = 60 * 60
+# the amount of deleted pages that are compacted right away, without waiting for the compaction interval
+COMPACTION_THRESHOLD = 10000
+# the stages of the IngestionPipeline, in order. Each stage reads from the queue of its name.
+STAGES = ("decode", "construct", "analyze", "resolve", "persist")
+logger = logging.getLogger(__name__)
+# marks the end of the messages in the queues of the IngestionPipeline
+_END = object()
+# the errors a malformed message raises while it is decoded, constructed or analyzed
+MALFORMED_ERRORS = (ValueError, KeyError, TypeError, AttributeError)
+# the errors of a page that failed to index, those of the Indexer and those of analyzing a malformed page
+INDEX_ERRORS = (IndexerException,) + MALFORMED_ERRORS
+
+
+def crawled_document(crawled_raw):
+	"""
+	converts a decoded message sent by the crawler to a PageDocument.
+	:param crawled_raw: the dictionary decoded from the json body of the message.
+	:return: the PageDocument.
+	"""
+	crawled = PageDocument()
+	crawled.doc_id = crawled_raw["id"]
+	crawled.url = crawled_raw["url"]
+	for anchor in crawled_raw["anchors"]:
+		crawled.anchors.append(Anchor(anchor["anchorText"], anchor["targetURL"]))
+	for text in crawled_raw["text-sections"]:
+		crawled.texts.append(TextSection(text))
+	for header in crawled_raw["headers"]:
+		crawled.headers.append(Header(text=header["text"]))
+	crawled.title = crawled_raw["title"]
+	crawled.checksum = crawled_raw["checksum"].encode("utf8")
+	crawled.content = crawled_raw["content"].encode("utf8")
+	return crawled
+
+
+class IndexMaintenance:
+	"""
+	Runs the periodic maintenance of an index between batches: updating the page rank and compacting the deleted pages.
+	It keeps the times of the last full page rank calculation and of the last compaction, so each indexer needs its
+	own IndexMaintenance. The Indexer is not thread safe, so the maintenance is meant to run between batches on the
+	thread writing them.
+	"""
+
+	def __init__(self):
+		"""
+		creates a new IndexMaintenance, which calculates the page rank in full and compacts on its first run.
+		"""
+		self._last_full = 0
+		self._last_compaction = 0
+
+	def maintain(self, indexer):
+		"""
+		runs refresh_page_rank and compact_tombstones.
+		:param indexer: the indexer to maintain.
+		:return: None.
+		"""
+		self.refresh_page_rank(indexer)
+		self.compact_tombstones(indexer)
+
+	def refresh_page_rank(self, indexer):
+		"""
+		updates the page rank if new pages were indexed and the current ranks are older than PAGE_RANK_INTERVAL. The
+		update is incremental, except for every PAGE_RANK_FULL_INTERVAL seconds when the ranks are calculated from
+		scratch.
+		:param indexer: the indexer to update.
+		:return: None.
+		"""
+		age = indexer.page_rank_age()
+		if indexer.is_page_rank_stale() and (age is None or age >= PAGE_RANK_INTERVAL):
+			now = time.time()
+			incremental = now - self._last_full < PAGE_RANK_FULL_INTERVAL
+			logger.info("Updating page rank (%s)", "incremental" if incremental else "full")
+			indexer.update_page_rank(incremental=incremental)
+			if not incremental:
+				self._last_full = now
+
+	def compact_tombstones(self, indexer):
+		"""
+		compacts the deleted pages once COMPACTION_THRESHOLD of them are waiting, or COMPACTION_INTERVAL seconds after
+		the last compaction.
+		:param indexer: the indexer to compact.
+		:return: None.
+		"""
+		count = indexer.tombstone_count()
+		now = time.time()
+		if count != 0 and (count >= COMPACTION_THRESHOLD or now - self._last_compaction >= COMPACTION_INTERVAL):
+			logger.info("Compacting %d deleted pages", count)
+			indexer.compact()
+			self._last_compaction = now
+
+
+class IngestionPipeline:
+	"""
+	Indexes crawled pages in stages connected by bounded asyncio queues: decoding the message, constructing the
+	PageDocument, analyzing its text in a process pool, resolving its words to word ids and persisting it. Every
+	database access runs on a single thread, because the Indexer is not thread safe. When a stage falls behind, the
+	queue in front of it fills up and the stages before it wait, until the pipeline stops taking messages from its
+	source, so memory stays bounded by the queue sizes.
+	"""
+
+	def __init__(self, indexer, batch_size=100, queue_size=1000, analysis_executor=None, after_batch=None):
+		"""
+		creates a new IngestionPipeline.
+		:param indexer: the Indexer to index the pages with.
+		:param batch_size: the maximum amount of pages analyzed, resolved and persisted together.
+		:param queue_size: the maximum amount of items waiting in front of each stage.
+		:param analysis_executor: the executor to analyze pages in, or None for a process pool with one process per
+		core.
+		:param after_batch: a function called with the Indexer on the database thread after each persisted batch, such
+		as IndexMaintenance.maintain, or None.
+		"""
+		self._indexer = indexer
+		self._batch_size = batch_size
+		self._queue_size = queue_size
+		self._analysis_executor = analysis_executor
+		self._after_batch = after_batch
+		self._database_executor = None
+		self._queues = {}
+
+	def depths(self):
+		"""
+		gets the amount of items waiting in front of each stage. The resolve and persist stages receive whole batches.
+		:return: a dictionary mapping the name of each stage to the size of its queue.
+		"""
+		return {name: queue.qsize() for name, queue in self._queues.items()}
+
+	async def run(self, messages, report_interval=None):
+		"""
+		indexes messages until the source is exhausted. Each message is acknowledged once its page is persisted.
+		Messages that are not valid crawled pages are rejected, and messages of pages that failed to persist are
+		requeued. If a stage or the source fails, the other stages are cancelled and the error is raised, rather than
+		leaving the source waiting on a full queue.
+		:param messages: an async iterable of (body, acknowledge) tuples, where acknowledge is a coroutine function
+		taking a success flag and a requeue flag.
+		:param report_interval: the amount of seconds between logging the queue depths, or None to not report.
+		:return: None.
+		"""
+		loop = asyncio.get_running_loop()
+		self._queues = {name: asyncio.Queue(self._queue_size) for name in STAGES}
+		self._database_executor = concurrent.futures.ThreadPoolExecutor(1)
+		analysis_executor = self._analysis_executor or concurrent.futures.ProcessPoolExecutor()
+		stages = [self._run_stage("decode", "construct", self._decode),
+		          self._run_stage("construct", "analyze", self._construct),
+		          self._run_batch_stage("analyze", "resolve", self._analyze, analysis_executor),
+		          self._resolve(),
+		          self._persist()]
+		tasks = [loop.create_task(stage) for stage in [self._read(messages)] + stages]
+		reporter = loop.create_task(self._report(report_interval)) if report_interval is not None else None
+		try:
+			done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+			for task in done:
+				task.result()
+		finally:
+			for task in tasks:
+				task.cancel()
+			if reporter is not None:
+				reporter.cancel()
+			self._database_executor.shutdown()
+			if self._analysis_executor is None:
+				analysis_executor.shutdown()
+
+	async def _read(self, messages):
+		"""
+		feeds the messages of the source to the decode stage, followed by the end marker.
+		:param messages: the async iterable of (body, acknowledge) tuples.
+		:return: None.
+		"""
+		async for body, acknowledge in messages:
+			await self._queues["decode"].put((acknowledge, body))
+		await self._queues["decode"].put(_END)
+
+	async def _run_stage(self, name, next_name, work):
+		"""
+		runs a stage that handles one item at a time. Items the work fails on are rejected.
+		:param name: the name of the stage.
+		:param next_name: the name of the next stage.
+		:param work: the function converting the payload of an item.
+		:return: None.
+		"""
+		source, target = self._queues[name], self._queues[next_name]
+		while True:
+			item = await source.get()
+			if item is _END:
+				await target.put(_END)
+				return
+			acknowledge, payload = item
+			try:
+				payload = work(payload)
+			except MALFORMED_ERRORS as e:
+				logger.warning("Rejected malformed message: %s", e)
+				await acknowledge(False, False)
+				continue
+			await target.put((acknowledge, payload))
+
+	async def _run_batch_stage(self, name, next_name, work, executor):
+		"""
+		runs a stage that handles the items waiting in its queue in batches of up to batch_size in an executor, and
+		passes each batch on as a single item. Batches left empty by the work are not passed on.
+		:param name: the name of the stage.
+		:param next_name: the name of the next stage.
+		:param work: a coroutine function taking the executor and a batch and returning the batch for the next stage.
+		:param executor: the executor to run the blocking work in.
+		:return: None.
+		"""
+		source, target = self._queues[name], self._queues[next_name]
+		finished = False
+		while not finished:
+			batch = []
+			item = await source.get()
+			while item is not _END:
+				batch.append(item)
+				if len(batch) >= self._batch_size or source.empty():
+					break
+				item = source.get_nowait()
+			finished = item is _END
+			if len(batch) != 0:
+				batch = await work(executor, batch)
+			if len(batch) != 0:
+				await target.put(batch)
+		await target.put(_END)
+
+	@staticmethod
+	def _decode(body):
+		return json.loads(body)
+
+	@staticmethod
+	def _construct(crawled_raw):
+		page = crawled_document(crawled_raw)
+		return page, document_sections(page)
+
+	async def _analyze(self, executor, batch):
+		"""
+		analyzes a batch of pages, spread over the executor. Pages the analysis fails on are rejected and left out.
+		:param executor: the executor to analyze in.
+		:param batch: a list of (acknowledge, (page, sections)) items.
+		:return: the batch as a list of (acknowledge, (page, analysis)) items.
+		"""
+		loop = asyncio.get_running_loop()
+		analyses = await asyncio.gather(
+			*[loop.run_in_executor(executor, analyze_sections, sections) for _, (_, sections) in batch],
+			return_exceptions=True)
+		analyzed = []
+		for (acknowledge, (page, _)), analysis in zip(batch, analyses):
+			if isinstance(analysis, MALFORMED_ERRORS):
+				logger.warning("Rejected malformed message: %s", analysis)
+				await acknowledge(False, False)
+			elif isinstance(analysis, BaseException):
+				raise analysis
+			else:
+				analyzed.append((acknowledge, (page, analysis)))
+		return analyzed
+
+	async def _resolve(self):
+		"""
+		runs the resolve stage, which resolves the words of each batch to word ids ahead of persisting it, so that the
+		write transaction finds them in the word cache. If this fails, persisting resolves the words again.
+		:return: None.
+		"""
+		loop = asyncio.get_running_loop()
+		source, target = self._queues["resolve"], self._queues["persist"]
+		while True:
+			batch = await source.get()
+			if batch is _END:
+				await target.put(_END)
+				return
+			words = set()
+			for _, (_, analysis) in batch:
+				words.update(analysis.keys())
+			try:
+				await loop.run_in_executor(self._database_executor, self._indexer.resolve_words, words)
+			except IndexerException as e:
+				logger.warning("Failed to resolve words: %s", e)
+			await target.put(batch)
+
+	async def _persist(self):
+		"""
+		runs the persist stage, which writes each batch with Indexer.index_many and acknowledges its messages. If a
+		batch fails, its pages are written again one at a time, so that only the pages failing on their own are
+		requeued and a bad page cannot take the good pages of its batch down with it.
+		:return: None.
+		"""
+		loop = asyncio.get_running_loop()
+		source = self._queues["persist"]
+		while True:
+			batch = await source.get()
+			if batch is _END:
+				return
+			pages = [page for _, (page, _) in batch]
+			analyses = [analysis for _, (_, analysis) in batch]
+			try:
+				await loop.run_in_executor(self._database_executor, self._indexer.index_many, pages, analyses)
+			except INDEX_ERRORS as e:
+				logger.warning("Failed to index batch of %d pages: %s", len(batch), e)
+				for acknowledge, (page, analysis) in batch:
+					try:
+						await loop.run_in_executor(self._database_executor, self._indexer.index_many, [page],
+						                           [analysis])
+					except INDEX_ERRORS as e:
+						logger.warning("Failed to index %s: %s", page.url, e)
+						await acknowledge(False, True)
+						continue
+					await acknowledge(True, False)
+			else:
+				for acknowledge, _ in batch:
+					await acknowledge(True, False)
+			if self._after_batch is not None:
+				await loop.run_in_executor(self._database_executor, self._after_batch, self._indexer)
+
+	async def _report(self, interval):
+		"""
+		logs the queue depths of the stages every interval seconds.
+		:param interval: the amount of seconds between reports.
+		:return: None.
+		"""
+		while True:
+			await asyncio.sleep(interval)
+			depths = self.depths()
+			logger.info("Queue depths: %s", ", ".join("{0}={1}".format(name, depth) for name, depth in depths.items()))
+
+
+class TestIngestionPipeline(unittest.TestCase):
+
+	class FakeIndexer:
+
+		def __init__(self):
+			self.batches = []
+			self.words = set()
+
+		def resolve_words(self, words):
+			self.words.update(words)
+
+		def index_many(self, pages, analyses):
+			if any(page.url == "https://www.fail.com" for page in pages):
+				raise IndexerException("fail")
+			self.batches.append([page.url for page in pages])
+
+	@staticmethod
+	def message(url, title="Title"):
+		return json.dumps({"id": 1, "url": url, "anchors": [{"anchorText": "Next", "targetURL": "https://www.b.com"}],
+		                   "text-sections": ["Some text"], "headers": [{"text": "Header"}], "title": title,
+		                   "checksum": "1", "content": "<html></html>"})
+
+	def test_pipeline(self):
+		indexer = self.FakeIndexer()
+		outcomes = {}
+		bodies = [self.message("https://www.a.com/" + str(number)) for number in range(7)]
+		bodies.append("not json")
+		bodies.append(self.message("https://www.fail.com"))
+
+		async def messages():
+			for number, body in enumerate(bodies):
+				async def acknowledge(success, requeue, number=number):
+					outcomes[number] = (success, requeue)
+
+				yield body, acknowledge
+
+		pipeline = IngestionPipeline(indexer, batch_size=3, queue_size=2,
+		                             analysis_executor=concurrent.futures.ThreadPoolExecutor(2))
+		asyncio.run(pipeline.run(messages()))
+		indexed = [url for batch in indexer.batches for url in batch]
+		requeued = [number for number, outcome in outcomes.items() if outcome == (False, True)]
+		self.assertEqual(["https://www.a.com/" + str(number) for number in range(7) if number not in requeued],
+		                 indexed, "Pipeline lost or reordered pages")
+		self.assertTrue(all(len(batch) <= 3 for batch in indexer.batches), "Pipeline exceeded the batch size")
+		self.assertEqual(len(bodies), len(outcomes), "Not every message was acknowledged")
+		self.assertEqual((False, False), outcomes[7], "Malformed message was not rejected")
+		self.assertEqual([8], requeued, "Only the failing page of a batch should be requeued")
+		self.assertIn("header", indexer.words, "Words were not resolved ahead of persisting")
+
+	def test_stage_failure(self):
+		indexer = self.FakeIndexer()
+		outcomes = {}
+		bodies = [self.message("https://www.a.com/1"), self.message("https://www.a.com/2", title=None),
+		          self.message("https://www.a.com/3")]
+
+		async def messages():
+			for number, body in enumerate(bodies):
+				async def acknowledge(success, requeue, number=number):
+					outcomes[number] = (success, requeue)
+
+				yield body, acknowledge
+
+		pipeline = IngestionPipeline(indexer, batch_size=3, queue_size=1,
+		                             analysis_executor=concurrent.futures.ThreadPoolExecutor(2))
+		asyncio.run(asyncio.wait_for(pipeline.run(messages()), 10))
+		self.assertEqual({0: (True, False), 1: (False, False), 2: (True, False)}, outcomes,
+		                 "Only the malformed page should be rejected")
+
+		def fail(words):
+			raise RuntimeError("resolve failed")
+
+		indexer.resolve_words = fail
+		bodies = [self.message("https://www.a.com/" + str(number)) for number in range(20)]
+		with self.assertRaises(RuntimeError, msg="Failure of a stage was not raised"):
+			asyncio.run(asyncio.wait_for(pipeline.run(messages()), 10))
+
+
+class TestIndexMaintenance(unittest.TestCase):
+
+	class FakeIndexer:
+
+		def __init__(self):
+			self.updates = []
+			self.compactions = 0
+
+		@staticmethod
+		def page_rank_age():
+			return None
+
+		@staticmethod
+		def is_page_rank_stale():
+			return True
+
+		def update_page_rank(self, incremental):
+			self.updates.append(incremental)
+
+		@staticmethod
+		def tombstone_count():
+			return 1
+
+		def compact(self):
+			self.compactions += 1
+
+	def test_maintain(self):
+		indexer, other = self.FakeIndexer(), self.FakeIndexer()
+		maintenance = IndexMaintenance()
+		maintenance.maintain(indexer)
+		maintenance.maintain(indexer)
+		self.assertEqual([False, True], indexer.updates, "Page rank was not calculated in full first")
+		self.assertEqual(1, indexer.compactions, "Compaction ignored the interval")
+		IndexMaintenance().maintain(other)
+		self.assertEqual(([False], 1), (other.updates, other.compactions), "Maintenance shared its timers")
@@ -0,0 +1,235 @@
+import bisect
+import time
+import unittest
+
+# the upper bounds in seconds of the buckets of the stage histograms, from half a millisecond to a minute
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 60.0)
+# the quantiles estimated by Histogram.statistics
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class Histogram:
+	"""
+	A histogram of observed values over fixed buckets, like the histograms of Prometheus. The sum, count and maximum of
+	the values are kept as well, and quantiles are estimated as the upper bound of the bucket they fall into.
+	"""
+
+	def __init__(self, buckets=DEFAULT_BUCKETS):
+		"""
+		creates a new Histogram.
+		:param buckets: the ascending upper bounds of the buckets. Values above the last bound are only counted in the
+		implicit +Inf bucket.
+		"""
+		self.buckets = tuple(buckets)
+		self.counts = [0] * (len(self.buckets) + 1)
+		self.count = 0
+		self.sum = 0.0
+		self.max = 0.0
+
+	def observe(self, value):
+		"""
+		adds a value to the histogram.
+		:param value: the value.
+		:return: None.
+		"""
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.count += 1
+		self.sum += value
+		if value > self.max:
+			self.max = value
+
+	def quantile(self, quantile):
+		"""
+		estimates a quantile of the observed values.
+		:param quantile: the quantile, from 0 to 1.
+		:return: the upper bound of the bucket holding the quantile, the maximum if it is in the +Inf bucket, or None
+		if nothing was observed.
+		"""
+		if self.count == 0:
+			return None
+		rank = quantile * self.count
+		cumulative = 0
+		for bound, count in zip(self.buckets, self.counts):
+			cumulative += count
+			if cumulative >= rank:
+				return min(bound, self.max)
+		return self.max
+
+	def statistics(self):
+		"""
+		summarizes the histogram.
+		:return: a dictionary of the count, sum, mean and maximum of the values and the estimated quantiles.
+		"""
+		result = {"count": self.count, "sum": self.sum, "mean": self.sum / self.count if self.count else None,
+		          "max": self.max}
+		for quantile in QUANTILES:
+			result["p{0:g}".format(quantile * 100)] = self.quantile(quantile)
+		return result
+
+
+class Timer:
+	"""
+	A context manager observing the seconds spent in its block in a Histogram.
+	"""
+
+	__slots__ = ("_histogram", "_start")
+
+	def __init__(self, histogram):
+		self._histogram = histogram
+		self._start = None
+
+	def __enter__(self):
+		self._start = time.perf_counter()
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self._histogram.observe(time.perf_counter() - self._start)
+		return False
+
+
+class NullTimer:
+	"""
+	A context manager doing nothing, used in place of a Timer when metrics are disabled.
+	"""
+
+	__slots__ = ()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Metrics:
+	"""
+	Collects the durations of the stages of indexing, searching and page rank calculation in histograms, and counts
+	events such as indexed pages or written postings. When disabled, timer hands out a shared context manager that
+	does nothing and increment returns right away, so instrumented code pays about one method call per stage. Like the
+	Indexer, it is not thread safe.
+	"""
+
+	def __init__(self, enabled=True, buckets=DEFAULT_BUCKETS):
+		"""
+		creates a new Metrics.
+		:param enabled: whether to record anything.
+		:param buckets: the upper bounds in seconds of the buckets of the stage histograms.
+		"""
+		self.enabled = enabled
+		self._buckets = buckets
+		self._stages = {}
+		self._counters = {}
+
+	def timer(self, stage):
+		"""
+		times a stage.
+		:param stage: the name of the stage.
+		:return: a context manager observing the duration of its block in the histogram of the stage.
+		"""
+		if not self.enabled:
+			return NULL_TIMER
+		histogram = self._stages.get(stage)
+		if histogram is None:
+			histogram = self._stages[stage] = Histogram(self._buckets)
+		return Timer(histogram)
+
+	def increment(self, counter, amount=1):
+		"""
+		adds to a counter.
+		:param counter: the name of the counter.
+		:param amount: the amount to add.
+		:return: None.
+		"""
+		if not self.enabled:
+			return
+		self._counters[counter] = self._counters.get(counter, 0) + amount
+
+	def reset(self):
+		"""
+		drops everything recorded so far.
+		:return: None.
+		"""
+		self._stages.clear()
+		self._counters.clear()
+
+	def statistics(self):
+		"""
+		gets everything recorded so far.
+		:return: a dictionary with a "stages" dictionary mapping each stage to the statistics of its histogram in
+		seconds, see Histogram.statistics, and a "counters" dictionary mapping each counter to its value.
+		"""
+		return {"stages": {stage: histogram.statistics() for stage, histogram in sorted(self._stages.items())},
+		        "counters": dict(sorted(self._counters.items()))}
+
+	def prometheus(self, prefix="halindexer"):
+		"""
+		dumps everything recorded so far in the Prometheus text exposition format. The stages share one histogram
+		family labelled by stage, and each counter is a counter family of its own.
+		:param prefix: the prefix of the metric names.
+		:return: the text.
+		"""
+		lines = []
+		if len(self._stages) != 0:
+			name = prefix + "_stage_duration_seconds"
+			lines.append("# HELP {0} Time spent in a stage of the indexer.".format(name))
+			lines.append("# TYPE {0} histogram".format(name))
+			for stage, histogram in sorted(self._stages.items()):
+				cumulative = 0
+				for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+					cumulative += count
+					lines.append('{0}_bucket{{stage="{1}",le="{2}"}} {3}'.format(name, stage, _format_bound(bound),
+					                                                             cumulative))
+				lines.append('{0}_sum{{stage="{1}"}} {2!r}'.format(name, stage, histogram.sum))
+				lines.append('{0}_count{{stage="{1}"}} {2}'.format(name, stage, histogram.count))
+		for counter, value in sorted(self._counters.items()):
+			name = "{0}_{1}_total".format(prefix, counter)
+			lines.append("# TYPE {0} counter".format(name))
+			lines.append("{0} {1}".format(name, value))
+		return "".join(line + "\n" for line in lines)
+
+
+def _format_bound(bound):
+	return "+Inf" if bound == float("inf") else repr(bound)
+
+
+# the Metrics used by components that are not given one, which records nothing
+DISABLED = Metrics(enabled=False)
+
+
+class TestMetrics(unittest.TestCase):
+
+	def test_histogram(self):
+		histogram = Histogram(buckets=(1, 2, 5))
+		for value in (0.5, 1, 1.5, 3, 8):
+			histogram.observe(value)
+		self.assertEqual([2, 1, 1, 1], histogram.counts, "Values were put in the wrong buckets")
+		self.assertEqual(14, histogram.sum)
+		self.assertEqual(2, histogram.quantile(0.5))
+		self.assertEqual(8, histogram.quantile(0.99), "Quantile beyond the last bucket is not the maximum")
+		self.assertIsNone(Histogram().quantile(0.5))
+
+	def test_metrics(self):
+		metrics = Metrics(buckets=(0.5, 1))
+		with metrics.timer("commit"):
+			pass
+		metrics.increment("pages_indexed", 3)
+		statistics = metrics.statistics()
+		self.assertEqual(1, statistics["stages"]["commit"]["count"])
+		self.assertEqual({"pages_indexed": 3}, statistics["counters"])
+		text = metrics.prometheus()
+		self.assertIn('halindexer_stage_duration_seconds_bucket{stage="commit",le="0.5"} 1\n', text)
+		self.assertIn('halindexer_stage_duration_seconds_bucket{stage="commit",le="+Inf"} 1\n', text)
+		self.assertIn('halindexer_stage_duration_seconds_count{stage="commit"} 1\n', text)
+		self.assertIn("halindexer_pages_indexed_total 3\n", text)
+
+	def test_disabled(self):
+		metrics = Metrics(enabled=False)
+		with metrics.timer("commit"):
+			pass
+		metrics.increment("pages_indexed")
+		self.assertIs(NULL_TIMER, metrics.timer("commit"))
+		self.assertEqual({"stages": {}, "counters": {}}, metrics.statistics())
+		self.assertEqual("", metrics.prometheus())
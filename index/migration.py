@@ -0,0 +1,600 @@
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import sqlalchemy as sa
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from index.docstore import DocumentStore
+from index.docstore import decode_document
+from index.docstore import encode_sections
+from index.entry import Anchor
+from index.entry import Base
+from index.entry import Header
+from index.entry import Hit
+from index.entry import PageDocument
+from index.entry import PageRankTracker
+from index.entry import PageUrlMapper
+from index.entry import Posting
+from index.entry import ReferenceTracker
+from index.entry import SchemaVersion
+from index.entry import TextSection
+from index.entry import UrlDictionaryEntry
+from index.entry import WordDictionaryEntry
+from index.entry import url_hash
+from index.exceptions import MigrationException
+from index.posting import decode_hits
+from index.posting import encode_hits
+from index.ranking import hit_weight
+
+# the amount of rows converted at once by data migrations
+MIGRATION_CHUNK_SIZE = 1000
+# the tables of the schema before postings, replaced by the Posting table
+LEGACY_TABLES = ("LexiconMapper", "PageHitMapper", "WordHitMapper", "ForwardMapper", "Hit")
+# the tables of the sections before the DocumentStore, with the kind of their hits, their columns and the attribute of
+# PageDocument they are loaded into
+SECTION_TABLES = {"Header": (Hit.HEADER_HIT, ("id", "doc_id", "text", "size"), "headers"),
+                  "TextSection": (Hit.TEXT_HIT, ("id", "doc_id", "text"), "texts"),
+                  "Anchor": (Hit.ANCHOR_HIT, ("id", "doc_id", "text", "url"), "anchors")}
+
+
+def _has_column(connection, table, column):
+	return column in [info["name"] for info in sa.inspect(connection).get_columns(table)]
+
+
+def _create_index(connection, table, name, *columns):
+	"""
+	creates an index unless a table already has an index of that name or does not exist.
+	:param connection: the connection to the database.
+	:param table: the name of the table.
+	:param name: the name of the index.
+	:param columns: the names of the indexed columns.
+	:return: None.
+	"""
+	inspector = sa.inspect(connection)
+	if table not in inspector.get_table_names() or name in [info["name"] for info in inspector.get_indexes(table)]:
+		return
+	table = sa.Table(table, sa.MetaData(), *[sa.Column(column) for column in columns])
+	sa.Index(name, *[table.c[column] for column in columns]).create(connection)
+
+
+def _read_chunks(connection, table, key_columns, columns):
+	"""
+	reads the rows of a table in chunks of MIGRATION_CHUNK_SIZE rows. The chunks are paginated by key rather than by
+	offset, so that each one is a range seek on the key and only one chunk is held in memory at a time. Rows of the
+	chunks already read may be updated in between, as long as their keys are not.
+	:param connection: the connection to the database.
+	:param table: the table.
+	:param key_columns: the names of the columns of a unique key of the table.
+	:param columns: the names of the columns to read, including the key columns.
+	:return: an iterator of lists of rows.
+	"""
+	keys = [table.c[column] for column in key_columns]
+	last = None
+	while True:
+		query = sa.select([table.c[column] for column in columns]).order_by(*keys).limit(MIGRATION_CHUNK_SIZE)
+		if last is not None:
+			# the rows whose key sorts after the last key read, (a, b) > (x, y) spelled out for every database
+			query = query.where(sa.or_(*[sa.and_(*[key == value for key, value in zip(keys[:position], last)],
+			                                     keys[position] > last[position]) for position in range(len(keys))]))
+		rows = connection.execute(query).fetchall()
+		if len(rows) == 0:
+			return
+		yield rows
+		last = [rows[-1][columns.index(column)] for column in key_columns]
+
+
+def _convert_legacy_postings(connection):
+	"""
+	converts the hits stored one row each in the legacy mapper tables to Posting rows, and drops the legacy tables.
+	:param connection: the connection to the database.
+	:return: None.
+	"""
+	tables = sa.inspect(connection).get_table_names()
+	if all(table in tables for table in ("LexiconMapper", "PageHitMapper", "Hit")):
+		metadata = sa.MetaData()
+		lexicon = sa.Table("LexiconMapper", metadata, sa.Column("word_id"), sa.Column("entry_id"))
+		page_hits = sa.Table("PageHitMapper", metadata, sa.Column("id"), sa.Column("page_id"), sa.Column("hit_id"))
+		hits = sa.Table("Hit", metadata, sa.Column("id"), sa.Column("kind"), sa.Column("section"),
+		                sa.Column("position"))
+		joined = lexicon.join(page_hits, lexicon.c.entry_id == page_hits.c.id).join(hits,
+		                                                                            hits.c.id == page_hits.c.hit_id)
+		query = sa.select([lexicon.c.word_id, page_hits.c.page_id, hits.c.kind, hits.c.section,
+		                   hits.c.position]).select_from(joined).order_by(lexicon.c.word_id, page_hits.c.page_id,
+		                                                                  hits.c.id)
+		rows = []
+		current, hit_list = None, []
+		for word_id, page_id, kind, section, position in connection.execute(query):
+			if (word_id, page_id) != current:
+				if current is not None:
+					rows.append(_posting_row(current, hit_list))
+				current, hit_list = (word_id, page_id), []
+			hit_list.append(Hit(kind, section, position))
+			if len(rows) >= MIGRATION_CHUNK_SIZE:
+				connection.execute(Posting.__table__.insert(), rows)
+				rows = []
+		if current is not None:
+			rows.append(_posting_row(current, hit_list))
+		if len(rows) != 0:
+			connection.execute(Posting.__table__.insert(), rows)
+	for table in LEGACY_TABLES:
+		if table in tables:
+			connection.execute('DROP TABLE "{0}"'.format(table))
+
+
+def _posting_row(key, hit_list):
+	return {"word_id": key[0], "page_id": key[1], "hit_count": len(hit_list), "weight": hit_weight(hit_list),
+	        "hits": encode_hits(hit_list)}
+
+
+def _migrate_postings(connection, options):
+	"""
+	version 1: stores the hits of a word on a page as a single Posting, and tracks the page rank generations.
+	"""
+	tables = sa.inspect(connection).get_table_names()
+	metadata = sa.MetaData()
+	if "Posting" not in tables:
+		sa.Table("Posting", metadata,
+		         sa.Column("word_id", sa.BigInteger, primary_key=True, autoincrement=False),
+		         sa.Column("page_id", sa.BigInteger, primary_key=True, autoincrement=False),
+		         sa.Column("hit_count", sa.Integer, nullable=False),
+		         sa.Column("weight", sa.Float, nullable=False),
+		         sa.Column("hits", sa.LargeBinary, nullable=False)).create(connection)
+	if "PageRankStatus" not in tables:
+		sa.Table("PageRankStatus", metadata,
+		         sa.Column("id", sa.Integer, primary_key=True, autoincrement=False),
+		         sa.Column("graph_generation", sa.BigInteger, nullable=False),
+		         sa.Column("rank_generation", sa.BigInteger, nullable=False),
+		         sa.Column("updated", sa.Float)).create(connection)
+	_convert_legacy_postings(connection)
+
+
+def _migrate_ranking(connection, options):
+	"""
+	version 2: adds the text score of postings and the index generation.
+	"""
+	if not _has_column(connection, "Posting", "weight"):
+		connection.execute('ALTER TABLE "Posting" ADD COLUMN weight FLOAT NOT NULL DEFAULT 0')
+		table = Posting.__table__
+		statement = table.update().where(sa.and_(table.c.word_id == sa.bindparam("posting_word_id"),
+		                                         table.c.page_id == sa.bindparam("posting_page_id"))).values(
+			weight=sa.bindparam("posting_weight"))
+		for chunk in _read_chunks(connection, table, ("word_id", "page_id"), ("word_id", "page_id", "hits")):
+			connection.execute(statement, [{"posting_word_id": word_id, "posting_page_id": page_id,
+			                                "posting_weight": hit_weight(decode_hits(hits))} for
+			                               word_id, page_id, hits in chunk])
+	if not _has_column(connection, "PageRankStatus", "index_generation"):
+		connection.execute('ALTER TABLE "PageRankStatus" ADD COLUMN index_generation BIGINT NOT NULL DEFAULT 0')
+
+
+def _migrate_lookup_indexes(connection, options):
+	"""
+	version 3: indexes the columns hot lookups filter on.
+	"""
+	_create_index(connection, "Posting", "ix_Posting_page_id", "page_id")
+	if _has_column(connection, "ReferenceTracker", "url"):
+		_create_index(connection, "ReferenceTracker", "ix_ReferenceTracker_url_page_id", "url", "page_id")
+	_create_index(connection, "ReferenceTracker", "ix_ReferenceTracker_page_id", "page_id")
+	_create_index(connection, "Anchor", "ix_Anchor_doc_id", "doc_id")
+	_create_index(connection, "Header", "ix_Header_doc_id", "doc_id")
+	_create_index(connection, "TextSection", "ix_TextSection_doc_id", "doc_id")
+
+
+def _migrate_url_ids(connection, options):
+	"""
+	version 4: interns urls in the UrlDictionary, and stores url ids in PageUrlMapper and ReferenceTracker and page ids
+	in PageRank instead of urls. The tables still holding urls are rebuilt chunk by chunk, and replace the legacy
+	tables once they are complete.
+	"""
+	legacy_columns = {"PageUrlMapper": ("page_id", "url"), "ReferenceTracker": ("id", "page_id", "url"),
+	                  "PageRank": ("url", "page_rank")}
+	metadata = sa.MetaData()
+	legacy = {table: sa.Table(table, metadata, *[sa.Column(column) for column in columns]) for table, columns in
+	          legacy_columns.items() if _has_column(connection, table, "url")}
+	if len(legacy) == 0:
+		return
+	rebuilt = {}
+	if "PageUrlMapper" in legacy:
+		rebuilt["PageUrlMapper"] = table = sa.Table(
+			"PageUrlMapper_v4", metadata, sa.Column("page_id", sa.BigInteger, primary_key=True, autoincrement=False),
+			sa.Column("url_id", sa.BigInteger, unique=True, nullable=False))
+		table.create(connection)
+		for chunk in _read_chunks(connection, legacy["PageUrlMapper"], ("page_id",), ("page_id", "url")):
+			url_ids = _intern_urls(connection, set(url for _, url in chunk))
+			connection.execute(table.insert(), [{"page_id": page_id, "url_id": url_ids[url]} for page_id, url in chunk])
+	if "ReferenceTracker" in legacy:
+		rebuilt["ReferenceTracker"] = table = sa.Table(
+			"ReferenceTracker_v4", metadata,
+			sa.Column("id", sa.BigInteger().with_variant(sa.Integer, "sqlite"), primary_key=True),
+			sa.Column("page_id", sa.BigInteger),
+			sa.Column("url_id", sa.BigInteger))
+		table.create(connection)
+		for chunk in _read_chunks(connection, legacy["ReferenceTracker"], ("id",), ("id", "page_id", "url")):
+			url_ids = _intern_urls(connection, set(url for _, _, url in chunk))
+			connection.execute(table.insert(), [{"id": reference_id, "page_id": page_id, "url_id": url_ids[url]} for
+			                                    reference_id, page_id, url in chunk])
+	if "PageRank" in legacy:
+		rebuilt["PageRank"] = table = sa.Table(
+			"PageRank_v4", metadata, sa.Column("page_id", sa.BigInteger, primary_key=True, autoincrement=False),
+			sa.Column("page_rank", sa.Float))
+		table.create(connection)
+		pages = legacy.get("PageUrlMapper")
+		for chunk in _read_chunks(connection, legacy["PageRank"], ("url",), ("url", "page_rank")):
+			# ranks of urls that are not an indexed page are dropped, they are recalculated with the next page rank
+			# update
+			if pages is None:
+				continue
+			query = sa.select([pages.c.url, pages.c.page_id]).where(pages.c.url.in_([url for url, _ in chunk]))
+			page_ids = {url: page_id for url, page_id in connection.execute(query)}
+			rows = [{"page_id": page_ids[url], "page_rank": page_rank} for url, page_rank in chunk if url in page_ids]
+			if len(rows) != 0:
+				connection.execute(table.insert(), rows)
+	for name, table in rebuilt.items():
+		connection.execute('DROP TABLE "{0}"'.format(name))
+		connection.execute('ALTER TABLE "{0}" RENAME TO "{1}"'.format(table.name, name))
+	if "ReferenceTracker" in rebuilt:
+		_create_index(connection, "ReferenceTracker", "ix_ReferenceTracker_url_id_page_id", "url_id", "page_id")
+		_create_index(connection, "ReferenceTracker", "ix_ReferenceTracker_page_id", "page_id")
+
+
+def _intern_urls(connection, urls):
+	"""
+	adds the urls missing from the UrlDictionary to it.
+	:param connection: the connection to the database.
+	:param urls: a set of urls.
+	:return: a dictionary mapping each url to its url id.
+	"""
+	url_ids = _lookup_url_ids(connection, urls)
+	missing = [url for url in urls if url not in url_ids]
+	if len(missing) != 0:
+		connection.execute(UrlDictionaryEntry.__table__.insert(), [{"url_hash": url_hash(url), "url": url} for url in
+		                                                           missing])
+		url_ids.update(_lookup_url_ids(connection, set(missing)))
+	return url_ids
+
+
+def _lookup_url_ids(connection, urls):
+	table = UrlDictionaryEntry.__table__
+	hashes = list(set(url_hash(url) for url in urls))
+	query = sa.select([table.c.url, table.c.url_id]).where(table.c.url_hash.in_(hashes))
+	return {url: url_id for url, url_id in connection.execute(query) if url in urls}
+
+
+def _migrate_tombstones(connection, options):
+	"""
+	version 5: adds the tombstones of deleted pages.
+	"""
+	if "Tombstone" not in sa.inspect(connection).get_table_names():
+		sa.Table("Tombstone", sa.MetaData(),
+		         sa.Column("page_id", sa.BigInteger, primary_key=True, autoincrement=False),
+		         sa.Column("deleted", sa.Float, nullable=False)).create(connection)
+
+
+def _migrate_document_store(connection, options):
+	"""
+	version 6: moves the raw content of the pages and the text of their sections to the DocumentStore in
+	options["document_directory"], and drops the section tables. Hits refer to a section by its index among the
+	sections of its kind on the page instead of its row id, so the hits of every posting are converted. Segment files
+	written before this migration hold the old hits and must be rebuilt with Indexer.rebuild_segments.
+	"""
+	tables = sa.inspect(connection).get_table_names()
+	section_tables = [table for table in SECTION_TABLES if table in tables]
+	has_content = _has_column(connection, "Document", "content")
+	if len(section_tables) == 0 and not has_content:
+		return
+	metadata = sa.MetaData()
+	columns = ["id", "title", "url", "checksum"] + (["content"] if has_content else [])
+	documents = sa.Table("Document", metadata, *[sa.Column(column) for column in columns])
+	sections = {table: sa.Table(table, metadata, *[sa.Column(column) for column in SECTION_TABLES[table][1]]) for
+	            table in section_tables}
+	if connection.execute(sa.select([sa.func.count()]).select_from(documents)).scalar() != 0:
+		if options.get("document_directory") is None:
+			raise MigrationException("moving the pages to the document store needs a document directory")
+		store = DocumentStore(options["document_directory"])
+		try:
+			for chunk in _read_chunks(connection, documents, ("id",), columns):
+				_move_documents(connection, store, {row[0]: row for row in chunk}, sections)
+		finally:
+			store.close()
+	for table in section_tables:
+		connection.execute('DROP TABLE "{0}"'.format(table))
+	if has_content:
+		rebuilt = sa.Table("Document_v6", sa.MetaData(),
+		                   sa.Column("id", sa.BigInteger().with_variant(sa.Integer, "sqlite"), primary_key=True),
+		                   sa.Column("title", sa.String(500), nullable=False),
+		                   sa.Column("url", sa.String(500), nullable=False),
+		                   sa.Column("checksum", sa.LargeBinary(128), nullable=False))
+		rebuilt.create(connection)
+		connection.execute(rebuilt.insert().from_select(["id", "title", "url", "checksum"], sa.select(
+			[documents.c.id, documents.c.title, documents.c.url, documents.c.checksum])))
+		connection.execute('DROP TABLE "Document"')
+		connection.execute('ALTER TABLE "Document_v6" RENAME TO "Document"')
+
+
+def _migrate_weight_index(connection, options):
+	"""
+	version 7: indexes the text scores of the postings by word, so the highest text score of a word is a single lookup.
+	"""
+	_create_index(connection, "Posting", "ix_Posting_word_id_weight", "word_id", "weight")
+
+
+def _move_documents(connection, store, chunk, sections):
+	"""
+	writes the records of a chunk of documents to the DocumentStore and converts the hits of their postings.
+	:param connection: the connection to the database.
+	:param store: the DocumentStore.
+	:param chunk: a dictionary mapping the page ids of the documents to their rows.
+	:param sections: a dictionary mapping the names of the legacy section tables to their tables.
+	:return: None.
+	"""
+	page_ids = list(chunk.keys())
+	documents = {page_id: PageDocument(page_id, row[1], row[2], row[3], row[4] if len(row) > 4 else b"") for
+	             page_id, row in chunk.items()}
+	ordinals = {}
+	for table_name, table in sections.items():
+		kind = SECTION_TABLES[table_name][0]
+		query = sa.select([table.c[column] for column in SECTION_TABLES[table_name][1]]).where(
+			table.c.doc_id.in_(page_ids)).order_by(table.c.id)
+		for row in connection.execute(query):
+			section_id, page_id = row[0], row[1]
+			target = getattr(documents[page_id], SECTION_TABLES[table_name][2])
+			ordinals[(page_id, kind, section_id)] = len(target)
+			if kind == Hit.HEADER_HIT:
+				target.append(Header(row[3], row[2]))
+			elif kind == Hit.TEXT_HIT:
+				target.append(TextSection(row[2]))
+			else:
+				target.append(Anchor(row[2], row[3]))
+	for page_id, document in documents.items():
+		store.put(page_id, document.content, encode_sections(document))
+	table = Posting.__table__
+	statement = table.update().where(sa.and_(table.c.word_id == sa.bindparam("posting_word_id"),
+	                                         table.c.page_id == sa.bindparam("posting_page_id"))).values(
+		hits=sa.bindparam("posting_hits"))
+	rows = []
+	query = sa.select([table.c.word_id, table.c.page_id, table.c.hits]).where(table.c.page_id.in_(page_ids))
+	for word_id, page_id, hits in connection.execute(query):
+		hit_list = [Hit(hit.kind, ordinals.get((page_id, hit.kind, hit.section), hit.section), hit.position) for hit in
+		            decode_hits(hits)]
+		rows.append({"posting_word_id": word_id, "posting_page_id": page_id, "posting_hits": encode_hits(hit_list)})
+	_update_chunks(connection, statement, rows)
+
+
+def _update_chunks(connection, statement, rows):
+	for start in range(0, len(rows), MIGRATION_CHUNK_SIZE):
+		connection.execute(statement, rows[start:start + MIGRATION_CHUNK_SIZE])
+
+
+# the migrations in the order they are applied. The version of a database is the amount of migrations applied to it.
+MIGRATIONS = [_migrate_postings, _migrate_ranking, _migrate_lookup_indexes, _migrate_url_ids, _migrate_tombstones,
+              _migrate_document_store, _migrate_weight_index]
+
+
+def schema_version(connection):
+	"""
+	gets the schema version of a database.
+	:param connection: the connection or engine of the database.
+	:return: the version, or None if the database has no tables at all.
+	"""
+	tables = sa.inspect(connection).get_table_names()
+	if "SchemaVersion" not in tables:
+		return None if len(tables) == 0 else 0
+	table = SchemaVersion.__table__
+	version = connection.execute(sa.select([table.c.version])).scalar()
+	return version or 0
+
+
+def migrate(engine, document_directory=None):
+	"""
+	brings the schema of a database up to date. An empty database gets the current schema right away. Otherwise, the
+	migrations newer than the version of the database are applied in order, each in its own transaction. Tables that
+	no migration touches are created if they are missing.
+	:param engine: the engine of the database.
+	:param document_directory: the directory of the DocumentStore of the index, needed to move the pages of a database
+	older than version 6 to the store.
+	:return: the amount of migrations applied.
+	"""
+	options = {"document_directory": document_directory}
+	version = schema_version(engine)
+	if version is None:
+		with engine.begin() as connection:
+			Base.metadata.create_all(connection)
+			_set_version(connection, len(MIGRATIONS))
+		return 0
+	applied = 0
+	for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+		with engine.begin() as connection:
+			Base.metadata.create_all(connection, tables=[table for table in Base.metadata.sorted_tables if
+			                                             table.name not in ("Posting", "PageRankStatus")])
+			migration(connection, options)
+			_set_version(connection, number)
+		applied += 1
+	return applied
+
+
+def _set_version(connection, version):
+	table = SchemaVersion.__table__
+	if connection.execute(sa.select([table.c.id])).first() is None:
+		connection.execute(table.insert().values(id=SchemaVersion.SINGLETON_ID, version=version))
+	else:
+		connection.execute(table.update().values(version=version))
+
+
+def explain_query_plan(connection, query):
+	"""
+	gets the plan SQLite chooses for a query.
+	:param connection: a connection to a SQLite database.
+	:param query: the query, a sqlalchemy selectable or ORM Query.
+	:return: the detail of each step of the plan.
+	"""
+	statement = getattr(query, "statement", query)
+	compiled = statement.compile(dialect=connection.dialect, compile_kwargs={"literal_binds": True})
+	plan = connection.execute("EXPLAIN QUERY PLAN " + str(compiled))
+	return [row[-1] for row in plan]
+
+
+def full_scans(plan):
+	"""
+	finds the steps of a query plan that read a whole table rather than searching an index.
+	:param plan: the plan returned by explain_query_plan.
+	:return: the steps scanning a table without a covering index.
+	"""
+	return [step for step in plan if step.startswith("SCAN") and "COVERING INDEX" not in step]
+
+
+class TestMigration(unittest.TestCase):
+
+	def setUp(self):
+		self.engine = create_engine("sqlite:///:memory:")
+		self.directory = tempfile.mkdtemp()
+
+	def create_legacy_schema(self):
+		metadata = sa.MetaData()
+		integer = sa.Integer
+		sa.Table("Hit", metadata, sa.Column("id", integer, primary_key=True), sa.Column("kind", sa.SmallInteger),
+		         sa.Column("section", integer), sa.Column("position", integer))
+		sa.Table("PageHitMapper", metadata, sa.Column("id", integer, primary_key=True),
+		         sa.Column("page_id", sa.BigInteger), sa.Column("hit_id", sa.BigInteger))
+		sa.Table("LexiconMapper", metadata, sa.Column("id", integer, primary_key=True),
+		         sa.Column("word_id", sa.BigInteger), sa.Column("entry_id", sa.BigInteger))
+		sa.Table("ForwardMapper", metadata, sa.Column("id", integer, primary_key=True),
+		         sa.Column("page_id", sa.BigInteger), sa.Column("word_id", sa.BigInteger))
+		sa.Table("ReferenceTracker", metadata, sa.Column("id", integer, primary_key=True),
+		         sa.Column("page_id", sa.BigInteger), sa.Column("url", sa.String(500)))
+		sa.Table("PageUrlMapper", metadata, sa.Column("page_id", sa.BigInteger, primary_key=True),
+		         sa.Column("url", sa.String(500), unique=True))
+		sa.Table("PageRank", metadata, sa.Column("url", sa.String(500), primary_key=True),
+		         sa.Column("page_rank", sa.Float))
+		sa.Table("Document", metadata, sa.Column("id", integer, primary_key=True), sa.Column("title", sa.String(500)),
+		         sa.Column("url", sa.String(500)), sa.Column("content", sa.LargeBinary),
+		         sa.Column("checksum", sa.LargeBinary))
+		sa.Table("TextSection", metadata, sa.Column("id", integer, primary_key=True), sa.Column("doc_id", integer),
+		         sa.Column("text", sa.String(5000)))
+		metadata.create_all(self.engine)
+		hits = [(1, 3, 0, 0), (2, 1, 5, 2), (3, 1, 5, 7), (4, 1, 6, 1)]
+		# word 10 occurs on page 1 at hits 1 and 2, and on page 2 at hit 4; word 11 occurs on page 1 at hit 3
+		page_hits = [(1, 1, 1), (2, 1, 2), (3, 1, 3), (4, 2, 4)]
+		lexicon = [(1, 10, 1), (2, 10, 2), (3, 11, 3), (4, 10, 4)]
+		with self.engine.begin() as connection:
+			connection.execute(metadata.tables["Hit"].insert(),
+			                   [dict(zip(("id", "kind", "section", "position"), hit)) for hit in hits])
+			connection.execute(metadata.tables["PageHitMapper"].insert(),
+			                   [dict(zip(("id", "page_id", "hit_id"), row)) for row in page_hits])
+			connection.execute(metadata.tables["LexiconMapper"].insert(),
+			                   [dict(zip(("id", "word_id", "entry_id"), row)) for row in lexicon])
+			connection.execute(metadata.tables["PageUrlMapper"].insert(),
+			                   [{"page_id": 1, "url": "https://a.com"}, {"page_id": 2, "url": "https://b.com"}])
+			connection.execute(metadata.tables["PageRank"].insert(),
+			                   [{"url": "https://a.com", "page_rank": 0.5}, {"url": "https://b.com", "page_rank": 0.3}])
+			connection.execute(metadata.tables["Document"].insert(), [
+				{"id": 1, "title": "A", "url": "https://a.com", "content": b"<p>a</p>", "checksum": b"1"},
+				{"id": 2, "title": "B", "url": "https://b.com", "content": b"<p>b</p>", "checksum": b"2"}])
+			# the hits on page 1 are in its second text section
+			connection.execute(metadata.tables["TextSection"].insert(), [
+				{"id": 3, "doc_id": 1, "text": "first"}, {"id": 5, "doc_id": 1, "text": "second"},
+				{"id": 6, "doc_id": 2, "text": "only"}])
+			connection.execute(metadata.tables["ReferenceTracker"].insert(),
+			                   [{"page_id": 1, "url": "https://b.com"}, {"page_id": 2, "url": "https://c.com"}])
+
+	def test_fresh_database(self):
+		self.assertEqual(0, migrate(self.engine), "An empty database should not need migrations")
+		self.assertEqual(len(MIGRATIONS), schema_version(self.engine))
+		self.assertEqual(0, migrate(self.engine), "Migrations were applied twice")
+
+	def test_legacy_database(self):
+		self.create_legacy_schema()
+		with self.assertRaises(MigrationException, msg="Pages were dropped without a document directory"):
+			migrate(self.engine)
+		failed = MIGRATIONS.index(_migrate_document_store)
+		self.assertEqual(failed, schema_version(self.engine), "Failed migration was not rolled back")
+		self.assertEqual(len(MIGRATIONS) - failed, migrate(self.engine, self.directory),
+		                 "Not all migrations were applied")
+		self.assertEqual(len(MIGRATIONS), schema_version(self.engine))
+		tables = sa.inspect(self.engine).get_table_names()
+		self.assertFalse(any(table in tables for table in LEGACY_TABLES), "Legacy tables were not dropped")
+		session = sessionmaker(bind=self.engine)()
+		query = session.query(Posting.word_id, Posting.page_id, Posting.hit_count, Posting.hits, Posting.weight)
+		postings = {(word_id, page_id): (hit_count, decode_hits(hits), weight) for
+		            word_id, page_id, hit_count, hits, weight in query}
+		session.close()
+		self.assertEqual({(10, 1), (10, 2), (11, 1)}, set(postings.keys()), "Legacy hits were not converted")
+		hit_count, hits, weight = postings[(10, 1)]
+		self.assertEqual(2, hit_count)
+		self.assertEqual([(3, 0, 0), (1, 1, 2)], [(hit.kind, hit.section, hit.position) for hit in hits],
+		                 "Hits were not converted to section ordinals")
+		self.assertAlmostEqual(hit_weight(hits), weight, msg="Converted postings have no text score")
+		indexes = [info["name"] for info in sa.inspect(self.engine).get_indexes("ReferenceTracker")]
+		self.assertIn("ix_ReferenceTracker_url_id_page_id", indexes, "Lookup indexes were not created")
+		indexes = [info["name"] for info in sa.inspect(self.engine).get_indexes("Posting")]
+		self.assertIn("ix_Posting_word_id_weight", indexes, "Text score index was not created")
+		session = sessionmaker(bind=self.engine)()
+		urls = dict(session.query(UrlDictionaryEntry.url_id, UrlDictionaryEntry.url))
+		pages = {page_id: urls[url_id] for page_id, url_id in session.query(PageUrlMapper.id, PageUrlMapper.url_id)}
+		references = {(page_id, urls[url_id]) for page_id, url_id in
+		              session.query(ReferenceTracker.page_id, ReferenceTracker.url_id)}
+		ranks = dict(session.query(PageRankTracker.page_id, PageRankTracker.page_rank))
+		session.close()
+		self.assertEqual({1: "https://a.com", 2: "https://b.com"}, pages, "Url mappings were not converted")
+		self.assertEqual({(1, "https://b.com"), (2, "https://c.com")}, references, "References were not converted")
+		self.assertEqual({1: 0.5, 2: 0.3}, ranks, "Page ranks were not converted")
+		self.assertFalse(_has_column(self.engine, "Document", "content"), "Content was kept in the database")
+		store = DocumentStore(self.directory)
+		document = decode_document(store.get(1), store.get_sections(1), PageDocument())
+		store.close()
+		self.assertEqual(b"<p>a</p>", document.content, "Content was not moved to the document store")
+		self.assertEqual(["first", "second"], [text.text for text in document.texts], "Sections were not moved")
+
+	def test_chunked_migration(self):
+		with mock.patch.object(sys.modules[__name__], "MIGRATION_CHUNK_SIZE", 1):
+			self.test_legacy_database()
+
+	def test_read_chunks(self):
+		table = sa.Table("Pair", sa.MetaData(), sa.Column("a", sa.Integer, primary_key=True),
+		                 sa.Column("b", sa.Integer, primary_key=True))
+		table.create(self.engine)
+		pairs = [(1, 1), (1, 2), (2, 0), (2, 5), (3, 1)]
+		with self.engine.begin() as connection:
+			connection.execute(table.insert(), [{"a": a, "b": b} for a, b in reversed(pairs)])
+			with mock.patch.object(sys.modules[__name__], "MIGRATION_CHUNK_SIZE", 2):
+				chunks = [[tuple(row) for row in chunk] for chunk in _read_chunks(connection, table, ("a", "b"),
+				                                                                   ("a", "b"))]
+		self.assertEqual([pairs[0:2], pairs[2:4], pairs[4:]], chunks, "Rows were not read by key in chunks")
+
+	def test_query_plans(self):
+		migrate(self.engine)
+		session = sessionmaker(bind=self.engine)()
+		hot_queries = {
+			"postings of a word": session.query(Posting.page_id, Posting.weight).filter(Posting.word_id == 1).order_by(
+				Posting.page_id),
+			"postings of a page": session.query(Posting.word_id, Posting.hits).filter(Posting.page_id == 1),
+			"postings of a word on pages": session.query(Posting.page_id, Posting.hits).filter(
+				Posting.word_id == 1, Posting.page_id.in_([1, 2, 3])),
+			"word ids": session.query(WordDictionaryEntry.word, WordDictionaryEntry.word_id).filter(
+				WordDictionaryEntry.word.in_(["a", "b"])),
+			"url ids": session.query(UrlDictionaryEntry.url_hash, UrlDictionaryEntry.url,
+			                         UrlDictionaryEntry.url_id).filter(UrlDictionaryEntry.url_hash.in_([1, 2])),
+			"indexed urls": session.query(PageUrlMapper.url_id).filter(PageUrlMapper.url_id.in_([1, 2])),
+			"pages linking to a url": session.query(ReferenceTracker.page_id).filter(ReferenceTracker.url_id == 1),
+			"references of a page": session.query(ReferenceTracker.url_id).filter(ReferenceTracker.page_id == 1),
+			"page rank of a page": session.query(PageRankTracker.page_rank).filter(PageRankTracker.page_id == 1),
+			"link graph": session.query(ReferenceTracker.page_id, PageUrlMapper.id).join(
+				PageUrlMapper, PageUrlMapper.url_id == ReferenceTracker.url_id),
+		}
+		# loading the link graph reads every reference anyway, only looking up the linked pages must use an index
+		expected_scans = {"link graph": ["SCAN ReferenceTracker"]}
+		with self.engine.connect() as connection:
+			for name, query in hot_queries.items():
+				plan = explain_query_plan(connection, query)
+				self.assertEqual(expected_scans.get(name, []), [step.split(" USING")[0] for step in full_scans(plan)],
+				                 "The query for " + name + " scans a table: " + str(plan))
+			query = session.query(sa.func.max(Posting.weight)).filter(Posting.word_id == 1)
+			self.assertIn("COVERING INDEX ix_Posting_word_id_weight", " ".join(explain_query_plan(connection, query)),
+			              "The highest text score of a word is not looked up in the index")
+		session.close()
+
+	def tearDown(self):
+		self.engine.dispose()
+		shutil.rmtree(self.directory)
@@ -0,0 +1,379 @@
+import unittest
+from array import array
+
+import numpy as np
+import sqlalchemy as sa
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from index.entry import Base
+from index.entry import PageRankTracker
+from index.entry import PageUrlMapper
+from index.entry import ReferenceTracker
+from index.entry import Tombstone
+from index.metrics import DISABLED
+
+
+class LinkGraph:
+	"""
+	The link graph between indexed pages, stored as a sparse matrix in compressed sparse row form. Row i of the matrix
+	lists the pages linking to page i, so that one step of the power iteration is a single sparse matrix-vector product.
+	Links to pages that are not indexed are dropped, and pages without any remaining out link are dangling.
+	"""
+
+	def __init__(self, page_ids, sources, targets):
+		"""
+		creates a new LinkGraph from a list of edges.
+		:param page_ids: the page id of each node, indexed by node number.
+		:param sources: a numpy array with the node number of the linking page of each edge.
+		:param targets: a numpy array with the node number of the linked page of each edge.
+		"""
+		self.page_ids = list(page_ids)
+		size = len(self.page_ids)
+		sources = np.asarray(sources, dtype=np.int64)
+		targets = np.asarray(targets, dtype=np.int64)
+		# a page linking to another page several times still counts as a single link.
+		edges = np.unique(targets * size + sources) if size > 0 else np.zeros(0, dtype=np.int64)
+		targets, sources = np.divmod(edges, max(size, 1))
+		self.indices = sources
+		self.indptr = np.zeros(size + 1, dtype=np.int64)
+		np.cumsum(np.bincount(targets, minlength=size), out=self.indptr[1:])
+		self.out_degree = np.bincount(sources, minlength=size)
+		self.dangling = self.out_degree == 0
+		self._nonempty = self.indptr[:-1] < self.indptr[1:]
+		# the transposed matrix, listing the pages each page links to
+		self.out_indices = targets[np.argsort(sources, kind="stable")]
+		self.out_indptr = np.zeros(size + 1, dtype=np.int64)
+		np.cumsum(self.out_degree, out=self.out_indptr[1:])
+
+	def __len__(self):
+		return len(self.page_ids)
+
+	def edge_count(self):
+		"""
+		gets the number of distinct links in the graph.
+		:return: the number of links.
+		"""
+		return len(self.indices)
+
+	def propagate(self, ranks):
+		"""
+		computes, for every page, the sum of rank / out link count over the pages linking to it.
+		:param ranks: a numpy array with the current rank of every node.
+		:return: a numpy array with the propagated rank of every node.
+		"""
+		shares = np.zeros(len(self))
+		np.divide(ranks, self.out_degree, out=shares, where=~self.dangling)
+		result = np.zeros(len(self))
+		if len(self.indices) != 0:
+			# each row is a contiguous run of indices, summed in one pass. reduceat only handles non empty runs.
+			result[self._nonempty] = np.add.reduceat(shares[self.indices], self.indptr[:-1][self._nonempty])
+		return result
+
+	def spread(self, nodes, amounts, target):
+		"""
+		divides an amount of every given node evenly over the pages it links to and adds the shares to a target array.
+		Only the out links of the given nodes are visited.
+		:param nodes: a numpy array of node numbers.
+		:param amounts: a numpy array with the amount to spread from each node.
+		:param target: the numpy array to add the shares to.
+		:return: None.
+		"""
+		degrees = self.out_degree[nodes]
+		linking = degrees > 0
+		nodes, amounts, degrees = nodes[linking], amounts[linking], degrees[linking]
+		# positions of the out links of each node within out_indices
+		offsets = np.repeat(self.out_indptr[nodes] - np.cumsum(degrees) + degrees, degrees) + np.arange(degrees.sum())
+		np.add.at(target, self.out_indices[offsets], np.repeat(amounts / degrees, degrees))
+
+
+class PageRanks:
+	"""
+	The persisted page ranks in arrays sorted by page id, so that looking up the rank of a candidate page of a search
+	costs a binary search rather than a query, and the ranks of a million pages take 16 MB rather than a dictionary.
+	Page ids are the ids given by the crawler, so they are neither dense nor small, and are never used as an index.
+	"""
+
+	def __init__(self, page_ids, ranks, default_rank):
+		"""
+		creates a new PageRanks.
+		:param page_ids: the page ids with a persisted rank.
+		:param ranks: the persisted rank of each page.
+		:param default_rank: the page rank of pages without a persisted rank.
+		"""
+		page_ids = np.asarray(page_ids, dtype=np.int64)
+		order = np.argsort(page_ids, kind="stable")
+		self._page_ids = page_ids[order]
+		self._ranks = np.asarray(ranks, dtype=np.float64)[order]
+		self.default_rank = default_rank
+		self.max_rank = max(float(self._ranks.max()), default_rank) if len(page_ids) != 0 else default_rank
+
+	@classmethod
+	def load(cls, session, default_rank, chunk_size=1000):
+		"""
+		reads the persisted page ranks.
+		:param session: the session to read the ranks from.
+		:param default_rank: the page rank of pages without a persisted rank.
+		:param chunk_size: the amount of ranks fetched at a time.
+		:return: the PageRanks.
+		"""
+		page_ids, ranks = array("q"), array("d")
+		query = session.query(PageRankTracker.page_id, PageRankTracker.page_rank).filter(
+			PageRankTracker.page_rank.isnot(None))
+		for page_id, rank in query.yield_per(chunk_size):
+			page_ids.append(page_id)
+			ranks.append(rank)
+		return cls(np.frombuffer(page_ids, dtype=np.int64), np.frombuffer(ranks, dtype=np.float64), default_rank)
+
+	def get(self, page_id, default=None):
+		"""
+		gets the page rank of a page.
+		:param page_id: the page id.
+		:param default: the rank of pages without a persisted rank, None for the default rank.
+		:return: the page rank.
+		"""
+		position = int(np.searchsorted(self._page_ids, page_id))
+		if position < len(self._page_ids) and self._page_ids[position] == page_id:
+			return float(self._ranks[position])
+		return self.default_rank if default is None else default
+
+
+class PageRankEngine:
+	"""
+	Calculates the page rank of all indexed pages with power iteration over the whole link graph. The rank follows the
+	formulation in The Anatomy of a Large-Scale Hypertextual Web Search Engine, PR(A) = (1 - d) + d * sum(PR(T) / C(T)),
+	where the rank of dangling pages is spread evenly over all pages so that the ranks average to 1.
+	"""
+
+	def __init__(self, session, dampener=0.8, max_iteration=100, tolerance=1e-8, residual_threshold=1e-6,
+	             metrics=DISABLED):
+		"""
+		creates a new PageRankEngine.
+		:param session: the session to read the link graph from and write the ranks to.
+		:param dampener: the dampening factor.
+		:param max_iteration: the maximum amount of iterations to run.
+		:param tolerance: the iteration stops once no rank changes by more than this amount.
+		:param residual_threshold: incremental updates stop once no page has a residual above this amount.
+		:param metrics: the Metrics to record the durations of loading, ranking and persisting in.
+		"""
+		self._session = session
+		self._dampener = dampener
+		self._max_iteration = max_iteration
+		self._tolerance = tolerance
+		self._residual_threshold = residual_threshold
+		self._metrics = metrics
+
+	def run(self):
+		"""
+		loads the link graph, calculates the page rank of every page and writes them back to the database. The session
+		is not committed.
+		:return: the amount of iterations that ran.
+		"""
+		metrics = self._metrics
+		with metrics.timer("page_rank_load"):
+			graph = self.load_graph()
+		with metrics.timer("page_rank_compute"):
+			ranks, iterations = self.compute(graph)
+		with metrics.timer("page_rank_persist"):
+			self.persist(graph, ranks)
+		metrics.increment("page_rank_iterations", iterations)
+		return iterations
+
+	def update(self):
+		"""
+		updates the persisted page ranks incrementally after pages or links were added. Starting from the persisted
+		ranks, only the residual caused by the changed part of the graph is propagated, and only the ranks that changed
+		are written back. The session is not committed.
+		:return: the amount of propagation rounds that ran.
+		"""
+		metrics = self._metrics
+		with metrics.timer("page_rank_load"):
+			graph = self.load_graph()
+			previous = self.load_ranks(graph)
+		with metrics.timer("page_rank_propagate"):
+			ranks, rounds = self.propagate_changes(graph, previous)
+		with metrics.timer("page_rank_persist"):
+			self.persist(graph, ranks, np.flatnonzero(ranks != previous))
+		metrics.increment("page_rank_iterations", rounds)
+		return rounds
+
+	def load_graph(self):
+		"""
+		loads the link graph of the indexed pages with one query for the pages and one for the links. Deleted pages and
+		the links to them are left out.
+		:return: the LinkGraph.
+		"""
+		pages = self._session.query(PageUrlMapper.id).outerjoin(Tombstone, Tombstone.page_id == PageUrlMapper.id)
+		pages = pages.filter(Tombstone.page_id.is_(None)).order_by(PageUrlMapper.id).all()
+		page_ids = np.fromiter((page[0] for page in pages), dtype=np.int64, count=len(pages))
+		links = self._session.query(ReferenceTracker.page_id, PageUrlMapper.id).join(
+			PageUrlMapper, PageUrlMapper.url_id == ReferenceTracker.url_id).outerjoin(
+			Tombstone, Tombstone.page_id == PageUrlMapper.id).filter(Tombstone.page_id.is_(None)).all()
+		link_array = np.array(links, dtype=np.int64).reshape(-1, 2)
+		sources = np.searchsorted(page_ids, link_array[:, 0])
+		targets = np.searchsorted(page_ids, link_array[:, 1])
+		# references made by pages that are not indexed (any more) are not part of the graph
+		known = sources < len(page_ids)
+		known[known] = page_ids[sources[known]] == link_array[known, 0]
+		return LinkGraph(page_ids, sources[known], targets[known])
+
+	def load_ranks(self, graph):
+		"""
+		loads the persisted rank of every node of a graph. Nodes without a persisted rank start at 1 - dampener.
+		:param graph: the LinkGraph to load the ranks of.
+		:return: a numpy array with the rank of every node.
+		"""
+		persisted = dict(self._session.query(PageRankTracker.page_id, PageRankTracker.page_rank))
+		default = 1 - self._dampener
+		return np.fromiter((persisted.get(page_id, default) for page_id in graph.page_ids), dtype=np.float64,
+		                   count=len(graph))
+
+	def compute(self, graph):
+		"""
+		calculates the page rank of every node of the graph with power iteration.
+		:param graph: the LinkGraph to rank.
+		:return: a tuple of a numpy array with the rank of every node and the amount of iterations that ran.
+		"""
+		size = len(graph)
+		ranks = np.ones(size)
+		iterations = 0
+		while iterations < self._max_iteration and size > 0:
+			iterations += 1
+			dangling_share = ranks[graph.dangling].sum() / size
+			updated = (1 - self._dampener) + self._dampener * (graph.propagate(ranks) + dangling_share)
+			change = np.abs(updated - ranks).max()
+			ranks = updated
+			if change <= self._tolerance:
+				break
+		return ranks, iterations
+
+	def propagate_changes(self, graph, ranks):
+		"""
+		brings ranks that were calculated for an earlier version of the graph up to date. The residual of every node,
+		the amount its rank is off from the page rank definition, is calculated once. Then, in each round, the nodes
+		whose residual exceeds the residual threshold take it into their rank and pass the dampened residual on to the
+		pages they link to, so that only the part of the graph affected by the change is visited.
+		:param graph: the LinkGraph to rank.
+		:param ranks: a numpy array with the previous rank of every node.
+		:return: a tuple of a numpy array with the updated rank of every node and the amount of rounds that ran.
+		"""
+		size = len(graph)
+		ranks = ranks.copy()
+		if size == 0:
+			return ranks, 0
+		dangling_share = ranks[graph.dangling].sum() / size
+		residual = (1 - self._dampener) + self._dampener * (graph.propagate(ranks) + dangling_share) - ranks
+		rounds = 0
+		while rounds < self._max_iteration:
+			active = np.flatnonzero(np.abs(residual) > self._residual_threshold)
+			if len(active) == 0:
+				break
+			rounds += 1
+			pushed = residual[active]
+			ranks[active] += pushed
+			residual[active] = 0
+			graph.spread(active, self._dampener * pushed, residual)
+			dangling_pushed = pushed[graph.dangling[active]].sum()
+			if dangling_pushed != 0:
+				residual += self._dampener * dangling_pushed / size
+		return ranks, rounds
+
+	def persist(self, graph, ranks, nodes=None):
+		"""
+		writes the ranks of the nodes of a graph to the database in one bulk update.
+		:param graph: the LinkGraph that was ranked.
+		:param ranks: the ranks of the nodes of the graph.
+		:param nodes: the node numbers to write the rank of, or None to write all of them.
+		:return: None.
+		"""
+		if nodes is None:
+			nodes = range(len(graph))
+		parameters = [{"node_page_id": int(graph.page_ids[node]), "node_rank": float(ranks[node])} for node in nodes]
+		if len(parameters) == 0:
+			return
+		table = PageRankTracker.__table__
+		statement = table.update().where(table.c.page_id == sa.bindparam("node_page_id")).values(
+			page_rank=sa.bindparam("node_rank"))
+		self._session.execute(statement, parameters)
+
+
+class TestPageRankEngine(unittest.TestCase):
+
+	def setUp(self):
+		self.engine = create_engine("sqlite:///:memory:")
+		Base.metadata.create_all(self.engine)
+		self.session = sessionmaker(bind=self.engine)()
+		self.url_ids = {}
+		self.pages = {}
+
+	def url_id(self, url):
+		return self.url_ids.setdefault(url, len(self.url_ids))
+
+	def add_page(self, page_id, url, links):
+		self.pages[url] = page_id
+		self.session.add(PageUrlMapper(page_id, self.url_id(url)))
+		self.session.add(PageRankTracker(page_id, 0.2))
+		self.session.add_all([ReferenceTracker(page_id, self.url_id(link)) for link in links])
+
+	def ranks(self):
+		urls = {page_id: url for url, page_id in self.pages.items()}
+		return {urls[page_id]: rank for page_id, rank in
+		        self.session.query(PageRankTracker.page_id, PageRankTracker.page_rank)}
+
+	def test_cycle(self):
+		self.add_page(1, "a", ["b"])
+		self.add_page(2, "b", ["a", "https://www.unindexed.com"])
+		PageRankEngine(self.session).run()
+		for url, rank in self.ranks().items():
+			self.assertAlmostEqual(1.0, rank, msg="A cycle should rank all pages equally")
+
+	def test_dangling(self):
+		self.add_page(1, "a", ["c"])
+		self.add_page(2, "b", ["a", "c", "c"])
+		self.add_page(3, "c", [])
+		iterations = PageRankEngine(self.session, max_iteration=1000).run()
+		ranks = self.ranks()
+		self.assertLess(iterations, 1000, "Power iteration failed to converge")
+		self.assertAlmostEqual(3.0, sum(ranks.values()), msg="The rank of the dangling page was lost")
+		self.assertGreater(ranks["c"], ranks["a"], "The page with the most links should rank first")
+		self.assertGreater(ranks["a"], ranks["b"], "The page without references should rank last")
+		expected_b = 0.2 + 0.8 * ranks["c"] / 3
+		self.assertAlmostEqual(expected_b, ranks["b"], msg="Page rank does not satisfy its definition")
+
+	def test_page_ranks(self):
+		self.session.add_all([PageRankTracker(2, 0.5), PageRankTracker(5, 1.5), PageRankTracker(7, None)])
+		ranks = PageRanks.load(self.session, 0.2, chunk_size=1)
+		self.assertEqual([0.2, 0.5, 0.2, 1.5, 0.2], [ranks.get(page_id) for page_id in (1, 2, 4, 5, 7)])
+		self.assertEqual(1.5, ranks.max_rank)
+		self.assertEqual(0.2, PageRanks([], [], 0.2).max_rank, "Without ranks the default rank is the highest")
+		ranks = PageRanks([2 ** 40, 3, -4], [0.7, 0.4, 0.9], 0.2)
+		self.assertEqual([0.7, 0.4, 0.9, 0.2, 0.2], [ranks.get(page_id) for page_id in (2 ** 40, 3, -4, 4, 2 ** 41)],
+		                 "Large, sparse or negative page ids were not looked up")
+
+	def test_deleted_page(self):
+		self.add_page(1, "a", ["b"])
+		self.add_page(2, "b", ["a"])
+		self.add_page(3, "c", ["a"])
+		self.session.add(Tombstone(3, 0.0))
+		graph = PageRankEngine(self.session).load_graph()
+		self.assertEqual([1, 2], graph.page_ids, "Deleted page is part of the link graph")
+		self.assertEqual(2, graph.edge_count(), "Links of the deleted page are part of the link graph")
+
+	def test_incremental_update(self):
+		self.add_page(1, "a", ["b", "c"])
+		self.add_page(2, "b", ["c"])
+		self.add_page(3, "c", ["a"])
+		self.add_page(4, "d", [])
+		PageRankEngine(self.session).run()
+		self.add_page(5, "e", ["d", "a"])
+		self.add_page(6, "f", ["e"])
+		self.session.add(ReferenceTracker(4, self.url_id("f")))
+		PageRankEngine(self.session).update()
+		updated = self.ranks()
+		PageRankEngine(self.session).run()
+		for url, rank in self.ranks().items():
+			self.assertAlmostEqual(rank, updated[url], places=4, msg="Incremental update diverged for " + url)
+
+	def tearDown(self):
+		self.session.close()
+		self.engine.dispose()
@@ -0,0 +1,129 @@
+import unittest
+
+from index.entry import Hit
+from index.ranking import hit_weight
+
+# the amount of low bits of an encoded hit holding its kind
+KIND_BITS = 3
+KIND_MASK = (1 << KIND_BITS) - 1
+
+
+def zigzag(value):
+	"""
+	maps a signed integer to an unsigned one so that numbers close to zero stay small: 0, -1, 1, -2 -> 0, 1, 2, 3.
+	:param value: the signed integer.
+	:return: the unsigned integer.
+	"""
+	return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def unzigzag(value):
+	"""
+	reverses zigzag.
+	:param value: the unsigned integer.
+	:return: the signed integer.
+	"""
+	return value >> 1 if value & 1 == 0 else -((value + 1) >> 1)
+
+
+def encode_varint(value, buffer):
+	"""
+	appends an unsigned integer to a buffer in the varint format, 7 bits per byte with the high bit set on all but the
+	last byte.
+	:param value: the unsigned integer to encode.
+	:param buffer: the bytearray to append to.
+	:return: None.
+	"""
+	while value > 0x7F:
+		buffer.append((value & 0x7F) | 0x80)
+		value >>= 7
+	buffer.append(value)
+
+
+def decode_varint(data, offset):
+	"""
+	reads a varint encoded unsigned integer.
+	:param data: the bytes to read from.
+	:param offset: the offset of the first byte of the varint.
+	:return: a tuple of the integer and the offset right after it.
+	"""
+	result = 0
+	shift = 0
+	while True:
+		byte = data[offset]
+		offset += 1
+		result |= (byte & 0x7F) << shift
+		if byte < 0x80:
+			return result, offset
+		shift += 7
+
+
+def encode_hits(hits):
+	"""
+	encodes a hit list into bytes. Each hit is stored as two varints: the zigzag encoded difference of its section to
+	the section of the previous hit, shifted left to make room for the kind, and the zigzag encoded difference of its
+	position to the position of the previous hit. The order of the hits is kept.
+	:param hits: the hit list to encode.
+	:return: the encoded bytes.
+	"""
+	buffer = bytearray()
+	section, position = 0, 0
+	for hit in hits:
+		encode_varint(zigzag(hit.section - section) << KIND_BITS | hit.kind, buffer)
+		encode_varint(zigzag(hit.position - position), buffer)
+		section, position = hit.section, hit.position
+	return bytes(buffer)
+
+
+def decode_hits(data):
+	"""
+	decodes a hit list encoded by encode_hits.
+	:param data: the encoded bytes.
+	:return: the list of Hit.
+	"""
+	hits = []
+	section, position = 0, 0
+	offset = 0
+	while offset < len(data):
+		value, offset = decode_varint(data, offset)
+		delta, offset = decode_varint(data, offset)
+		section += unzigzag(value >> KIND_BITS)
+		position += unzigzag(delta)
+		hits.append(Hit(value & KIND_MASK, section, position))
+	return hits
+
+
+def posting_rows(forward_entry, word_ids=None):
+	"""
+	converts a ForwardIndexEntry to the column values of its Posting rows.
+	:param forward_entry: the ForwardIndexEntry to convert.
+	:param word_ids: the word ids to convert, or None to convert all words of the entry.
+	:return: a list of dictionaries with the values of each Posting row.
+	"""
+	if word_ids is None:
+		word_ids = forward_entry.hits.keys()
+	rows = []
+	for word_id in word_ids:
+		hit_list = forward_entry.hits[word_id]
+		rows.append({"word_id": word_id, "page_id": forward_entry.page_id, "hit_count": len(hit_list),
+		             "weight": hit_weight(hit_list), "hits": encode_hits(hit_list)})
+	return rows
+
+
+class TestHitEncoding(unittest.TestCase):
+
+	def test_varint(self):
+		for value in (0, 1, 127, 128, 300, 2 ** 40):
+			buffer = bytearray()
+			encode_varint(value, buffer)
+			self.assertEqual((value, len(buffer)), decode_varint(buffer, 0), "Varint round trip failed")
+		for value in (0, -1, 1, -200, 200):
+			self.assertEqual(value, unzigzag(zigzag(value)), "Zigzag round trip failed")
+
+	def test_round_trip(self):
+		hits = [Hit(Hit.HEADER_HIT, 4, 2), Hit(Hit.TEXT_HIT, 5, 2), Hit(Hit.TEXT_HIT, 5, 40),
+		        Hit(Hit.ANCHOR_HIT, 3, 0), Hit(Hit.URL_HIT, 0, 0)]
+		encoded = encode_hits(hits)
+		self.assertEqual(hits, decode_hits(encoded), "Hit list round trip failed")
+		self.assertEqual(2 * len(hits), len(encoded), "Hits close together should take two bytes each")
+		self.assertEqual([], decode_hits(encode_hits([])), "Empty hit list round trip failed")
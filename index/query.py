@@ -0,0 +1,621 @@
+import heapq
+import re
+import unittest
+from bisect import bisect_left
+
+from index.entry import Hit
+from index.tokenizer import tokenize
+
+QUERY_TOKEN = re.compile(r'-?"[^"]*"?(?:~\d+)?|\(|\)|[^\s()]+')
+PHRASE = re.compile(r'"([^"]*)"?(?:~(\d+))?$')
+
+
+class TermQuery:
+	"""
+	A query matching the pages containing a word.
+	"""
+
+	def __init__(self, word):
+		self.word = word
+
+	def words(self):
+		return [self.word]
+
+	def __eq__(self, other):
+		return isinstance(other, TermQuery) and self.word == other.word
+
+	def __repr__(self):
+		return repr(self.word)
+
+
+class PhraseQuery:
+	"""
+	A query matching the pages where its words occur in the same section. With a slop of 0 the words must appear next to
+	each other in the given order; otherwise they must all appear, in any order, within slop positions of each other.
+	"""
+
+	def __init__(self, words, slop=0):
+		self.phrase = list(words)
+		self.slop = slop
+
+	def words(self):
+		return list(self.phrase)
+
+	def __eq__(self, other):
+		return isinstance(other, PhraseQuery) and self.phrase == other.phrase and self.slop == other.slop
+
+	def __repr__(self):
+		return repr(self.phrase) + "~" + str(self.slop)
+
+
+class AndQuery:
+	"""
+	A query matching the pages matched by all of its children. Children wrapped in a NotQuery exclude pages instead.
+	"""
+
+	def __init__(self, children):
+		self.children = list(children)
+
+	def words(self):
+		return [word for child in self.children for word in child.words()]
+
+	def __eq__(self, other):
+		return isinstance(other, AndQuery) and self.children == other.children
+
+	def __repr__(self):
+		return "AND" + repr(self.children)
+
+
+class OrQuery:
+	"""
+	A query matching the pages matched by any of its children.
+	"""
+
+	def __init__(self, children):
+		self.children = list(children)
+
+	def words(self):
+		return [word for child in self.children for word in child.words()]
+
+	def __eq__(self, other):
+		return isinstance(other, OrQuery) and self.children == other.children
+
+	def __repr__(self):
+		return "OR" + repr(self.children)
+
+
+class NotQuery:
+	"""
+	A query excluding the pages matched by its child. It only matches anything as part of an AndQuery.
+	"""
+
+	def __init__(self, child):
+		self.child = child
+
+	def words(self):
+		return self.child.words()
+
+	def __eq__(self, other):
+		return isinstance(other, NotQuery) and self.child == other.child
+
+	def __repr__(self):
+		return "NOT" + repr(self.child)
+
+
+def parse_query(text):
+	"""
+	parses a boolean query. Words next to each other must all match, unless joined by OR, which binds looser than the
+	implicit AND. A word or group prefixed by NOT or - excludes pages, and parentheses group sub queries. The operators
+	AND, OR and NOT must be written in upper case. Words in double quotes form a phrase, and a phrase followed by ~N
+	matches its words within N positions of each other.
+	:param text: the query text.
+	:return: the parsed query, or None if the query has no words.
+	"""
+	tokens = QUERY_TOKEN.findall(text)
+	query, position = _parse_or(tokens, 0)
+	while position < len(tokens):
+		# unbalanced closing parentheses are ignored
+		rest, position = _parse_or(tokens, position + 1)
+		query = _combine(AndQuery, [child for child in (query, rest) if child is not None])
+	return query
+
+
+def normalize_query(query, normalize):
+	"""
+	normalizes the words of a parsed query, so that queries differing only in the case or punctuation of their words
+	become equal.
+	:param query: the parsed query, or None.
+	:param normalize: the function normalizing a single word.
+	:return: the normalized query.
+	"""
+	if isinstance(query, TermQuery):
+		return TermQuery(normalize(query.word))
+	if isinstance(query, PhraseQuery):
+		return PhraseQuery([normalize(word) for word in query.phrase], query.slop)
+	if isinstance(query, NotQuery):
+		return NotQuery(normalize_query(query.child, normalize))
+	if isinstance(query, (AndQuery, OrQuery)):
+		return type(query)([normalize_query(child, normalize) for child in query.children])
+	return query
+
+
+def _parse_or(tokens, position):
+	children = []
+	child, position = _parse_and(tokens, position)
+	if child is not None:
+		children.append(child)
+	while position < len(tokens) and tokens[position] == "OR":
+		child, position = _parse_and(tokens, position + 1)
+		if child is not None:
+			children.append(child)
+	return _combine(OrQuery, children), position
+
+
+def _parse_and(tokens, position):
+	children = []
+	while position < len(tokens) and tokens[position] not in ("OR", ")"):
+		if tokens[position] == "AND":
+			position += 1
+			continue
+		child, position = _parse_unary(tokens, position)
+		if child is not None:
+			children.append(child)
+	return _combine(AndQuery, children), position
+
+
+def _parse_unary(tokens, position):
+	token = tokens[position]
+	if token == "NOT":
+		if position + 1 == len(tokens) or tokens[position + 1] in ("OR", ")"):
+			return None, position + 1
+		child, position = _parse_unary(tokens, position + 1)
+		return (None if child is None else NotQuery(child)), position
+	if token == "(":
+		child, position = _parse_or(tokens, position + 1)
+		if position < len(tokens) and tokens[position] == ")":
+			position += 1
+		return child, position
+	if token.startswith('"'):
+		match = PHRASE.match(token)
+		words = [word for word, _ in tokenize(match.group(1))]
+		slop = int(match.group(2) or 0)
+		if len(words) == 0:
+			return None, position + 1
+		if len(words) == 1:
+			return TermQuery(words[0]), position + 1
+		return PhraseQuery(words, slop), position + 1
+	if token == "-":
+		# the tokens split a - from the group it excludes, any other lone - is no word
+		if position + 1 == len(tokens) or tokens[position + 1] != "(":
+			return None, position + 1
+		child, position = _parse_unary(tokens, position + 1)
+		return (None if child is None else NotQuery(child)), position
+	if token.startswith("-"):
+		child, _ = _parse_unary([token[1:]], 0)
+		return (None if child is None else NotQuery(child)), position + 1
+	return TermQuery(token), position + 1
+
+
+def _combine(kind, children):
+	if len(children) == 0:
+		return None
+	if len(children) == 1:
+		return children[0]
+	return kind(children)
+
+
+def query_terms(query):
+	"""
+	splits a query into the words a page may contain and the sub queries of the pages to exclude.
+	:param query: the parsed query.
+	:return: a tuple of the list of words and the list of excluding queries.
+	"""
+	if query is None:
+		return [], []
+	if isinstance(query, NotQuery):
+		return [], [query.child]
+	if isinstance(query, (AndQuery, OrQuery)):
+		words, excluded = [], []
+		for child in query.children:
+			child_words, child_excluded = query_terms(child)
+			words.extend(child_words)
+			excluded.extend(child_excluded)
+		return words, excluded
+	return query.words(), []
+
+
+def required_phrases(query):
+	"""
+	finds the phrases every page matching a query must match, which are the phrases the query or its AND children
+	consist of, and not those under an OR or NOT.
+	:param query: the parsed query.
+	:return: the list of PhraseQuery.
+	"""
+	if isinstance(query, PhraseQuery):
+		return [query]
+	if isinstance(query, AndQuery):
+		return [phrase for child in query.children for phrase in required_phrases(child)]
+	return []
+
+
+def gallop(values, target, low):
+	"""
+	finds the first position at or after low holding a value not less than target, probing positions low, low + 1,
+	low + 3, low + 7 and so on before binary searching the last step. This takes time logarithmic in the distance
+	skipped rather than in the length of the list.
+	:param values: a sorted list.
+	:param target: the value to look for.
+	:param low: the position to start at.
+	:return: the found position, or len(values) if every remaining value is less than target.
+	"""
+	step = 1
+	high = low
+	while high < len(values) and values[high] < target:
+		low = high + 1
+		high += step
+		step *= 2
+	return bisect_left(values, target, low, min(high, len(values)))
+
+
+def intersect(shorter, longer):
+	"""
+	intersects two sorted lists by galloping through the longer list for each value of the shorter one.
+	:param shorter: the sorted list with fewer values.
+	:param longer: the sorted list with more values.
+	:return: the sorted values in both lists.
+	"""
+	result = []
+	position = 0
+	for value in shorter:
+		position = gallop(longer, value, position)
+		if position == len(longer):
+			break
+		if longer[position] == value:
+			result.append(value)
+	return result
+
+
+def difference(values, excluded):
+	"""
+	removes the values of a sorted list from another sorted list.
+	:param values: the sorted list to filter.
+	:param excluded: the sorted list of values to remove.
+	:return: the sorted values that are not excluded.
+	"""
+	result = []
+	position = 0
+	for value in values:
+		position = gallop(excluded, value, position)
+		if position == len(excluded) or excluded[position] != value:
+			result.append(value)
+	return result
+
+
+def union(lists):
+	"""
+	merges sorted lists.
+	:param lists: the sorted lists.
+	:return: the sorted values in any of the lists, without duplicates.
+	"""
+	result = []
+	for value in heapq.merge(*lists):
+		if len(result) == 0 or result[-1] != value:
+			result.append(value)
+	return result
+
+
+def section_positions(hits):
+	"""
+	groups the positions of a hit list by section.
+	:param hits: the hit list.
+	:return: a dictionary mapping (kind, section) to the sorted positions of the hits in that section.
+	"""
+	sections = {}
+	for hit in hits:
+		key = (hit.kind, hit.section)
+		if key not in sections:
+			sections[key] = []
+		sections[key].append(hit.position)
+	for positions in sections.values():
+		positions.sort()
+	return sections
+
+
+def minimum_span(position_lists):
+	"""
+	finds the smallest window of positions containing at least one position of every list.
+	:param position_lists: sorted lists of positions.
+	:return: the distance between the first and the last position of the smallest window.
+	"""
+	heap = [(positions[0], index, 0) for index, positions in enumerate(position_lists)]
+	heapq.heapify(heap)
+	highest = max(entry[0] for entry in heap)
+	best = highest - heap[0][0]
+	while True:
+		lowest, index, offset = heapq.heappop(heap)
+		best = min(best, highest - lowest)
+		if offset + 1 == len(position_lists[index]):
+			return best
+		following = position_lists[index][offset + 1]
+		highest = max(highest, following)
+		heapq.heappush(heap, (following, index, offset + 1))
+
+
+def phrase_span(hit_lists, ordered):
+	"""
+	finds how close the words of a phrase occur in a page.
+	:param hit_lists: the hit list of each word of the phrase on the page, in phrase order.
+	:param ordered: if True, only count occurrences where the words are next to each other in phrase order.
+	:return: the smallest span, in positions, of a section containing all the words, or None if no section does. An
+	exact phrase has a span of len(hit_lists) - 1.
+	"""
+	sections = [section_positions(hits) for hits in hit_lists]
+	best = None
+	for key, first_positions in sections[0].items():
+		other_positions = [positions.get(key) for positions in sections[1:]]
+		if any(positions is None for positions in other_positions):
+			continue
+		if ordered:
+			position_sets = [set(positions) for positions in other_positions]
+			for position in first_positions:
+				if all(position + offset + 1 in positions for offset, positions in enumerate(position_sets)):
+					return len(hit_lists) - 1
+			continue
+		span = minimum_span([first_positions] + other_positions)
+		if best is None or span < best:
+			best = span
+	return best
+
+
+def proximity_score(hit_lists, window):
+	"""
+	scores how close the words of a query occur in a page.
+	:param hit_lists: the hit list of each word on the page.
+	:param window: the largest span, in positions, that still scores.
+	:return: a score from 0, when the words are never within window positions in the same section, to 1, when they are
+	next to each other.
+	"""
+	if len(hit_lists) < 2:
+		return 0
+	span = phrase_span(hit_lists, False)
+	if span is None or span > window:
+		return 0
+	return (window + len(hit_lists) - 1 - span) / window if window > 0 else 1
+
+
+class QueryEngine:
+	"""
+	Evaluates boolean queries against the sorted page id lists of a posting source, such as the ReverseIndex or the
+	SegmentIndex. The children of an AND are evaluated from the rarest to the most common, each only at the pages
+	matching so far, and evaluation stops as soon as the intersection is empty, so the cost of a query is bounded by its
+	shortest posting list.
+	"""
+
+	def __init__(self, postings, word_dictionary):
+		"""
+		creates a new QueryEngine.
+		:param postings: the posting source, providing get_page_ids, filter_page_ids, get_hits and document_frequency
+		by word id.
+		:param word_dictionary: the WordDictionary to look up the words of the queries.
+		"""
+		self._postings = postings
+		self._word_dictionary = word_dictionary
+
+	def search(self, query):
+		"""
+		finds the pages matching a query.
+		:param query: the query text or a parsed query.
+		:return: the matching page ids in ascending order.
+		"""
+		if isinstance(query, str):
+			query = parse_query(query)
+		if query is None:
+			return []
+		word_ids = self._word_dictionary.lookup_word_ids(query.words())
+		return self._evaluate(query, word_ids)
+
+	def _evaluate(self, query, word_ids, candidates=None):
+		"""
+		finds the pages matching a query, among the candidate pages if given. A word is then only probed at the
+		candidate pages, so its posting list is never fetched in full.
+		"""
+		if isinstance(query, TermQuery):
+			word_id = word_ids.get(query.word)
+			if word_id is None:
+				return []
+			if candidates is None:
+				return list(self._postings.get_page_ids(word_id))
+			return self._postings.filter_page_ids(word_id, candidates)
+		if isinstance(query, OrQuery):
+			return union([self._evaluate(child, word_ids, candidates) for child in query.children])
+		if isinstance(query, AndQuery):
+			return self._evaluate_and(query, word_ids, candidates)
+		if isinstance(query, PhraseQuery):
+			return self._evaluate_phrase(query, word_ids, candidates)
+		# a query that only excludes pages matches nothing
+		return []
+
+	def _evaluate_and(self, query, word_ids, candidates=None):
+		"""
+		evaluates the rarest child in full and every other child only at the pages still matching, which gallops the
+		posting lists of the other children against the result so far. Nested groups are evaluated as part of this one,
+		so a group that only excludes pages, like in "page (-a -b)", excludes them from the other children.
+		"""
+		children = _and_children(query)
+		included = [child for child in children if not isinstance(child, NotQuery)]
+		excluded = [child.child for child in children if isinstance(child, NotQuery)]
+		if len(included) == 0:
+			return []
+		included.sort(key=lambda child: self._estimate(child, word_ids))
+		result = candidates
+		for child in included:
+			if result is not None and len(result) == 0:
+				return result
+			result = self._evaluate(child, word_ids, result)
+		for child in excluded:
+			if len(result) == 0:
+				return result
+			result = difference(result, self._evaluate(child, word_ids, result))
+		return result
+
+	def _evaluate_phrase(self, query, word_ids, candidates=None):
+		"""
+		finds the pages containing all words of a phrase like an AND query, and only then decodes the hits of the
+		remaining candidate pages to check the positions.
+		"""
+		candidates = self._evaluate_and(AndQuery([TermQuery(word) for word in query.phrase]), word_ids, candidates)
+		if len(candidates) == 0:
+			return candidates
+		hits = {}
+		for word in set(query.phrase):
+			hits[word] = self._postings.get_hits(word_ids[word], candidates)
+		result = []
+		for page_id in candidates:
+			span = phrase_span([hits[word][page_id] for word in query.phrase], query.slop == 0)
+			if span is not None and span <= max(query.slop, len(query.phrase) - 1):
+				result.append(page_id)
+		return result
+
+	def _estimate(self, query, word_ids):
+		"""
+		estimates the amount of pages a query matches without fetching any posting list.
+		"""
+		if isinstance(query, TermQuery):
+			word_id = word_ids.get(query.word)
+			return 0 if word_id is None else self._postings.document_frequency(word_id)
+		if isinstance(query, OrQuery):
+			return sum(self._estimate(child, word_ids) for child in query.children)
+		if isinstance(query, AndQuery):
+			# a query that only excludes pages matches nothing
+			return min((self._estimate(child, word_ids) for child in _and_children(query)
+			            if not isinstance(child, NotQuery)), default=0)
+		if isinstance(query, PhraseQuery):
+			return min(self._estimate(TermQuery(word), word_ids) for word in query.phrase)
+		return 0
+
+
+def _and_children(query):
+	"""
+	gets the children of an AndQuery, with the children of nested AndQuery in place of them.
+	"""
+	children = []
+	for child in query.children:
+		children.extend(_and_children(child) if isinstance(child, AndQuery) else [child])
+	return children
+
+
+class TestQueryParser(unittest.TestCase):
+
+	def test_implicit_and(self):
+		self.assertEqual(AndQuery([TermQuery("page"), TermQuery("rank")]), parse_query("page  rank"))
+		self.assertEqual(AndQuery([TermQuery("page"), TermQuery("rank")]), parse_query("page AND rank"))
+		self.assertEqual(TermQuery("page"), parse_query("page"))
+		self.assertIsNone(parse_query("  "))
+
+	def test_normalize_query(self):
+		expected = AndQuery([TermQuery("page"), NotQuery(PhraseQuery(["web", "search"], 2))])
+		self.assertEqual(expected, normalize_query(parse_query('Page -"Web Search"~2'), str.lower))
+
+	def test_precedence(self):
+		expected = OrQuery([AndQuery([TermQuery("a"), TermQuery("b")]), TermQuery("c")])
+		self.assertEqual(expected, parse_query("a b OR c"))
+		expected = AndQuery([TermQuery("a"), OrQuery([TermQuery("b"), TermQuery("c")])])
+		self.assertEqual(expected, parse_query("a (b OR c)"))
+
+	def test_not(self):
+		expected = AndQuery([TermQuery("a"), NotQuery(TermQuery("b")), NotQuery(TermQuery("c"))])
+		self.assertEqual(expected, parse_query("a NOT b -c"))
+		self.assertEqual((["a", "d", "d", "e"], [TermQuery("b"), TermQuery("c")]),
+		                 query_terms(parse_query('a NOT b -c (d OR "d e")')))
+		self.assertEqual([PhraseQuery(["a", "b"]), PhraseQuery(["e", "f"], 1)],
+		                 required_phrases(parse_query('"a b" -"c d" ("e f"~1 (g OR "h i"))')))
+		expected = AndQuery([TermQuery("a"), NotQuery(OrQuery([TermQuery("b"), TermQuery("c")]))])
+		self.assertEqual(expected, parse_query("a -(b OR c)"), "A - before a group should exclude the group")
+		self.assertEqual(AndQuery([TermQuery("a"), TermQuery("b")]), parse_query("a - b"))
+
+
+class TestPhrase(unittest.TestCase):
+
+	def test_parse(self):
+		expected = AndQuery([PhraseQuery(["page", "rank"]), NotQuery(PhraseQuery(["web", "search"], 3))])
+		self.assertEqual(expected, parse_query('"page rank" -"web search"~3'))
+		self.assertEqual(TermQuery("page"), parse_query('"page"'))
+		self.assertEqual(PhraseQuery(["page", "rank"]), parse_query('"page rank'))
+
+	def test_span(self):
+		page = [Hit(Hit.TEXT_HIT, 1, 0), Hit(Hit.TEXT_HIT, 2, 7)]
+		rank = [Hit(Hit.TEXT_HIT, 1, 5), Hit(Hit.TEXT_HIT, 2, 8), Hit(Hit.TITLE_HIT, 0, 0)]
+		self.assertEqual(1, phrase_span([page, rank], True), "Failed to find the exact phrase")
+		self.assertIsNone(phrase_span([rank, page], True), "Phrase matched in the wrong order")
+		self.assertEqual(1, phrase_span([rank, page], False), "Failed to find the closest occurrence")
+		self.assertIsNone(phrase_span([page, [Hit(Hit.TEXT_HIT, 3, 0)]], False), "Matched across sections")
+		self.assertEqual(3, minimum_span([[1, 10, 20], [4, 12], [13, 30]]))
+		self.assertEqual(1, proximity_score([page, rank], 5), "Adjacent words should score 1")
+		self.assertEqual(0, proximity_score([page, [Hit(Hit.TEXT_HIT, 1, 9)]], 5), "Distant words should score 0")
+
+
+class TestQueryEngine(unittest.TestCase):
+
+	class Postings:
+
+		def __init__(self, lists):
+			self.lists = lists
+			self.fetched = []
+			self.filtered = []
+
+		def get_page_ids(self, word_id):
+			self.fetched.append(word_id)
+			return self.lists[word_id]
+
+		def filter_page_ids(self, word_id, page_ids):
+			self.filtered.append(word_id)
+			return intersect(page_ids, self.lists[word_id])
+
+		def document_frequency(self, word_id):
+			return len(self.lists[word_id])
+
+		@staticmethod
+		def get_hits(word_id, page_ids):
+			# "rare" is followed by "other" on page 500 only
+			position = 0 if word_id == 2 else 1
+			return {page_id: [Hit(Hit.TEXT_HIT, 0, position if page_id == 500 else 5)] for page_id in page_ids}
+
+	class Dictionary:
+
+		@staticmethod
+		def lookup_word_ids(words):
+			ids = {"common": 1, "rare": 2, "other": 3, "missing": 4}
+			return {word: ids[word] for word in words if word in ids}
+
+	def setUp(self):
+		self.postings = self.Postings({1: list(range(0, 1000)), 2: [5, 500, 2000], 3: [6, 500], 4: []})
+		self.engine = QueryEngine(self.postings, self.Dictionary())
+
+	def test_and(self):
+		self.assertEqual([5, 500], self.engine.search("common rare"))
+		self.assertEqual([2], self.postings.fetched, "Only the posting list of the rarest term should be fetched")
+		self.assertEqual([1], self.postings.filtered, "The common term should only be probed at the rare pages")
+		self.postings.fetched.clear()
+		self.assertEqual([], self.engine.search("common missing rare"))
+		self.assertEqual([4], self.postings.fetched, "Evaluation should stop at an empty posting list")
+		self.assertEqual([], self.engine.search("common unknown"))
+
+	def test_or_not(self):
+		self.assertEqual([5, 6, 500, 2000], self.engine.search("rare OR other"))
+		self.assertEqual([5, 2000], self.engine.search("rare -other"))
+		self.assertEqual([5, 2000], self.engine.search("rare -(other OR missing)"))
+		self.assertEqual([], self.engine.search("NOT rare"))
+		self.assertEqual([5, 2000], self.engine.search("rare (-other -missing)"), "Excluding group was not applied")
+		self.assertEqual([5, 2000], self.engine.search("rare (NOT other NOT missing)"))
+		self.assertEqual([], self.engine.search("(-other -missing)"), "Excluding query should match nothing")
+
+	def test_phrase(self):
+		self.assertEqual([500], self.engine.search('"rare other"'))
+		self.assertEqual([], self.engine.search('"other rare"'))
+		self.assertEqual([500], self.engine.search('"other rare"~1'))
+
+	def test_set_operations(self):
+		self.assertEqual([3, 9], intersect([1, 3, 9], [0, 2, 3, 4, 5, 6, 7, 8, 9, 10]))
+		self.assertEqual([1, 10], difference([1, 3, 9, 10], [3, 4, 9]))
+		self.assertEqual([1, 2, 3], union([[1, 3], [2, 3], []]))
+		self.assertEqual(3, gallop([1, 2, 3, 7, 9], 5, 1))
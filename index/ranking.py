@@ -0,0 +1,186 @@
+import heapq
+import math
+import unittest
+
+from index.entry import Hit
+from index.query import gallop
+
+# the weight of a hit of each kind, so that a word in the title or url counts more than a word in the text
+HIT_WEIGHTS = {
+	Hit.TEXT_HIT: 1.0,
+	Hit.ANCHOR_HIT: 3.0,
+	Hit.TITLE_HIT: 5.0,
+	Hit.HEADER_HIT: 2.0,
+	Hit.URL_HIT: 4.0,
+	Hit.REFERENCE_HIT: 1.0,
+}
+
+
+def hit_weight(hits):
+	"""
+	calculates the text score of a word on a page from its hit list, as the dot product of the weight of each hit kind
+	with a count weight that grows with the amount of hits of that kind but quickly tapers off.
+	:param hits: the hit list of the word on the page.
+	:return: the text score.
+	"""
+	counts = {}
+	for hit in hits:
+		counts[hit.kind] = counts.get(hit.kind, 0) + 1
+	return sum(HIT_WEIGHTS.get(kind, 1.0) * math.log1p(count) for kind, count in counts.items())
+
+
+class PostingCursor:
+	"""
+	A cursor over the page ids and text scores of a posting list held in memory.
+	"""
+
+	def __init__(self, page_ids, weights, upper_bound, hit_lists=None):
+		"""
+		creates a new PostingCursor.
+		:param page_ids: the sorted page ids of the posting list.
+		:param weights: the text score of the word on each page.
+		:param upper_bound: the highest text score in the posting list.
+		:param hit_lists: the encoded hit list of the word on each page, or None if they are not needed.
+		"""
+		self.page_ids = page_ids
+		self.weights = weights
+		self.hit_lists = hit_lists
+		self.upper_bound = upper_bound
+		self.position = 0
+
+	def page_id(self):
+		return self.page_ids[self.position]
+
+	def weight(self):
+		return self.weights[self.position]
+
+	def hits(self):
+		return self.hit_lists[self.position]
+
+	def next(self):
+		self.position += 1
+
+	def advance_to(self, page_id):
+		"""
+		moves the cursor to the first page with an id not less than page_id.
+		:param page_id: the page id to move to.
+		:return: None.
+		"""
+		self.position = gallop(self.page_ids, page_id, self.position)
+
+	def exhausted(self):
+		return self.position >= len(self.page_ids)
+
+
+def top_k(cursors, k, ranks, default_rank, max_rank, page_rank_weight=1.0, excluded=frozenset(), required=None):
+	"""
+	finds the k pages with the highest score, where the score of a page is the sum of the text scores of the words it
+	contains plus page_rank_weight times its page rank. This is the WAND algorithm: the cursors are kept sorted by their
+	current page, and the first page where the upper bounds of the cursors up to it, plus the largest possible page rank
+	score, exceed the score of the current k-th result is the pivot. Pages before the pivot cannot enter the top k, so
+	the cursors skip over them without scoring them. Cursors only read their posting lists where they move to, so with
+	lazy cursors the skipped pages are not read either.
+	:param cursors: a cursor for each word, such as a PostingCursor, with page_id, weight, next, advance_to, exhausted
+	and an upper_bound of its text scores.
+	:param k: the amount of results to find.
+	:param ranks: a dictionary mapping page ids to their page rank.
+	:param default_rank: the page rank of pages missing from ranks.
+	:param max_rank: the highest page rank of any page.
+	:param page_rank_weight: the weight of the page rank in the score.
+	:param excluded: a set of page ids that must not be in the result.
+	:param required: a sorted list of page ids the result must be among, or None to allow any page. The cursors skip
+	straight to the next required page.
+	:return: a list of (page_id, score) tuples sorted by descending score.
+	"""
+	heap = []
+	threshold = -math.inf
+	rank_bound = page_rank_weight * max_rank
+	position = 0
+	cursors = [cursor for cursor in cursors if not cursor.exhausted()]
+	while len(cursors) != 0 and k > 0:
+		cursors.sort(key=lambda cursor: cursor.page_id())
+		bound = rank_bound
+		pivot = None
+		for index, cursor in enumerate(cursors):
+			bound += cursor.upper_bound
+			if bound > threshold:
+				pivot = index
+				break
+		if pivot is None:
+			break
+		pivot_page = cursors[pivot].page_id()
+		if required is not None:
+			position = gallop(required, pivot_page, position)
+			if position == len(required):
+				break
+			if required[position] != pivot_page:
+				for cursor in cursors:
+					cursor.advance_to(required[position])
+				cursors = [cursor for cursor in cursors if not cursor.exhausted()]
+				continue
+		if cursors[0].page_id() == pivot_page:
+			score = page_rank_weight * ranks.get(pivot_page, default_rank)
+			for cursor in cursors:
+				if cursor.page_id() != pivot_page:
+					break
+				score += cursor.weight()
+				cursor.next()
+			if pivot_page not in excluded:
+				if len(heap) < k:
+					heapq.heappush(heap, (score, -pivot_page))
+				elif score > heap[0][0]:
+					heapq.heapreplace(heap, (score, -pivot_page))
+			if len(heap) == k:
+				threshold = heap[0][0]
+		else:
+			for cursor in cursors[:pivot]:
+				cursor.advance_to(pivot_page)
+		cursors = [cursor for cursor in cursors if not cursor.exhausted()]
+	return [(-page, score) for score, page in sorted(heap, reverse=True)]
+
+
+class TestRanking(unittest.TestCase):
+
+	class CountingRanks(dict):
+
+		def __init__(self, *args):
+			dict.__init__(self, *args)
+			self.lookups = 0
+
+		def get(self, key, default=None):
+			self.lookups += 1
+			return dict.get(self, key, default)
+
+	def test_hit_weight(self):
+		title = hit_weight([Hit(Hit.TITLE_HIT, 0, 0)])
+		text = hit_weight([Hit(Hit.TEXT_HIT, 1, 0)])
+		many_text = hit_weight([Hit(Hit.TEXT_HIT, 1, position) for position in range(100)])
+		self.assertGreater(title, text, "Title hits should weigh more than text hits")
+		self.assertLess(many_text, 10 * text, "The count weight should taper off")
+
+	def test_top_k(self):
+		common = list(range(1000))
+		rare = [10, 20, 500, 999]
+		lists = {"common": (common, [1.0 + (page % 7) / 10 for page in common]),
+		         "rare": (rare, [5.0, 9.0, 1.0, 6.0])}
+		ranks = self.CountingRanks({page: 0.5 + (page % 13) / 100 for page in common})
+		cursors = [PostingCursor(page_ids, weights, max(weights)) for page_ids, weights in lists.values()]
+		result = top_k(cursors, 2, ranks, 0.2, max(ranks.values()))
+		scores = {}
+		for page_ids, weights in lists.values():
+			for page, weight in zip(page_ids, weights):
+				scores[page] = scores.get(page, ranks[page]) + weight
+		expected = sorted(scores.items(), key=lambda entry: (-entry[1], entry[0]))[:2]
+		self.assertEqual([page for page, _ in expected], [page for page, _ in result], "WAND found the wrong pages")
+		for (_, expected_score), (_, score) in zip(expected, result):
+			self.assertAlmostEqual(expected_score, score)
+		self.assertLess(ranks.lookups, 50, "WAND failed to skip pages that cannot enter the top k")
+		self.assertEqual([], top_k([], 3, ranks, 0.2, 1.0))
+		cursors = [PostingCursor(page_ids, weights, max(weights)) for page_ids, weights in lists.values()]
+		result = top_k(cursors, 2, ranks, 0.2, max(ranks.values()), excluded={20})
+		self.assertEqual([page for page, _ in expected[1:]], [page for page, _ in result[:1]],
+		                 "WAND returned an excluded page")
+		cursors = [PostingCursor(page_ids, weights, max(weights)) for page_ids, weights in lists.values()]
+		result = top_k(cursors, 2, ranks, 0.2, max(ranks.values()), required=[3, 500, 2000])
+		self.assertEqual([500, 3], [page for page, _ in result], "WAND returned a page that is not required")
+		self.assertAlmostEqual(scores[500], result[0][1])
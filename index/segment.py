@@ -0,0 +1,964 @@
+import heapq
+import json
+import math
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import unittest
+
+from index.entry import ForwardIndexEntry
+from index.entry import Hit
+from index.entry import ReverseIndexEntry
+from index.exceptions import SegmentException
+from index.posting import decode_hits
+from index.posting import decode_varint
+from index.posting import encode_hits
+from index.posting import encode_varint
+from index.ranking import PostingCursor
+from index.ranking import hit_weight
+
+SEGMENT_MAGIC = b"HSEG"
+SEGMENT_VERSION = 3
+# the amount of postings between two skip entries of a posting list
+SKIP_INTERVAL = 64
+SEGMENT_SUFFIX = ".seg"
+MANIFEST_NAME = "MANIFEST"
+PENDING_NAME = "PENDING"
+# magic, version, term count, document count, term dictionary offset, document table offset
+HEADER = struct.Struct("<4sIQQQQ")
+# word id, postings offset, postings length, document frequency, highest text score
+TERM = struct.Struct("<qQIIf")
+# the text score of a posting
+WEIGHT = struct.Struct("<f")
+# the page id before a block of postings, its offset
+SKIP = struct.Struct("<qQ")
+# page id, hit count
+DOCUMENT = struct.Struct("<qI")
+# the page id of an entry of the pending file
+PENDING = struct.Struct("<q")
+
+
+def write_segment(path, rows):
+	"""
+	writes an immutable segment file. The file starts with a header, followed by the posting lists of all terms, a term
+	dictionary of fixed size records sorted by word id and a document table of fixed size records sorted by page id,
+	so that a memory mapped segment can be searched without deserializing it. A posting list holds, for every page, the
+	varint encoded page id difference to the previous page, the hit count, the text score as a 32 bit float, and the
+	length and bytes of the encoded hit list. Every SKIP_INTERVAL postings the page id difference starts from a skip
+	entry, and the skip entries of a posting list follow it, so that a cursor can seek into the list without decoding
+	it from the start. The file is written to a temporary file first and moved into place once complete.
+	:param path: the path of the segment file.
+	:param rows: an iterable of (word_id, page_id, hit_count, weight, hits) tuples sorted by word id and page id, where
+	weight is the text score and hits is an encoded hit list.
+	:return: the amount of documents in the segment.
+	"""
+	terms = []
+	documents = {}
+	temp_path = path + ".tmp"
+	with open(temp_path, "wb") as segment_file:
+		segment_file.write(bytes(HEADER.size))
+		offset = HEADER.size
+		current_word, start, frequency, previous_page, max_weight, skips = None, offset, 0, 0, 0.0, []
+		buffer = bytearray()
+		for word_id, page_id, hit_count, weight, hits in rows:
+			if word_id != current_word:
+				if current_word is not None:
+					terms.append((current_word, start, offset - start, frequency, max_weight))
+					offset += _write_skips(segment_file, skips)
+				current_word, start, frequency, previous_page, max_weight, skips = word_id, offset, 0, 0, 0.0, []
+			if frequency != 0 and frequency % SKIP_INTERVAL == 0:
+				skips.append((previous_page, offset))
+			encode_varint(page_id - previous_page, buffer)
+			encode_varint(hit_count, buffer)
+			buffer.extend(WEIGHT.pack(weight))
+			encode_varint(len(hits), buffer)
+			buffer.extend(hits)
+			segment_file.write(buffer)
+			offset += len(buffer)
+			buffer.clear()
+			frequency += 1
+			previous_page = page_id
+			max_weight = max(max_weight, weight)
+			documents[page_id] = documents.get(page_id, 0) + hit_count
+		if current_word is not None:
+			terms.append((current_word, start, offset - start, frequency, max_weight))
+			offset += _write_skips(segment_file, skips)
+		terms_offset = offset
+		for term in terms:
+			segment_file.write(TERM.pack(*term))
+		documents_offset = terms_offset + len(terms) * TERM.size
+		for page_id in sorted(documents.keys()):
+			segment_file.write(DOCUMENT.pack(page_id, documents[page_id]))
+		segment_file.seek(0)
+		segment_file.write(HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, len(terms), len(documents), terms_offset,
+		                               documents_offset))
+		segment_file.flush()
+		os.fsync(segment_file.fileno())
+	os.replace(temp_path, path)
+	return len(documents)
+
+
+def _write_skips(segment_file, skips):
+	for skip in skips:
+		segment_file.write(SKIP.pack(*skip))
+	return len(skips) * SKIP.size
+
+
+class Segment:
+	"""
+	A read only view of a memory mapped segment file written by write_segment. Lookups binary search the term
+	dictionary and the document table in place, so opening a segment costs the same regardless of its size.
+	"""
+
+	def __init__(self, path):
+		"""
+		opens a segment file.
+		:param path: the path of the segment file.
+		"""
+		self.path = path
+		self.name = os.path.basename(path)
+		try:
+			with open(path, "rb") as segment_file:
+				self._data = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+			magic, version, self.term_count, self.document_count, self._terms_offset, self._documents_offset = \
+				HEADER.unpack_from(self._data, 0)
+		except (OSError, ValueError, struct.error) as e:
+			raise SegmentException(path) from e
+		if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+			self._data.close()
+			raise SegmentException(path)
+
+	def postings(self, word_id):
+		"""
+		gets the postings of a word in this segment.
+		:param word_id: the word id to look up.
+		:return: a generator of (page_id, hit_count, weight, hits) tuples in ascending page order, where weight is the
+		text score and hits is an encoded hit list.
+		"""
+		term = self._find_term(word_id)
+		if term is None:
+			return iter(())
+		return self._read_postings(term[1], term[2])
+
+	def cursor(self, word_id):
+		"""
+		gets a cursor over the postings of a word in this segment.
+		:param word_id: the word id to look up.
+		:return: a SegmentCursor, or an exhausted PostingCursor if the word is not in this segment.
+		"""
+		term = self._find_term(word_id)
+		if term is None:
+			return PostingCursor([], [], 0.0)
+		return SegmentCursor(self._data, term)
+
+	def max_weight(self, word_id):
+		"""
+		gets the highest text score of a word in this segment.
+		:param word_id: the word id to look up.
+		:return: the highest text score, or 0 if the word is not in this segment.
+		"""
+		term = self._find_term(word_id)
+		return 0.0 if term is None else term[4]
+
+	def document_frequency(self, word_id):
+		"""
+		gets the amount of pages in this segment containing a word.
+		:param word_id: the word id to look up.
+		:return: the amount of pages.
+		"""
+		term = self._find_term(word_id)
+		return 0 if term is None else term[3]
+
+	def contains_document(self, page_id):
+		"""
+		checks whether this segment holds a version of a page.
+		:param page_id: the page id to look for.
+		:return: True if the page is in this segment.
+		"""
+		low, high = 0, self.document_count
+		while low < high:
+			middle = (low + high) // 2
+			found = DOCUMENT.unpack_from(self._data, self._documents_offset + middle * DOCUMENT.size)[0]
+			if found < page_id:
+				low = middle + 1
+			elif found > page_id:
+				high = middle
+			else:
+				return True
+		return False
+
+	def documents(self):
+		"""
+		iterates the document table of this segment.
+		:return: a generator of (page_id, hit_count) tuples in ascending page order.
+		"""
+		for index in range(self.document_count):
+			yield DOCUMENT.unpack_from(self._data, self._documents_offset + index * DOCUMENT.size)
+
+	def rows(self):
+		"""
+		iterates all postings of this segment.
+		:return: a generator of (word_id, page_id, hit_count, weight, hits) tuples sorted by word id and page id.
+		"""
+		for index in range(self.term_count):
+			word_id, offset, length, _, _ = TERM.unpack_from(self._data, self._terms_offset + index * TERM.size)
+			for posting in self._read_postings(offset, length):
+				yield (word_id,) + posting
+
+	def size(self):
+		"""
+		gets the size of the segment file.
+		:return: the size in bytes.
+		"""
+		return len(self._data)
+
+	def close(self):
+		"""
+		unmaps the segment file.
+		:return: None.
+		"""
+		self._data.close()
+
+	def _find_term(self, word_id):
+		low, high = 0, self.term_count
+		while low < high:
+			middle = (low + high) // 2
+			term = TERM.unpack_from(self._data, self._terms_offset + middle * TERM.size)
+			if term[0] < word_id:
+				low = middle + 1
+			elif term[0] > word_id:
+				high = middle
+			else:
+				return term
+		return None
+
+	def _read_postings(self, offset, length):
+		end = offset + length
+		page_id = 0
+		while offset < end:
+			delta, offset = decode_varint(self._data, offset)
+			hit_count, offset = decode_varint(self._data, offset)
+			weight = WEIGHT.unpack_from(self._data, offset)[0]
+			hits_length, offset = decode_varint(self._data, offset + WEIGHT.size)
+			page_id += delta
+			yield page_id, hit_count, weight, self._data[offset:offset + hits_length]
+			offset += hits_length
+
+
+class SegmentCursor:
+	"""
+	A cursor over the posting list of a word in a memory mapped segment, decoding one posting at a time. Seeking binary
+	searches the skip entries of the list for the last block starting before the target page, so it decodes at most
+	SKIP_INTERVAL postings.
+	"""
+
+	def __init__(self, data, term):
+		"""
+		creates a new SegmentCursor.
+		:param data: the memory mapped segment file.
+		:param term: the term dictionary record of the word.
+		"""
+		_, offset, length, frequency, self.upper_bound = term
+		self._data = data
+		self._offset = offset
+		self._end = offset + length
+		self._skip_count = (frequency - 1) // SKIP_INTERVAL
+		self._current_page = 0
+		self._posting = None
+		self.next()
+
+	def page_id(self):
+		return self._posting[0]
+
+	def hit_count(self):
+		return self._posting[1]
+
+	def weight(self):
+		return self._posting[2]
+
+	def hits(self):
+		"""
+		gets the encoded hit list of the current posting.
+		"""
+		return self._data[self._posting[3]:self._offset]
+
+	def next(self):
+		if self._offset >= self._end:
+			self._posting = None
+			return
+		delta, offset = decode_varint(self._data, self._offset)
+		hit_count, offset = decode_varint(self._data, offset)
+		weight = WEIGHT.unpack_from(self._data, offset)[0]
+		hits_length, offset = decode_varint(self._data, offset + WEIGHT.size)
+		self._current_page += delta
+		self._posting = (self._current_page, hit_count, weight, offset)
+		self._offset = offset + hits_length
+
+	def advance_to(self, page_id):
+		"""
+		moves the cursor to the first page with an id not less than page_id.
+		:param page_id: the page id to move to.
+		:return: None.
+		"""
+		if self._posting is None or self._posting[0] >= page_id:
+			return
+		# the last skip entry whose block starts before page_id
+		low, high = 0, self._skip_count
+		while low < high:
+			middle = (low + high) // 2
+			if SKIP.unpack_from(self._data, self._end + middle * SKIP.size)[0] < page_id:
+				low = middle + 1
+			else:
+				high = middle
+		if low != 0:
+			base, offset = SKIP.unpack_from(self._data, self._end + (low - 1) * SKIP.size)
+			if offset >= self._offset:
+				self._current_page, self._offset = base, offset
+				self.next()
+		while self._posting is not None and self._posting[0] < page_id:
+			self.next()
+
+	def exhausted(self):
+		return self._posting is None
+
+
+class MemorySegment:
+	"""
+	The mutable in memory segment collecting newly indexed pages until they are flushed to a segment file.
+	"""
+
+	def __init__(self):
+		self._terms = {}
+		self._documents = {}
+
+	def add(self, rows):
+		"""
+		adds postings to the segment.
+		:param rows: an iterable of (word_id, page_id, hit_count, weight, hits) tuples.
+		:return: None.
+		"""
+		for word_id, page_id, hit_count, weight, hits in rows:
+			if word_id not in self._terms:
+				self._terms[word_id] = {}
+			self._terms[word_id][page_id] = (hit_count, weight, hits)
+			self._documents.setdefault(page_id, set()).add(word_id)
+
+	def remove(self, page_id):
+		"""
+		removes all postings of a page from the segment.
+		:param page_id: the page id to remove.
+		:return: None.
+		"""
+		for word_id in self._documents.pop(page_id, ()):
+			pages = self._terms[word_id]
+			del pages[page_id]
+			if len(pages) == 0:
+				del self._terms[word_id]
+
+	def postings(self, word_id):
+		pages = self._terms.get(word_id, {})
+		return ((page_id,) + pages[page_id] for page_id in sorted(pages.keys()))
+
+	def cursor(self, word_id):
+		pages = self._terms.get(word_id, {})
+		page_ids = sorted(pages.keys())
+		return PostingCursor(page_ids, [pages[page_id][1] for page_id in page_ids], self.max_weight(word_id),
+		                     [pages[page_id][2] for page_id in page_ids])
+
+	def document_frequency(self, word_id):
+		return len(self._terms.get(word_id, ()))
+
+	def max_weight(self, word_id):
+		return max((posting[1] for posting in self._terms.get(word_id, {}).values()), default=0.0)
+
+	def contains_document(self, page_id):
+		return page_id in self._documents
+
+	def rows(self):
+		for word_id in sorted(self._terms.keys()):
+			for posting in self.postings(word_id):
+				yield (word_id,) + posting
+
+	def __len__(self):
+		return len(self._documents)
+
+
+def shadowed_postings(layers, word_id):
+	"""
+	gets the postings of a word over several segments, where a page in a newer segment replaces all versions of the page
+	in older segments.
+	:param layers: the segments from oldest to newest.
+	:param word_id: the word id to look up.
+	:return: an iterator of (page_id, hit_count, weight, hits) tuples in ascending page order.
+	"""
+	streams = [_unshadowed(layer.postings(word_id), layers[index + 1:], 0) for index, layer in enumerate(layers)]
+	return heapq.merge(*streams, key=lambda posting: posting[0])
+
+
+class ShadowedCursor:
+	"""
+	A cursor over the postings of a word over several segments, where a page in a newer segment replaces all versions of
+	the page in older segments. Each segment is only read where the cursor moves to.
+	"""
+
+	def __init__(self, layers, word_id):
+		"""
+		creates a new ShadowedCursor.
+		:param layers: the segments from oldest to newest.
+		:param word_id: the word id to look up.
+		"""
+		self._cursors = [(layer.cursor(word_id), layers[index + 1:]) for index, layer in enumerate(layers)]
+		self.upper_bound = max((cursor.upper_bound for cursor, _ in self._cursors), default=0.0)
+		for cursor, newer in self._cursors:
+			_skip_shadowed(cursor, newer)
+		self._current, self._current_newer = None, None
+		self._select()
+
+	def page_id(self):
+		return self._current.page_id()
+
+	def weight(self):
+		return self._current.weight()
+
+	def hits(self):
+		return self._current.hits()
+
+	def next(self):
+		cursor, newer = self._current, self._current_newer
+		cursor.next()
+		_skip_shadowed(cursor, newer)
+		self._select()
+
+	def advance_to(self, page_id):
+		"""
+		moves the cursor to the first page with an id not less than page_id.
+		:param page_id: the page id to move to.
+		:return: None.
+		"""
+		for cursor, newer in self._cursors:
+			cursor.advance_to(page_id)
+			_skip_shadowed(cursor, newer)
+		self._select()
+
+	def exhausted(self):
+		return self._current is None
+
+	def _select(self):
+		# every page is in at most one of the cursors once the shadowed versions are skipped
+		self._cursors = [entry for entry in self._cursors if not entry[0].exhausted()]
+		self._current, self._current_newer = min(self._cursors, key=lambda entry: entry[0].page_id(),
+		                                         default=(None, None))
+
+
+def _skip_shadowed(cursor, newer):
+	while not cursor.exhausted() and any(layer.contains_document(cursor.page_id()) for layer in newer):
+		cursor.next()
+
+
+def shadowed_rows(layers):
+	"""
+	iterates all postings of several segments, where a page in a newer segment replaces all versions of the page in
+	older segments.
+	:param layers: the segments from oldest to newest.
+	:return: an iterator of (word_id, page_id, hit_count, weight, hits) tuples sorted by word id and page id.
+	"""
+	streams = [_unshadowed(layer.rows(), layers[index + 1:], 1) for index, layer in enumerate(layers)]
+	return heapq.merge(*streams, key=lambda row: (row[0], row[1]))
+
+
+def _unshadowed(postings, newer, page_field):
+	for posting in postings:
+		if not any(layer.contains_document(posting[page_field]) for layer in newer):
+			yield posting
+
+
+class SegmentIndex:
+	"""
+	A log structured inverted index. New pages are collected in a MemorySegment and flushed into small immutable segment
+	files, which are memory mapped for searching. Segments of similar size are merged into bigger ones, either on demand
+	or by a background thread, and the list of live segments is kept in a manifest file in the segment directory. The
+	page ids about to be added are appended to a pending file until they are flushed, so that pages lost with the in
+	memory segment when the process exits can be added again from the database, see pending_pages. Searching may run
+	concurrently with merging, but adding pages and searching must happen on the same thread, which also unmaps the
+	segments retired by merges, see release_retired. A segment directory belongs to a single process, as the manifest
+	is only read on opening and segments written by other processes are never seen.
+	"""
+
+	def __init__(self, directory, merge_factor=10):
+		"""
+		opens or creates a segment index.
+		:param directory: the directory holding the segment files.
+		:param merge_factor: the amount of segments of the same size tier that are merged together.
+		"""
+		os.makedirs(directory, exist_ok=True)
+		self._directory = directory
+		self._merge_factor = merge_factor
+		self._lock = threading.Lock()
+		self._merge_lock = threading.Lock()
+		self._stop_merging = threading.Event()
+		self._merge_thread = None
+		self._memory = MemorySegment()
+		manifest = self._read_manifest()
+		self._next_id = manifest["next_id"]
+		self._segments = [Segment(os.path.join(directory, name)) for name in manifest["segments"]]
+		self._retired = []
+		self._pending_file = open(os.path.join(directory, PENDING_NAME), "ab")
+
+	def add(self, forward_entry):
+		"""
+		adds the postings of a page to the in memory segment. A page added again replaces its earlier version, both in
+		the in memory segment and, through shadowing, in the segment files.
+		:param forward_entry: the ForwardIndexEntry of the page.
+		:return: None.
+		"""
+		self._memory.remove(forward_entry.page_id)
+		self._memory.add((word_id, forward_entry.page_id, len(hit_list), hit_weight(hit_list), encode_hits(hit_list))
+		                 for word_id, hit_list in forward_entry.hits.items())
+
+	def log_pending(self, page_ids):
+		"""
+		durably records that pages are about to be added, which should happen before the pages are committed to the
+		database. The record is dropped once the pages are flushed.
+		:param page_ids: the page ids.
+		:return: None.
+		"""
+		self._pending_file.write(b"".join(PENDING.pack(page_id) for page_id in page_ids))
+		self._pending_file.flush()
+		os.fsync(self._pending_file.fileno())
+
+	def pending_pages(self):
+		"""
+		gets the pages recorded by log_pending that were not flushed yet. After opening the index, these are the pages
+		that may have been lost with the in memory segment, and should be added again.
+		:return: the set of page ids.
+		"""
+		with open(os.path.join(self._directory, PENDING_NAME), "rb") as pending_file:
+			data = pending_file.read()
+		# an entry cut short by a crash while appending is ignored
+		return {PENDING.unpack_from(data, offset)[0] for offset in
+		        range(0, len(data) - len(data) % PENDING.size, PENDING.size)}
+
+	def buffered_documents(self):
+		"""
+		gets the amount of pages in the in memory segment.
+		:return: the amount of pages not flushed yet.
+		"""
+		return len(self._memory)
+
+	def flush(self):
+		"""
+		writes the in memory segment to a new segment file, and drops the record of the pending pages.
+		:return: None.
+		"""
+		if len(self._memory) != 0:
+			self.write(self._memory.rows())
+			self._memory = MemorySegment()
+		self._clear_pending()
+		self.release_retired()
+
+	def write(self, rows):
+		"""
+		writes postings to a new segment file, which becomes the newest segment.
+		:param rows: an iterable of (word_id, page_id, hit_count, weight, hits) tuples sorted by word id and page id.
+		:return: None.
+		"""
+		segment = self._write_segment(rows)
+		with self._lock:
+			self._segments.append(segment)
+			self._write_manifest()
+
+	def clear(self):
+		"""
+		removes all segments, including the pages not flushed yet.
+		:return: None.
+		"""
+		with self._merge_lock, self._lock:
+			retired = self._segments
+			self._segments = []
+			self._memory = MemorySegment()
+			self._write_manifest()
+		self._clear_pending()
+		self._remove(retired)
+
+	def postings(self, word_id):
+		"""
+		gets the postings of a word over all segments.
+		:param word_id: the word id to search for.
+		:return: an iterator of (page_id, hit_count, weight, hits) tuples in ascending page order.
+		"""
+		return shadowed_postings(self._layers(), word_id)
+
+	def get_entry(self, word_id):
+		"""
+		gets the ReverseIndexEntry of a word.
+		:param word_id: the word id to search for.
+		:return: ReverseIndexEntry mapped by this word id.
+		"""
+		result = ReverseIndexEntry(word_id)
+		result.pages = dict(self.iter_entry(word_id))
+		return result
+
+	def iter_entry(self, word_id):
+		"""
+		streams the pages and hit lists of a word, decoding one hit list at a time.
+		:param word_id: the word id to search for.
+		:return: a generator of (page_id, hit list) tuples in ascending page order.
+		"""
+		for page_id, _, _, hits in self.postings(word_id):
+			yield page_id, decode_hits(hits)
+
+	def get_page_ids(self, word_id):
+		"""
+		gets the page id of all pages containing a word.
+		:param word_id: the word id to search for.
+		:return: all page ids containing the word in ascending order.
+		"""
+		return [posting[0] for posting in self.postings(word_id)]
+
+	def cursor(self, word_id):
+		"""
+		gets a cursor over the postings of a word over all segments, which reads the segments lazily and seeks with
+		their skip entries.
+		:param word_id: the word id to search for.
+		:return: a ShadowedCursor.
+		"""
+		return ShadowedCursor(self._layers(), word_id)
+
+	def filter_page_ids(self, word_id, page_ids):
+		"""
+		finds which of some pages contain a word, by seeking a cursor to each page rather than reading the whole
+		posting list.
+		:param word_id: the word id to search for.
+		:param page_ids: the sorted page ids to check.
+		:return: the sorted page ids containing the word.
+		"""
+		cursor = self.cursor(word_id)
+		result = []
+		for page_id in page_ids:
+			cursor.advance_to(page_id)
+			if cursor.exhausted():
+				break
+			if cursor.page_id() == page_id:
+				result.append(page_id)
+		return result
+
+	def get_hits(self, word_id, page_ids):
+		"""
+		gets the hit lists of a word on some pages. A cursor seeks to each page with the skip entries of the segments,
+		so only the postings near the given pages are read and only their hit lists are decoded.
+		:param word_id: the word id to search for.
+		:param page_ids: the page ids to get the hits on.
+		:return: a dictionary mapping the page ids containing the word to its hit list on the page.
+		"""
+		cursor = self.cursor(word_id)
+		result = {}
+		for page_id in sorted(set(page_ids)):
+			cursor.advance_to(page_id)
+			if cursor.exhausted():
+				break
+			if cursor.page_id() == page_id:
+				result[page_id] = decode_hits(cursor.hits())
+		return result
+
+	def max_weight(self, word_id):
+		"""
+		gets an upper bound of the text score of a word on any page.
+		:param word_id: the word id to search for.
+		:return: the highest text score of the word.
+		"""
+		return max(layer.max_weight(word_id) for layer in self._layers())
+
+	def document_frequency(self, word_id):
+		"""
+		estimates the amount of pages containing a word. Pages replaced by a newer segment are counted once per
+		segment, so the result may be too large.
+		:param word_id: the word id to search for.
+		:return: the estimated amount of pages.
+		"""
+		return sum(layer.document_frequency(word_id) for layer in self._layers())
+
+	def segment_count(self):
+		"""
+		gets the amount of segment files.
+		:return: the amount of segments.
+		"""
+		return len(self._segments)
+
+	def maybe_merge(self):
+		"""
+		merges the oldest run of merge_factor consecutive segments that fall in the same size tier, where the tier of a
+		segment is the logarithm of its document count to the base of merge_factor.
+		:return: True if segments were merged.
+		"""
+		with self._merge_lock:
+			with self._lock:
+				segments = list(self._segments)
+			run = self._find_merge(segments)
+			if run is None:
+				return False
+			merging = segments[run[0]:run[1]]
+			merged = self._write_segment(shadowed_rows(merging))
+			with self._lock:
+				start = self._segments.index(merging[0])
+				self._segments[start:start + len(merging)] = [merged]
+				self._write_manifest()
+			self._remove(merging)
+			return True
+
+	def purge(self, page_ids):
+		"""
+		removes all versions of some pages for good. Each segment file holding one of the pages is rewritten without it,
+		and dropped if no other page is left in it. Searching may run concurrently.
+		:param page_ids: the page ids to remove.
+		:return: the amount of segment files rewritten.
+		"""
+		page_ids = set(page_ids)
+		for page_id in page_ids:
+			self._memory.remove(page_id)
+		rewritten = 0
+		with self._merge_lock:
+			with self._lock:
+				segments = list(self._segments)
+			for segment in segments:
+				if not any(segment.contains_document(page_id) for page_id in page_ids):
+					continue
+				purged = self._write_segment(row for row in segment.rows() if row[1] not in page_ids)
+				replacement = [purged] if purged.document_count != 0 else []
+				with self._lock:
+					position = self._segments.index(segment)
+					self._segments[position:position + 1] = replacement
+					self._write_manifest()
+				if len(replacement) == 0:
+					self._remove([purged])
+				self._remove([segment])
+				rewritten += 1
+		return rewritten
+
+	def start_merging(self, interval=1.0):
+		"""
+		starts a background thread merging segments.
+		:param interval: the amount of seconds between checks for segments to merge.
+		:return: None.
+		"""
+		if self._merge_thread is not None:
+			return
+		self._stop_merging.clear()
+		self._merge_thread = threading.Thread(target=self._merge_loop, args=(interval,), daemon=True)
+		self._merge_thread.start()
+
+	def stop_merging(self):
+		"""
+		stops the background merge thread and waits for a running merge to complete.
+		:return: None.
+		"""
+		if self._merge_thread is None:
+			return
+		self._stop_merging.set()
+		self._merge_thread.join()
+		self._merge_thread = None
+
+	def close(self):
+		"""
+		stops merging, flushes the in memory segment and unmaps the segment files.
+		:return: None.
+		"""
+		self.stop_merging()
+		self.flush()
+		self._pending_file.close()
+		with self._lock:
+			for segment in self._segments:
+				segment.close()
+			self._segments = []
+
+	def release_retired(self):
+		"""
+		unmaps and removes the files of the segments retired by merges, purges and clear. Searches may still hold
+		cursors over a retired segment, so this must be called on the searching thread between searches.
+		:return: None.
+		"""
+		with self._lock:
+			retired, self._retired = self._retired, []
+		for segment in retired:
+			segment.close()
+			os.remove(segment.path)
+
+	def _layers(self):
+		with self._lock:
+			return list(self._segments) + [self._memory]
+
+	def _find_merge(self, segments):
+		tiers = [int(math.log(max(segment.document_count, 1), self._merge_factor)) for segment in segments]
+		start = 0
+		for index in range(1, len(segments) + 1):
+			if index == len(segments) or tiers[index] != tiers[start]:
+				if index - start >= self._merge_factor:
+					return start, start + self._merge_factor
+				start = index
+		return None
+
+	def _merge_loop(self, interval):
+		while not self._stop_merging.wait(interval):
+			while not self._stop_merging.is_set() and self.maybe_merge():
+				pass
+
+	def _write_segment(self, rows):
+		with self._lock:
+			name = "{0:08d}{1}".format(self._next_id, SEGMENT_SUFFIX)
+			self._next_id += 1
+		path = os.path.join(self._directory, name)
+		write_segment(path, rows)
+		return Segment(path)
+
+	def _remove(self, segments):
+		# searches may still hold the segments, so they are only unmapped and removed by release_retired
+		with self._lock:
+			self._retired.extend(segments)
+
+	def _clear_pending(self):
+		if os.fstat(self._pending_file.fileno()).st_size == 0:
+			return
+		self._pending_file.truncate(0)
+		self._pending_file.flush()
+		os.fsync(self._pending_file.fileno())
+
+	def _read_manifest(self):
+		path = os.path.join(self._directory, MANIFEST_NAME)
+		if not os.path.isfile(path):
+			return {"next_id": 0, "segments": []}
+		with open(path, "r") as manifest_file:
+			return json.load(manifest_file)
+
+	def _write_manifest(self):
+		path = os.path.join(self._directory, MANIFEST_NAME)
+		with open(path + ".tmp", "w") as manifest_file:
+			json.dump({"next_id": self._next_id, "segments": [segment.name for segment in self._segments]},
+			          manifest_file)
+			manifest_file.flush()
+			os.fsync(manifest_file.fileno())
+		os.replace(path + ".tmp", path)
+
+
+class TestSegmentIndex(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+
+	@staticmethod
+	def create_entry(page_id, hits):
+		entry = ForwardIndexEntry(page_id)
+		entry.hits = hits
+		return entry
+
+	def test_flush_and_reopen(self):
+		index = SegmentIndex(self.directory)
+		index.add(self.create_entry(2, {1: [Hit(Hit.TITLE_HIT, 0, 0)], 7: [Hit(Hit.TEXT_HIT, 4, 1)]}))
+		index.add(self.create_entry(1, {1: [Hit(Hit.TEXT_HIT, 3, 5), Hit(Hit.TEXT_HIT, 3, 9)]}))
+		self.assertEqual([1, 2], index.get_page_ids(1), "Unflushed pages should be searchable")
+		index.add(self.create_entry(2, {1: [Hit(Hit.TITLE_HIT, 0, 0)]}))
+		self.assertEqual([], index.get_page_ids(7), "Re-added page kept its old postings")
+		index.close()
+		index = SegmentIndex(self.directory)
+		self.assertEqual(1, index.segment_count(), "Flushed segment was not recorded in the manifest")
+		entry = index.get_entry(1)
+		self.assertEqual({1: [Hit(Hit.TEXT_HIT, 3, 5), Hit(Hit.TEXT_HIT, 3, 9)], 2: [Hit(Hit.TITLE_HIT, 0, 0)]},
+		                 entry.pages, "Segment failed to retrieve postings")
+		self.assertEqual([], index.get_page_ids(3), "Segment returned postings for an unknown word")
+		self.assertEqual(list(entry.pages.items()), list(index.iter_entry(1)), "Streamed entry differs")
+		index.close()
+
+	def test_cursor(self):
+		index = SegmentIndex(self.directory)
+		for page_id in range(0, 1000, 2):
+			index.add(self.create_entry(page_id, {1: [Hit(Hit.TEXT_HIT, 1, 0)]}))
+		index.flush()
+		# newer versions of some pages no longer contain the word, one of them is not flushed yet
+		index.add(self.create_entry(500, {2: [Hit(Hit.TEXT_HIT, 1, 0)]}))
+		index.flush()
+		index.add(self.create_entry(502, {2: [Hit(Hit.TEXT_HIT, 1, 0)]}))
+		index.add(self.create_entry(503, {1: [Hit(Hit.TITLE_HIT, 0, 0)]}))
+		expected = [page_id for page_id in range(0, 1000, 2) if page_id not in (500, 502)] + [503]
+		expected.sort()
+		self.assertEqual(expected, index.get_page_ids(1))
+		cursor = index.cursor(1)
+		cursor.advance_to(301)
+		self.assertEqual(302, cursor.page_id(), "Seeking with the skip entries missed the page")
+		cursor.advance_to(497)
+		cursor.next()
+		self.assertEqual(503, cursor.page_id(), "Cursor returned a replaced page")
+		self.assertEqual([Hit(Hit.TITLE_HIT, 0, 0)], decode_hits(cursor.hits()))
+		cursor.advance_to(2000)
+		self.assertTrue(cursor.exhausted())
+		self.assertEqual([0, 498, 503, 998], index.filter_page_ids(1, [0, 1, 498, 500, 502, 503, 998, 999]))
+		self.assertEqual({302: [Hit(Hit.TEXT_HIT, 1, 0)], 503: [Hit(Hit.TITLE_HIT, 0, 0)]},
+		                 index.get_hits(1, [503, 500, 302]), "Failed to seek to the hits of the pages")
+		index.close()
+
+	def test_pending_pages(self):
+		index = SegmentIndex(self.directory)
+		index.log_pending([1, 2])
+		index.add(self.create_entry(1, {1: [Hit(Hit.TEXT_HIT, 1, 0)]}))
+		index.stop_merging()
+		# the process exits without flushing
+		index = SegmentIndex(self.directory)
+		self.assertEqual({1, 2}, index.pending_pages(), "Pending pages were not recorded")
+		self.assertEqual([], index.get_page_ids(1))
+		index.add(self.create_entry(1, {1: [Hit(Hit.TEXT_HIT, 1, 0)]}))
+		index.flush()
+		self.assertEqual(set(), index.pending_pages(), "Flushed pages are still pending")
+		index.close()
+
+	def test_merge(self):
+		index = SegmentIndex(self.directory, merge_factor=2)
+		index.add(self.create_entry(1, {1: [Hit(Hit.TEXT_HIT, 1, 0)], 2: [Hit(Hit.TEXT_HIT, 1, 1)]}))
+		index.flush()
+		index.add(self.create_entry(2, {2: [Hit(Hit.TEXT_HIT, 2, 0)]}))
+		index.flush()
+		# a newer version of page 1 no longer contains word 1
+		index.add(self.create_entry(1, {2: [Hit(Hit.TITLE_HIT, 0, 0)]}))
+		index.flush()
+		self.assertEqual([], index.get_page_ids(1), "Newer segment should replace the page")
+		# a search still holding the merged segments
+		cursor = index.cursor(2)
+		self.assertTrue(index.maybe_merge(), "Segments of the same tier should be merged")
+		self.assertEqual(2, index.segment_count(), "Merge did not combine two segments")
+		index.add(self.create_entry(3, {3: [Hit(Hit.URL_HIT, 0, 0)]}))
+		index.flush()
+		while index.maybe_merge():
+			pass
+		self.assertEqual(1, index.segment_count(), "Merge did not cascade to the next tier")
+		self.assertEqual([], index.get_page_ids(1), "Merge resurrected a replaced page")
+		self.assertEqual({1: [Hit(Hit.TITLE_HIT, 0, 0)], 2: [Hit(Hit.TEXT_HIT, 2, 0)]}, index.get_entry(2).pages,
+		                 "Merge lost postings")
+		cursor.advance_to(2)
+		self.assertEqual(2, cursor.page_id(), "Merged segments were unmapped while a search held them")
+		index.release_retired()
+		self.assertEqual(3, len(os.listdir(self.directory)), "Merged segments were not removed")
+		index.close()
+
+	def test_version(self):
+		path = os.path.join(self.directory, "old" + SEGMENT_SUFFIX)
+		with open(path, "wb") as segment_file:
+			segment_file.write(HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION - 1, 0, 0, HEADER.size, HEADER.size))
+		with self.assertRaises(SegmentException, msg="Segment of another version was opened"):
+			Segment(path)
+
+	def test_purge(self):
+		index = SegmentIndex(self.directory)
+		index.add(self.create_entry(1, {1: [Hit(Hit.TEXT_HIT, 1, 0)]}))
+		index.add(self.create_entry(2, {1: [Hit(Hit.TEXT_HIT, 1, 0)]}))
+		index.flush()
+		index.add(self.create_entry(3, {1: [Hit(Hit.TEXT_HIT, 1, 0)]}))
+		index.flush()
+		index.add(self.create_entry(4, {1: [Hit(Hit.TEXT_HIT, 1, 0)]}))
+		self.assertEqual(2, index.purge([2, 3, 4]), "Purge did not rewrite the segments holding the pages")
+		self.assertEqual([1], index.get_page_ids(1), "Purged pages are still searchable")
+		self.assertEqual(1, index.segment_count(), "Empty segment was not dropped")
+		index.release_retired()
+		self.assertEqual(3, len(os.listdir(self.directory)), "Purged segments were not removed")
+		index.close()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
@@ -0,0 +1,105 @@
+import html
+import unittest
+
+from index.entry import Hit
+from index.query import section_positions
+from index.tokenizer import WORD
+
+# the kinds of sections a snippet is taken from, in order of preference
+SNIPPET_KINDS = (Hit.TEXT_HIT, Hit.HEADER_HIT, Hit.ANCHOR_HIT)
+# the text put between the fragments of a snippet and in place of the text left out around them
+ELLIPSIS = "…"
+
+
+def snippet(sections, hit_lists, max_sections=2, window=20, highlight=("<b>", "</b>")):
+	"""
+	builds a highlighted snippet of a page from the hits of the query terms on it. The sections containing the most
+	distinct terms are chosen, preferring text sections, and only their text is read. The text is html escaped, and
+	the words at the hit positions are wrapped in the highlight markers.
+	:param sections: a dictionary mapping a hit kind to the list of section texts of that kind on the page.
+	:param hit_lists: the hit list of each query term on the page.
+	:param max_sections: the maximum amount of sections the snippet is taken from.
+	:param window: the maximum amount of words of a section in the snippet.
+	:param highlight: the text put before and after each highlighted word.
+	:return: the snippet, or None if no term occurs in a section with text.
+	"""
+	terms, positions = {}, {}
+	for hits in hit_lists:
+		for key, section_hits in section_positions(hits).items():
+			kind, ordinal = key
+			if kind not in SNIPPET_KINDS or ordinal >= len(sections.get(kind, ())):
+				continue
+			terms[key] = terms.get(key, 0) + 1
+			positions.setdefault(key, []).extend(section_hits)
+	if len(terms) == 0:
+		return None
+	chosen = sorted(terms.keys(), key=lambda key: (-terms[key], SNIPPET_KINDS.index(key[0]), -len(positions[key]),
+	                                               key[1]))[:max_sections]
+	chosen.sort(key=lambda key: (SNIPPET_KINDS.index(key[0]), key[1]))
+	return (" " + ELLIPSIS + " ").join(
+		fragment(sections[kind][ordinal], positions[(kind, ordinal)], window, highlight) for kind, ordinal in chosen)
+
+
+def fragment(text, positions, window=20, highlight=("<b>", "</b>")):
+	"""
+	cuts the part of a text with the most hit positions within window words, and highlights the words at the positions.
+	The positions count the words of the text the same way as index.tokenizer.tokenize.
+	:param text: the text of the section.
+	:param positions: the positions of the words to highlight.
+	:param window: the maximum amount of words in the fragment.
+	:param highlight: the text put before and after each highlighted word.
+	:return: the html escaped fragment.
+	"""
+	lowered = text.lower()
+	# lower casing changes the length of a few characters, the word spans then only fit the lower cased text
+	source = text if len(lowered) == len(text) else lowered
+	spans = [match.span() for match in WORD.finditer(lowered)]
+	positions = sorted(set(position for position in positions if position < len(spans)))
+	start = 0
+	if len(positions) != 0:
+		best, count, last = positions[0], 0, 0
+		for first in range(len(positions)):
+			while last < len(positions) and positions[last] < positions[first] + window:
+				last += 1
+			if last - first > count:
+				best, count = positions[first], last - first
+		start = max(0, min(best - window // 4, len(spans) - window))
+	end = min(len(spans), start + window)
+	marked = set(positions)
+	parts = [ELLIPSIS + " "] if start > 0 else []
+	offset = spans[start][0] if start > 0 else 0
+	for position in range(start, end):
+		word_start, word_end = spans[position]
+		parts.append(html.escape(source[offset:word_start]))
+		word = html.escape(source[word_start:word_end])
+		parts.append(highlight[0] + word + highlight[1] if position in marked else word)
+		offset = word_end
+	if end < len(spans):
+		parts.append(" " + ELLIPSIS)
+	else:
+		parts.append(html.escape(source[offset:]))
+	return "".join(parts)
+
+
+class TestSnippet(unittest.TestCase):
+
+	def test_fragment(self):
+		self.assertEqual("Go to <b>Example</b>.", fragment("Go to Example.", [2]))
+		text = " ".join("w" + str(number) for number in range(30))
+		self.assertEqual("… w9 <b>w10</b> w11 w12 …", fragment(text, [10], window=4),
+		                 "Fragment is not cut around the hit")
+		self.assertEqual("… w25 <b>w26</b> <b>w27</b> w28 …", fragment(text, [2, 26, 27], window=4),
+		                 "Fragment does not hold the most hits")
+		self.assertEqual("a &lt; <b>b</b>", fragment("a < b", [1]), "Fragment is not html escaped")
+
+	def test_snippet(self):
+		sections = {Hit.TEXT_HIT: ["nothing here", "the first word", "the first and second word"],
+		            Hit.HEADER_HIT: ["first"]}
+		first = [Hit(Hit.TITLE_HIT, 0, 0), Hit(Hit.HEADER_HIT, 0, 0), Hit(Hit.TEXT_HIT, 1, 1),
+		         Hit(Hit.TEXT_HIT, 2, 1)]
+		second = [Hit(Hit.TEXT_HIT, 2, 3)]
+		self.assertEqual("the <b>first</b> and <b>second</b> word", snippet(sections, [first, second], 1),
+		                 "The section with the most terms was not chosen")
+		self.assertEqual("the <b>first</b> word … the <b>first</b> and <b>second</b> word",
+		                 snippet(sections, [first, second]), "Sections are not in page order")
+		self.assertIsNone(snippet(sections, [[Hit(Hit.URL_HIT, 0, 0)]]), "Snippet without text was made")
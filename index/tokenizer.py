@@ -0,0 +1,49 @@
+import itertools
+import re
+import unittest
+
+# a word starts and ends with a letter or digit of any script, and may contain punctuation in between, such as the
+# apostrophe of it's or the dots of a url. Whitespace of any kind separates words.
+WORD = re.compile(r"[^\W_]\S*(?<![\W_])")
+# the part of a string from its first to its last letter or digit
+ENCLOSED = re.compile(r"[^\W_](?:.*[^\W_])?", re.DOTALL)
+
+
+def tokenize(text):
+	"""
+	splits a text into normalized words, the lower case runs of non whitespace characters without their enclosing
+	punctuation. Runs without any letter or digit are skipped, so a text never yields empty or whitespace only words.
+	:param text: the text to split.
+	:return: an iterator of (word, position) tuples, where position counts the words of the text from 0.
+	"""
+	return zip(WORD.findall(text.lower()), itertools.count())
+
+
+def strip_punctuation(word):
+	"""
+	removes the punctuation enclosing a single word, the same way as tokenize.
+	:param word: the word to strip.
+	:return: the word without enclosing punctuation, or the word itself if it has no letter or digit.
+	"""
+	match = ENCLOSED.search(word)
+	if match is None:
+		return word
+	return match.group()
+
+
+class TestTokenizer(unittest.TestCase):
+
+	def test_tokenize(self):
+		self.assertEqual([("go", 0), ("to", 1), ("example", 2)], list(tokenize("Go  to\texample")),
+		                 "Whitespace runs should separate words")
+		self.assertEqual([("it's", 0), ("https://www.test.com", 1), ("end", 2)],
+		                 list(tokenize("(It's) https://www.test.com -- end.")), "Punctuation was not stripped")
+		self.assertEqual([("über", 0), ("café", 1)], list(tokenize("Über\ncafé!")),
+		                 "Tokenizer is not Unicode aware")
+		self.assertEqual([], list(tokenize(" \n\t ... ")), "Tokenizer produced empty words")
+
+	def test_strip_punctuation(self):
+		self.assertEqual("word", strip_punctuation("(word)."))
+		self.assertEqual("it's", strip_punctuation("'it's'"))
+		self.assertEqual("...", strip_punctuation("..."))
+		self.assertEqual("", strip_punctuation(""))
@@ -2,49 +2,185 @@
 This module if ran takes input from a rabbitmq queue and index it.
 """
 
+import argparse
 import json
+import logging
+import time
 
 import pika
 
-import data.web as wb
 from index.indexer import Indexer
+from index.indexer import configure
+from index.ingest import crawled_document
+from index.ingest import INDEX_ERRORS
+from index.ingest import MALFORMED_ERRORS
+from index.ingest import IndexMaintenance
+from index.migration import migrate
 
+# the maximum amount of crawled pages indexed together
+BATCH_SIZE = 100
+# the maximum amount of milliseconds a received page waits for the rest of its batch
+BATCH_LINGER_MS = 500
+# the minimum amount of seconds between two reports of the indexed pages and the lag of the queue
+REPORT_INTERVAL = 10
+CRAWLED_QUEUE = "crawledQueue"
 
-def handle_crawled_data(chl, method, properties, body):
-	crawled_raw = json.loads(body, encoding = "utf8")
-	crawled = wb.PageDocument()
-	crawled.doc_id = crawled_raw["id"]
-	crawled.url = crawled_raw["url"]
-	for anchor in crawled_raw["anchors"]:
-		anchor_obj = wb.Anchor(anchor["anchorText"], anchor["targetURL"])
-		crawled.anchors.append(anchor_obj)
-	crawled.texts = crawled_raw["text-sections"]
-	for header in crawled_raw["headers"]:
-		crawled.headers.append(header["text"])
-	crawled.title = crawled_raw["title"]
-	crawled.checksum = crawled_raw["checksum"]
-	crawled.html = crawled_raw["content"]
-	print("Received {0}".format(str(crawled)))
-	handle_crawled_data._indexer.index(crawled)
-	chl.basic_ack(delivery_tag = method.delivery_tag)
 
+def parse_crawled_data(body):
+	"""
+	converts a message sent by the crawler to a PageDocument.
+	:param body: the json body of the message.
+	:return: the PageDocument.
+	"""
+	return crawled_document(json.loads(body))
 
-def cleanup():
-	print("closing resources")
-	handle_crawled_data._indexer.close()
+
+class BatchConsumer:
+	"""
+	Consumes crawled pages from a queue and indexes them in batches. A batch is indexed once it holds batch_size pages
+	or its first page has waited linger_ms milliseconds, whichever comes first, and all of its messages are then
+	acknowledged at once. The prefetch limit of the channel is set to the batch size so that the broker never holds
+	back a full batch, nor floods the consumer with more pages than it can index.
+	"""
+
+	def __init__(self, channel, indexer, queue = CRAWLED_QUEUE, batch_size = BATCH_SIZE, linger_ms = BATCH_LINGER_MS,
+	             report_interval = REPORT_INTERVAL):
+		"""
+		creates a new BatchConsumer.
+		:param channel: the blocking channel to consume from.
+		:param indexer: the Indexer to index the pages with.
+		:param queue: the name of the queue of crawled pages.
+		:param batch_size: the maximum amount of pages indexed together.
+		:param linger_ms: the maximum amount of milliseconds a page waits for the rest of its batch.
+		:param report_interval: the minimum amount of seconds between two progress reports, see report.
+		"""
+		self._channel = channel
+		self._indexer = indexer
+		self._queue = queue
+		self._batch_size = batch_size
+		self._linger = linger_ms / 1000
+		self._batch = []
+		self._batch_start = None
+		self._maintenance = IndexMaintenance()
+		self._report_interval = report_interval
+		self._last_report = time.time()
+		self._reported_pages = 0
+
+	def start_consuming(self):
+		"""
+		consumes the queue until interrupted.
+		:return: None.
+		"""
+		self._channel.basic_qos(prefetch_count = self._batch_size)
+		for method, properties, body in self._channel.consume(self._queue, inactivity_timeout = self._linger / 2):
+			if method is not None:
+				self.on_message(method, properties, body)
+			if self._batch_start is not None and time.time() - self._batch_start >= self._linger:
+				self.flush()
+
+	def on_message(self, method, properties, body):
+		"""
+		adds a received message to the current batch, and indexes the batch once it is full. Messages that are not
+		valid crawled pages are rejected without being requeued.
+		:param method: the delivery of the message.
+		:param properties: the properties of the message.
+		:param body: the body of the message.
+		:return: None.
+		"""
+		try:
+			page = parse_crawled_data(body)
+		except MALFORMED_ERRORS as e:
+			print("Rejected malformed message: {0}".format(e))
+			self._channel.basic_nack(delivery_tag = method.delivery_tag, requeue = False)
+			return
+		if self._batch_start is None:
+			self._batch_start = time.time()
+		self._batch.append((method, properties, page))
+		if len(self._batch) >= self._batch_size:
+			self.flush()
+
+	def flush(self):
+		"""
+		indexes the current batch and acknowledges all of its messages with one multiple acknowledgement. If the batch
+		fails, its pages are indexed again one at a time, see index_each, so that a bad page cannot take the good pages
+		of its batch down with it.
+		:return: None.
+		"""
+		batch, batch_start = self._batch, self._batch_start
+		self._batch, self._batch_start = [], None
+		if len(batch) == 0:
+			return
+		try:
+			self._indexer.index_many([page for _, _, page in batch])
+		except INDEX_ERRORS as e:
+			print("Failed to index batch of {0} pages: {1}".format(len(batch), e))
+			self.index_each(batch)
+		else:
+			self._channel.basic_ack(delivery_tag = batch[-1][0].delivery_tag, multiple = True)
+		self._reported_pages += len(batch)
+		if time.time() - self._last_report >= self._report_interval:
+			self.report(batch, batch_start)
+		self._maintenance.maintain(self._indexer)
+
+	def index_each(self, batch):
+		"""
+		indexes the pages of a failed batch one at a time, acknowledging each page that is indexed. A page that fails on
+		its own, such as a page the analysis fails on, is requeued, except if it was already redelivered once, in which
+		case it is rejected so that it cannot block the queue.
+		:param batch: the failed batch.
+		:return: None.
+		"""
+		for method, _, page in batch:
+			try:
+				self._indexer.index_many([page])
+			except INDEX_ERRORS as e:
+				print("Failed to index {0}: {1}".format(page.url, e))
+				self._channel.basic_nack(delivery_tag = method.delivery_tag, requeue = not method.redelivered)
+				continue
+			self._channel.basic_ack(delivery_tag = method.delivery_tag)
+
+	def report(self, batch, batch_start):
+		"""
+		prints the amount of pages consumed since the last report, the latency of the last batch and the lag of the
+		queue. Reading the backlog of the queue takes a round trip to the broker, so this is only called every
+		report_interval seconds.
+		:param batch: the last indexed batch.
+		:param batch_start: the time the first message of the batch was received.
+		:return: None.
+		"""
+		now = time.time()
+		backlog = self._channel.queue_declare(queue = self._queue, durable = True, passive = True).method.message_count
+		timestamps = [properties.timestamp for _, properties, _ in batch if properties.timestamp is not None]
+		lag = "unknown" if len(timestamps) == 0 else "{0:.1f}s".format(now - min(timestamps))
+		print("Consumed {0} pages in {1:.0f}s, last batch in {2:.0f}ms, {3} messages queued, oldest page lag {4}"
+		      .format(self._reported_pages, now - self._last_report, (now - batch_start) * 1000, backlog, lag))
+		self._last_report = now
+		self._reported_pages = 0
 
 
 if __name__ == "__main__":
-	indexer = Indexer(index_dir = "search_index")
-	indexer.load()
-	handle_crawled_data._indexer = indexer
+	parser = argparse.ArgumentParser(description = "Indexes crawled pages from a rabbitmq queue.")
+	parser.add_argument("--database", default = "sqlite:///search_index.db", help = "the database connection string")
+	parser.add_argument("--documents", default = "documents", help = "the directory of the page content store")
+	parser.add_argument("--batch-size", type = int, default = BATCH_SIZE, help = "the maximum pages per batch")
+	parser.add_argument("--linger-ms", type = int, default = BATCH_LINGER_MS,
+	                    help = "the maximum milliseconds a page waits for its batch")
+	parser.add_argument("--report-interval", type = float, default = REPORT_INTERVAL,
+	                    help = "the minimum seconds between progress reports")
+	arguments = parser.parse_args()
+	logging.basicConfig(level = logging.INFO, format = "%(asctime)s %(levelname)s %(name)s: %(message)s")
+	migrate(configure(arguments.database), arguments.documents)
+	indexer = Indexer(document_directory = arguments.documents)
 	connection = pika.BlockingConnection(pika.ConnectionParameters(host = "localhost"))
 	channel = connection.channel()
-	channel.queue_declare(queue = "crawledQueue", durable = True)
-	channel.basic_consume(handle_crawled_data, queue = "crawledQueue")
+	channel.queue_declare(queue = CRAWLED_QUEUE, durable = True)
+	consumer = BatchConsumer(channel, indexer, batch_size = arguments.batch_size, linger_ms = arguments.linger_ms,
+	                         report_interval = arguments.report_interval)
 	try:
-		channel.start_consuming()
+		consumer.start_consuming()
 	except KeyboardInterrupt:
-		cleanup()
+		print("closing resources")
+		consumer.flush()
+		indexer.close()
 		channel.close()
 		connection.close()